@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compares the throughput of the buffered transfer loop with the previous loop, which
+# allocated a new 32KB bytes object for every read. Needs an environment in which the
+# plugin can be imported, but not a running server:
+#
+#     python plugin_tests/copy_benchmark.py [size in MB]
+
+import os
+import sys
+import tempfile
+import time
+
+from girder.plugins.wt_data_manager.lib.handlers.common import FileLikeUrlTransferHandler
+
+MB = 1024 * 1024
+LEGACY_BUFSZ = 32768
+
+
+class _Limiter:
+    def throttle(self, userId, n):
+        pass
+
+
+class _Manager:
+    def __init__(self):
+        self.bandwidthLimiter = _Limiter()
+
+    def transferProgress(self, transferId, total, current):
+        pass
+
+
+class _Handler(FileLikeUrlTransferHandler):
+    # only what transferBytes() needs; there is no item behind this handler
+    def __init__(self, size):
+        self.transferId = None
+        self.flen = size
+        self.lastTransferred = 0
+        self.watermark = None
+        self.user = {'_id': None}
+        self.transferManager = _Manager()
+
+
+def legacyTransferBytes(handler, outf, inf, crt=0):
+    while True:
+        buf = inf.read(LEGACY_BUFSZ)
+        if not buf:
+            break
+        outf.write(buf)
+        crt = crt + len(buf)
+        outf.flush()
+        handler.bytesCommitted(crt)
+        handler.updateTransferProgress(handler.flen, crt)
+        handler.throttle(len(buf))
+
+
+def run(name, copy, path, size, repeat=5):
+    best = None
+    for i in range(repeat):
+        with open(path, 'rb') as inf, open(os.devnull, 'wb') as outf:
+            start = time.time()
+            copy(_Handler(size), outf, inf)
+            elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('%-10s %8.1f MB/s' % (name, size / MB / best))
+    return size / best
+
+
+def main():
+    size = int(sys.argv[1]) * MB if len(sys.argv) > 1 else 256 * MB
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for i in range(size // MB):
+                f.write(os.urandom(MB))
+        legacy = run('legacy', legacyTransferBytes, path, size)
+        buffered = run('buffered', lambda h, o, i: h.transferBytes(o, i), path, size)
+        print('speedup    %8.2fx' % (buffered / legacy))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,13 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import collections
+import gzip
+import io
+import random
 import re
 import threading
+import time
+import urllib.parse
+import zipfile
 
 
 MULTIPLIERS = {
@@ -10,57 +17,207 @@ MULTIPLIERS = {
     'G': 1024 * 1024 * 1024
 }
 
-BUFLEN = 256
+# The byte at offset i in a served file is i % PATTERN_PERIOD, which allows
+# clients to check that ranges were assembled in the right place
+PATTERN_PERIOD = 251
+PATTERN = bytes(range(PATTERN_PERIOD)) * 256
+WRITE_SIZE = 64 * 1024
+
+
+def content(start, end):
+    pos = start
+    while pos < end:
+        offset = pos % PATTERN_PERIOD
+        n = min(len(PATTERN) - offset, end - pos)
+        yield PATTERN[offset:offset + n]
+        pos += n
 
 
 class Handler(BaseHTTPRequestHandler):
+    # allows clients to keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.serve(False)
+
     def do_GET(self):
-        try:
-            szMatch = re.search('[0-9]+', self.path)
-            if not szMatch:
-                raise IOError('size pattern not found')
+        self.serve(True)
 
-            szStr = szMatch.group()
-            unit = self.path[len(szStr) + 1:]
-            sz = int(szStr)
+    def parseSize(self):
+        path = self.path.split('?')[0]
+        szMatch = re.search('[0-9]+', path)
+        if not szMatch:
+            raise IOError('size pattern not found')
 
-            if unit not in MULTIPLIERS:
-                raise IOError('no such unit %s' % unit)
-            multiplier = MULTIPLIERS[unit]
+        szStr = szMatch.group()
+        unit = path[len(szStr) + 1:]
+        sz = int(szStr)
 
-            szm = sz * multiplier
+        if unit not in MULTIPLIERS:
+            raise IOError('no such unit %s' % unit)
+        multiplier = MULTIPLIERS[unit]
 
-            print('Got request for %s x %s (%s)' % (sz, unit, szm))
-            mimetype = 'application/octet-stream'
+        if self.server.verbose:
+            print('Got request for %s x %s (%s)' % (sz, unit, sz * multiplier))
+        return sz * multiplier
 
-            self.send_response(200)
-            self.send_header('Content-type', mimetype)
-            self.end_headers()
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
 
-            buf = b''
-            for i in range(BUFLEN):
-                buf += b'\0'
+    def parseRange(self, szm):
+        rangeHeader = self.headers.get('Range')
+        if rangeHeader is None:
+            return None
+        rangeMatch = re.match(r'bytes=([0-9]+)-([0-9]*)$', rangeHeader)
+        if not rangeMatch:
+            return None
+        start = int(rangeMatch.group(1))
+        end = szm
+        if rangeMatch.group(2):
+            end = min(int(rangeMatch.group(2)) + 1, szm)
+        return (start, end)
 
-            while szm > BUFLEN:
-                self.wfile.write(buf)
-                szm -= BUFLEN
+    def getOption(self, query, name):
+        # query parameters override the defaults of the server
+        if name in query:
+            return float(query[name][0])
+        return self.server.options.get(name, 0)
 
-            if szm > 0:
-                self.wfile.write(buf[:szm])
+    def serve(self, body):
+        self.server.requests.append((self.command, self.path))
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        delay = self.getOption(query, 'delay')
+        if delay > 0:
+            # simulates a slow server
+            time.sleep(delay)
+        errorRate = self.getOption(query, 'error')
+        if errorRate > 0:
+            with self.server.lock:
+                attempt = self.server.attempts[self.path]
+                self.server.attempts[self.path] += 1
+            # the outcome only depends on the seed, the path and the number of earlier
+            # requests for it, not on the order in which concurrent requests arrive
+            fail = random.Random('%s %s %s' % (self.server.seed, self.path, attempt)).random() \
+                < errorRate
+            if fail:
+                self.send_error(503, 'Injected failure')
+                return
+        data = self.server.files.get(self.path.split('?')[0])
+        try:
+            szm = len(data) if data is not None else self.parseSize()
+        except IOError as ex:
+            self.send_error(404, 'File Not Found: %s (%s)' % (self.path, ex))
+            return
 
+        if self.getOption(query, 'gzip') and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            self.serveGzipped(body, data, szm, self.getOption(query, 'rate'))
             return
 
-        except IOError as ex:
-            self.send_error(404, 'File Not Found: %s (%s)' % (self.path, ex.message))
+        mimetype = 'application/octet-stream'
+        byteRange = self.parseRange(szm)
+        if byteRange is None:
+            start, end = 0, szm
+            self.send_response(200)
+        else:
+            start, end = byteRange
+            if start >= end:
+                self.send_error(416, 'Range Not Satisfiable')
+                return
+            self.server.rangeRequests.append(byteRange)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end - 1, szm))
+
+        self.send_header('Content-type', mimetype)
+        self.send_header('Accept-Ranges', 'bytes')
+        # the content only depends on the size
+        self.send_header('ETag', '"%s"' % szm)
+        self.send_header('Last-Modified', 'Thu, 01 Jan 1970 00:00:00 GMT')
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+
+        if body:
+            if data is not None:
+                self.write([data[start:end]], self.getOption(query, 'rate'))
+            else:
+                self.write(content(start, end), self.getOption(query, 'rate'))
+
+    def serveGzipped(self, body, data, szm, rate):
+        # ranges are not supported, as with most servers that compress on the fly
+        key = self.path.split('?')[0]
+        with self.server.lock:
+            compressed = self.server.gzipped.get(key)
+        if compressed is None:
+            if data is None:
+                data = b''.join(content(0, szm))
+            compressed = gzip.compress(data, compresslevel=1)
+            with self.server.lock:
+                self.server.gzipped[key] = compressed
+        self.send_response(200)
+        self.send_header('Content-type', 'application/octet-stream')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(compressed)))
+        self.end_headers()
+        if body:
+            self.write([compressed], rate)
+
+    def write(self, chunks, rate):
+        # writes the chunks, at no more than rate bytes per second if rate is set
+        start = time.time()
+        written = 0
+        for chunk in chunks:
+            for pos in range(0, len(chunk), WRITE_SIZE):
+                piece = chunk[pos:pos + WRITE_SIZE]
+                self.wfile.write(piece)
+                written += len(piece)
+                if rate > 0:
+                    wait = written / rate - (time.time() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    # benchmarks open many connections at once
+    request_queue_size = 1024
 
 
 class Server(threading.Thread):
-    def __init__(self):
+    """
+    Serves files whose size is given by their path, e.g., /10M, made of a fixed pattern
+    (see content()), or files added with addFile() or addZipArchive(). Range requests are
+    supported. Each response can be altered using query parameters, which default to the
+    options passed to the constructor:
+
+    - delay: seconds to wait before responding
+    - rate: the maximum number of bytes per second to send
+    - error: the probability of failing a request with a 503 response
+    - gzip: if non-zero, compress the response if the client accepts it
+
+    Whether a request fails is decided by a random generator seeded with the seed, the
+    path of the request and the number of earlier requests for the same path, so the
+    same requests fail on every run, whatever the order of concurrent requests. Requests
+    are logged unless verbose is False.
+    """
+
+    def __init__(self, seed=0, verbose=True, **options):
         threading.Thread.__init__(self, name='HTTP Fake Data Server')
         self.daemon = True
+        self.seed = seed
+        self.verbose = verbose
+        self.options = options
 
     def start(self):
-        self.server = HTTPServer(('', 0), Handler)
+        self.server = _HTTPServer(('', 0), Handler)
+        self.server.rangeRequests = []
+        self.server.requests = []
+        self.server.files = {}
+        self.server.gzipped = {}
+        self.server.options = self.options
+        self.server.verbose = self.verbose
+        self.server.seed = self.seed
+        self.server.attempts = collections.Counter()
+        self.server.lock = threading.Lock()
         print('Started httpserver on port %s' % self.server.server_port)
         threading.Thread.start(self)
 
@@ -73,5 +230,30 @@ class Server(threading.Thread):
     def getUrl(self):
         return 'http://localhost:%s' % self.server.server_port
 
+    def addFile(self, path, data):
+        # serves the given data instead of the generated pattern
+        self.server.files[path] = data
+
+    def addZipArchive(self, path, sizes, compression=zipfile.ZIP_STORED):
+        """
+        Serves a zip archive with members of the given sizes, made of the generated pattern,
+        and returns the names of the members.
+        """
+        buf = io.BytesIO()
+        names = []
+        with zipfile.ZipFile(buf, 'w', compression) as zf:
+            for i, size in enumerate(sizes):
+                name = 'member%s' % i
+                zf.writestr(name, b''.join(content(0, size)))
+                names.append(name)
+        self.addFile(path, buf.getvalue())
+        return names
+
+    def getRangeRequests(self):
+        return self.server.rangeRequests
+
+    def getRequests(self):
+        return self.server.requests
+
     def stop(self):
         self.server.shutdown()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Transfer benchmarks. Each test locks a set of HTTP items served by the local server in
+# httpserver.py, the same way a session would, waits for all of them to be cached and
+# reports the throughput (MB/s and transfers/s) and the p50/p99 time from acquiring a
+# lock to the item being cached. The following environment variables are recognized:
+#
+#   DM_BENCHMARK_SCALE      multiplies the sizes of all files (default 1)
+#   DM_BENCHMARK_OUTPUT     file to write the results to, as JSON
+#   DM_BENCHMARK_BASELINE   results of an earlier run, in the same format; tests that
+#                           are slower than the baseline by more than the tolerance fail
+#   DM_BENCHMARK_TOLERANCE  the allowed slowdown, as a fraction (default 0.25)
+#
+# The benchmarks move hundreds of megabytes and their results depend on the machine, so
+# they are skipped unless DM_BENCHMARK, DM_BENCHMARK_OUTPUT or DM_BENCHMARK_BASELINE is set.
+
+from tests import base
+import cherrypy
+import json
+import os
+import threading
+import time
+import unittest
+from girder import events
+from .httpserver import Server
+
+
+KB = 1024
+MB = 1024 * KB
+SCALE = float(os.environ.get('DM_BENCHMARK_SCALE', 1))
+TOLERANCE = float(os.environ.get('DM_BENCHMARK_TOLERANCE', 0.25))
+TIMEOUT = 600
+
+RESULTS = {}
+
+
+def setUpModule():
+    if not any(os.environ.get(name) for name in
+               ('DM_BENCHMARK', 'DM_BENCHMARK_OUTPUT', 'DM_BENCHMARK_BASELINE')):
+        raise unittest.SkipTest('Set DM_BENCHMARK to run the transfer benchmarks')
+    base.enabledPlugins.append('wt_data_manager')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+    output = os.environ.get('DM_BENCHMARK_OUTPUT')
+    if output:
+        with open(output, 'w') as f:
+            json.dump(RESULTS, f, indent=2, sort_keys=True)
+
+
+def loadBaseline():
+    path = os.environ.get('DM_BENCHMARK_BASELINE')
+    if not path:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def percentile(values, p):
+    # nearest rank
+    values = sorted(values)
+    index = max(int(round(p / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def scaled(size):
+    return max(int(size * SCALE), 1)
+
+
+class TransferBenchmarkTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.user = self.model('user').createUser(
+            'wt-dm-bench-user', 'password', 'Bench', 'User', 'bench@example.com')
+        collection = self.model('collection').createCollection(
+            'wt_dm_benchmark', creator=self.user, public=False, reuseExisting=True)
+        self.folder = self.model('folder').createFolder(
+            collection, 'wt_dm_benchmark', parentType='collection', reuseExisting=True)
+        self.apiroot = cherrypy.tree.apps['/api'].root.v1
+        self.baseline = loadBaseline()
+        self.cached = {}
+        self.cachedLock = threading.Lock()
+        events.bind('dm.fileDownloaded', 'benchmark', self.fileDownloaded)
+
+    def tearDown(self):
+        events.unbind('dm.fileDownloaded', 'benchmark')
+        base.TestCase.tearDown(self)
+
+    def fileDownloaded(self, event):
+        with self.cachedLock:
+            self.cached.setdefault(str(event.info['itemId']), time.time())
+
+    def createItems(self, server, files):
+        items = []
+        for i, (path, size) in enumerate(files):
+            resp = self.request(path='/file', method='POST', user=self.user, params={
+                'parentType': 'folder',
+                'parentId': self.folder['_id'],
+                'name': 'bench%s' % i,
+                'linkUrl': server.getUrl() + path,
+                'size': size
+            })
+            self.assertStatusOk(resp)
+            items.append(self.model('item').load(resp.json['itemId'], user=self.user))
+        return items
+
+    def runBenchmark(self, name, server, files, expectFailures=False):
+        items = self.createItems(server, files)
+        dataSet = [{'itemId': item['_id'], 'mountPath': '/' + item['name'],
+                    '_modelType': 'item'} for item in items]
+        sessionModel = self.model('session', 'wt_data_manager')
+        lockModel = self.model('lock', 'wt_data_manager')
+        session = sessionModel.createSession(self.user, dataSet=dataSet)
+
+        started = {}
+        locks = []
+        for item in items:
+            started[str(item['_id'])] = time.time()
+            locks.append(lockModel.acquireLock(self.user, session['_id'], item['_id']))
+        failed = self.waitForItems(items)
+        with self.cachedLock:
+            cached = dict(self.cached)
+
+        latencies = [cached[itemId] - started[itemId] for itemId in started if itemId in cached]
+        transferred = sum(item['size'] for item in items if str(item['_id']) in cached)
+        elapsed = max(cached.values()) - min(started.values()) if cached else 0
+        result = {
+            'transfers': len(items),
+            'failed': failed,
+            'bytes': transferred,
+            'seconds': elapsed,
+            'mbPerSecond': transferred / MB / elapsed if elapsed > 0 else 0,
+            'transfersPerSecond': len(latencies) / elapsed if elapsed > 0 else 0,
+            'p50': percentile(latencies, 50) if latencies else None,
+            'p99': percentile(latencies, 99) if latencies else None
+        }
+        RESULTS[name] = result
+        print('%-14s %5d transfers %4d failed %9.1f MB/s %8.1f transfers/s '
+              'p50 %7.3fs p99 %7.3fs' %
+              (name, result['transfers'], failed, result['mbPerSecond'],
+               result['transfersPerSecond'], result['p50'] or 0, result['p99'] or 0))
+
+        for lock in locks:
+            lockModel.releaseLock(self.user, lock)
+        sessionModel.deleteSession(self.user, session)
+        # keep the private storage from filling up over several benchmarks
+        self.apiroot.dm.cacheManager.clearCache(False)
+
+        if not expectFailures:
+            self.assertEqual(failed, 0)
+        self.checkBaseline(name, result)
+        return result
+
+    def waitForItems(self, items):
+        # returns the number of items that could not be transferred
+        ids = [item['_id'] for item in items]
+        deadline = time.time() + TIMEOUT
+        while time.time() < deadline:
+            pending = self.model('item').find({
+                '_id': {'$in': ids},
+                'dm.cached': {'$ne': True},
+                'dm.transferError': {'$ne': True}
+            }).count()
+            if pending == 0:
+                return self.model('item').find({
+                    '_id': {'$in': ids},
+                    'dm.transferError': True
+                }).count()
+            time.sleep(0.05)
+        self.fail('Transfers did not finish after %ss' % TIMEOUT)
+
+    def checkBaseline(self, name, result):
+        baseline = self.baseline.get(name)
+        if baseline is None or not baseline.get('transfersPerSecond'):
+            return
+        minimum = baseline['transfersPerSecond'] * (1 - TOLERANCE)
+        self.assertGreaterEqual(
+            result['transfersPerSecond'], minimum,
+            '%s: %.1f transfers/s, baseline %.1f' % (name, result['transfersPerSecond'],
+                                                     baseline['transfersPerSecond']))
+
+    def startServer(self, **options):
+        server = Server(verbose=False, **options)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def test01SmallFiles(self):
+        server = self.startServer()
+        size = scaled(16 * KB)
+        self.runBenchmark('smallFiles', server,
+                          [('/%s?i=%s' % (size, i), size) for i in range(200)])
+
+    def test02LargeFiles(self):
+        server = self.startServer()
+        size = scaled(64 * MB)
+        self.runBenchmark('largeFiles', server,
+                          [('/%s?i=%s' % (size, i), size) for i in range(4)])
+
+    def test03MixedFiles(self):
+        server = self.startServer()
+        small = scaled(64 * KB)
+        large = scaled(32 * MB)
+        files = [('/%s?i=%s' % (small, i), small) for i in range(98)] + \
+            [('/%s?i=%s' % (large, i), large) for i in range(2)]
+        self.runBenchmark('mixedFiles', server, files)
+
+    def test04SlowOrigin(self):
+        # 50ms to first byte and 8MB/s per connection
+        server = self.startServer(delay=0.05, rate=8 * MB)
+        size = scaled(MB)
+        self.runBenchmark('slowOrigin', server,
+                          [('/%s?i=%s' % (size, i), size) for i in range(32)])
+
+    def test05FlakyOrigin(self):
+        # the same requests fail on every run, since failures only depend on the seed of
+        # the server and on the request
+        server = self.startServer(error=0.05)
+        size = scaled(64 * KB)
+        result = self.runBenchmark('flakyOrigin', server,
+                                   [('/%s?i=%s' % (size, i), size) for i in range(100)],
+                                   expectFailures=True)
+        self.assertLess(result['failed'], 100)
+
+    def test06Gzip(self):
+        server = self.startServer(gzip=1)
+        size = scaled(MB)
+        self.runBenchmark('gzip', server,
+                          [('/%s?i=%s' % (size, i), size) for i in range(16)])
+
+    def test07ZipMembers(self):
+        server = self.startServer()
+        sizes = [scaled(64 * KB)] * 50
+        names = server.addZipArchive('/archive.zip', sizes)
+        self.runBenchmark('zipMembers', server,
+                          [('/archive.zip?path=%s' % name, size)
+                           for name, size in zip(names, sizes)])
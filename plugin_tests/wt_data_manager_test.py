@@ -2,14 +2,20 @@
 # -*- coding: utf-8 -*-
 
 from tests import base
+import datetime
+import hashlib
 import tempfile
+import threading
 import time
 import os
 import cherrypy
 import json
 from bson import ObjectId
+from girder import events
 import shutil
-from .httpserver import Server
+import subprocess
+import sys
+from .httpserver import Server, content
 # oh, boy; you'd think we've learned from #include...
 # from plugins.wt_data_manager.server.constants import PluginSettings
 
@@ -488,3 +494,1116 @@ class IntegrationTestCase(base.TestCase):
             path='/dm/session/{_id}'.format(**session),
             method='DELETE', user=self.user)
         self.assertStatusOk(resp)
+
+    def test10TransferSchedulerLimits(self):
+        from girder.plugins.wt_data_manager.lib.transfer_manager import \
+            TransferScheduler, ScheduledTransfer
+
+        class Handler:
+            def __init__(self, url):
+                self.url = url
+
+            def getSourceUrl(self):
+                return self.url
+
+        settings = {
+            'dm.transfer_worker_count': 0,
+            'dm.transfer_host_limit': 1,
+            'dm.transfer_scheme_limits': {'file': 1},
+            'dm.transfer_priority_aging_interval': 0
+        }
+        # no workers are started, so entries can be taken manually
+        scheduler = TransferScheduler(settings, None)
+        a1 = ScheduledTransfer('a1', 't1', Handler('http://a.org/1'))
+        a2 = ScheduledTransfer('a2', 't2', Handler('http://a.org/2'))
+        b1 = ScheduledTransfer('b1', 't3', Handler('http://b.org/1'))
+        f1 = ScheduledTransfer('f1', 't4', Handler('file:///tmp/1'))
+        f2 = ScheduledTransfer('f2', 't5', Handler('file:///tmp/2'))
+        for entry in [a1, a2, b1, f1, f2]:
+            scheduler.submit(entry)
+
+        self.assertIs(scheduler.take(), a1)
+        # a2 is held back by the host limit and f2 by the scheme limit
+        self.assertIs(scheduler.take(), b1)
+        self.assertIs(scheduler.take(), f1)
+        self.assertEqual(scheduler.getQueueLength(), 2)
+        scheduler.release(f1)
+        self.assertIs(scheduler.take(), f2)
+        scheduler.release(a1)
+        self.assertIs(scheduler.take(), a2)
+
+    def test11TransferSchedulerPriority(self):
+        from girder.plugins.wt_data_manager.lib.transfer_manager import \
+            TransferScheduler, ScheduledTransfer
+        from girder.plugins.wt_data_manager.constants import TransferPriority
+
+        class Handler:
+            def getSourceUrl(self):
+                return None
+
+        settings = {
+            'dm.transfer_worker_count': 0,
+            'dm.transfer_host_limit': 0,
+            'dm.transfer_scheme_limits': {},
+            'dm.transfer_priority_aging_interval': 60
+        }
+        scheduler = TransferScheduler(settings, None)
+        bulk = ScheduledTransfer('b', 't1', Handler(), TransferPriority.BULK)
+        normal = ScheduledTransfer('n', 't2', Handler(), TransferPriority.NORMAL)
+        interactive = ScheduledTransfer('i', 't3', Handler(), TransferPriority.INTERACTIVE)
+        for entry in [bulk, normal, interactive]:
+            scheduler.submit(entry)
+        self.assertIs(scheduler.take(), interactive)
+
+        # after waiting for more than two aging intervals, the bulk transfer
+        # overtakes a normal transfer that was just queued
+        bulk.queuedTime -= 121
+        self.assertIs(scheduler.take(), bulk)
+
+        late = ScheduledTransfer('l', 't4', Handler(), TransferPriority.BULK)
+        scheduler.submit(late)
+        scheduler.raisePriority('l', TransferPriority.INTERACTIVE)
+        self.assertIs(scheduler.take(), late)
+        self.assertIs(scheduler.take(), normal)
+
+    def test12HttpSessionPool(self):
+        from girder.plugins.wt_data_manager.lib.handlers.http_pool import HttpSessionPool
+
+        self.testServer = Server()
+        self.testServer.start()
+        try:
+            pool = HttpSessionPool({'dm.http_pool_size': 2, 'dm.http_pool_idle_timeout': 60})
+            url = self.testServer.getUrl() + '/1K'
+            for i in range(3):
+                resp = pool.getSession(url).get(url)
+                self.assertEqual(len(resp.content), 1024)
+            stats = pool.getStats()[self.testServer.getUrl()]
+            self.assertEqual(stats['requests'], 3)
+            self.assertEqual(stats['connections'], 1)
+            self.assertEqual(stats['reused'], 2)
+        finally:
+            self.testServer.stop()
+
+    def test13HttpRangedTransfer(self):
+        from girder.plugins.wt_data_manager.lib.handlers.http import Http
+
+        self.model('setting').set('dm.http_ranged_min_size', MB)
+        rangeSize = Http.RANGE_SIZE
+        Http.RANGE_SIZE = 256 * 1024
+        self.testServer = Server()
+        self.testServer.start()
+        try:
+            self.createHttpFile()
+            dataSet = self.makeDataSet([self.httpItem])
+            session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                             dataSet=dataSet)
+            lock = self.model('lock', 'wt_data_manager').acquireLock(self.user, session['_id'],
+                                                                     self.httpItem['_id'])
+            psPath = self.waitForFile(self.reloadItem(self.httpItem))
+            with open(psPath, 'rb') as f:
+                self.assertEqual(f.read(), b''.join(content(0, MB)))
+            self.assertEqual(len(self.testServer.getRangeRequests()), 4)
+
+            self.model('lock', 'wt_data_manager').releaseLock(self.user, lock)
+            self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+        finally:
+            Http.RANGE_SIZE = rangeSize
+            self.testServer.stop()
+
+    def test14HttpResume(self):
+        from girder.plugins.wt_data_manager.lib.handlers.partial import \
+            ResumeRecord, ByteRanges
+
+        self.testServer = Server()
+        self.testServer.start()
+        try:
+            self.createHttpFile()
+            # pretend that a previous transfer was interrupted half way
+            psPath = self.apiroot.dm.cacheManager.pathMapper.getPSPath(self.httpItem['_id'])
+            os.makedirs(os.path.dirname(psPath), exist_ok=True)
+            with open(psPath, 'wb') as f:
+                f.write(b''.join(content(0, MB // 2)))
+                f.truncate(MB)
+            validator = {'etag': '"%s"' % MB, 'lastModified': 'Thu, 01 Jan 1970 00:00:00 GMT'}
+            ResumeRecord(psPath, self.testServer.getUrl() + '/1M', MB, validator,
+                         ByteRanges([[0, MB // 2]])).save()
+
+            dataSet = self.makeDataSet([self.httpItem])
+            session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                             dataSet=dataSet)
+            lock = self.model('lock', 'wt_data_manager').acquireLock(self.user, session['_id'],
+                                                                     self.httpItem['_id'])
+            psPath = self.waitForFile(self.reloadItem(self.httpItem))
+            with open(psPath, 'rb') as f:
+                self.assertEqual(f.read(), b''.join(content(0, MB)))
+            # only the missing half was requested
+            self.assertEqual(self.testServer.getRangeRequests(), [(MB // 2, MB)])
+            self.assertFalse(os.path.exists(ResumeRecord.getPath(psPath)))
+
+            self.model('lock', 'wt_data_manager').releaseLock(self.user, lock)
+            self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+        finally:
+            self.testServer.stop()
+
+    def test15HttpChecksum(self):
+        from girder.plugins.wt_data_manager.lib.handlers.http import Http
+
+        self.model('setting').set('dm.http_ranged_min_size', MB)
+        rangeSize = Http.RANGE_SIZE
+        Http.RANGE_SIZE = 256 * 1024
+        self.testServer = Server()
+        self.testServer.start()
+        try:
+            self.createHttpFile()
+            digest = hashlib.sha256(b''.join(content(0, MB))).hexdigest()
+            self.model('item').setMetadata(self.httpItem, {'checksum': {'sha256': digest}})
+            dataSet = self.makeDataSet([self.httpItem])
+            session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                             dataSet=dataSet)
+            lock = self.model('lock', 'wt_data_manager').acquireLock(self.user, session['_id'],
+                                                                     self.httpItem['_id'])
+            item = self.reloadItem(self.httpItem)
+            self.waitForFile(item)
+            # the checksum was computed while downloading the ranges
+            self.assertEqual(self.reloadItem(item)['dm']['checksum'], {'sha256': digest})
+
+            self.model('lock', 'wt_data_manager').releaseLock(self.user, lock)
+            self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+        finally:
+            Http.RANGE_SIZE = rangeSize
+            self.testServer.stop()
+
+    def test16ProgressiveDownload(self):
+        from girder import events
+        from girder.plugins.wt_data_manager.lib.tm_utils import Watermark
+        import threading
+
+        item = self.gfiles[2]
+        psPath = os.path.join(self.tmpdir['test_'], 'partial')
+        data = b''.join(content(0, MB))
+        watermark = Watermark(psPath)
+
+        def getWatermark(event):
+            if event.info['itemId'] == item['_id']:
+                event.addResponse(watermark)
+
+        events.bind('dm.getWatermark', 'test', getWatermark)
+        try:
+            # a range that is available is returned right away
+            with open(psPath, 'wb') as f:
+                f.write(data[:MB // 2])
+            watermark.advance(MB // 2)
+            stream = self.model('lock', 'wt_data_manager').downloadItem(
+                {'itemId': item['_id']}, offset=1000, length=2000)
+            self.assertEqual(b''.join(stream()), data[1000:3000])
+
+            # reading past the watermark waits for the rest of the file
+            received = []
+            stream = self.model('lock', 'wt_data_manager').downloadItem(
+                {'itemId': item['_id']}, offset=MB // 4)
+            reader = threading.Thread(target=lambda: received.extend(stream()))
+            reader.start()
+            time.sleep(0.5)
+            self.assertTrue(reader.is_alive())
+            self.assertEqual(b''.join(received), data[MB // 4:MB // 2])
+            with open(psPath, 'ab') as f:
+                f.write(data[MB // 2:])
+            watermark.advance(MB)
+            reader.join(10)
+            self.assertFalse(reader.is_alive())
+            self.assertEqual(b''.join(received), data[MB // 4:])
+
+            # a stalled transfer ends the download with an error
+            stalled = Watermark(psPath)
+            with self.assertRaises(IOError):
+                stalled.waitFor(1, 0.1)
+        finally:
+            events.unbind('dm.getWatermark', 'test')
+
+        # cached files are streamed to the end, whatever the size of the item says
+        self.model('item').update({'_id': item['_id']}, {'$set': {
+            'size': 0, 'dm.cached': True, 'dm.psPath': psPath}})
+        stream = self.model('lock', 'wt_data_manager').downloadItem({'itemId': item['_id']})
+        self.assertEqual(b''.join(stream()), data)
+        self.model('item').update({'_id': item['_id']}, {'$set': {'dm.cached': False}})
+
+    def test17LocalCopyFallback(self):
+        from girder.plugins.wt_data_manager.lib.handlers.local import Local
+
+        # pretend that the kernel cannot copy anything, so the buffered copy is used
+        saved = (Local.clone, Local.copyFileRange, Local.sendfile)
+        Local.clone = lambda self, infd, outfd: False
+        Local.copyFileRange = lambda self, infd, outfd, crt: crt
+        Local.sendfile = lambda self, infd, outfd, crt: crt
+        try:
+            dataSet = self.makeDataSet(self.gfiles)
+            self._testItem(dataSet, self.gfiles[3])
+        finally:
+            (Local.clone, Local.copyFileRange, Local.sendfile) = saved
+
+    def test18GlobusTaskMonitor(self):
+        from girder.plugins.wt_data_manager.lib.handlers.globus_monitor import GlobusTaskMonitor
+
+        class FakeTransferClient:
+            def __init__(self):
+                self.polls = []
+                self.status = {}
+
+            def task_list(self, filter, limit):
+                ids = filter[len('task_id:'):].split(',')
+                self.polls.append(ids)
+                return [{'task_id': id, 'status': self.status[id], 'bytes_transferred': 0}
+                        for id in ids]
+
+        class FakeClients:
+            def __init__(self):
+                self.tc = FakeTransferClient()
+
+            def getUserTransferClient(self, user):
+                return self.tc
+
+        class Listener:
+            def __init__(self):
+                self.statuses = []
+
+            def taskUpdated(self, task):
+                self.statuses.append(task['status'])
+
+        GlobusTaskMonitor.INITIAL_INTERVAL = 0.1
+        clients = FakeClients()
+        monitor = GlobusTaskMonitor(clients)
+        listeners = [Listener() for i in range(3)]
+        for i, listener in enumerate(listeners):
+            clients.tc.status[str(i)] = 'ACTIVE'
+            monitor.watch(self.user, str(i), listener)
+        monitor.start()
+        try:
+            time.sleep(0.5)
+            # all tasks of a user are polled with one request
+            self.assertEqual(sorted(clients.tc.polls[0]), ['0', '1', '2'])
+            clients.tc.status['1'] = 'SUCCEEDED'
+            for i in range(50):
+                if listeners[1].statuses[-1] == 'SUCCEEDED':
+                    break
+                time.sleep(0.1)
+            self.assertEqual(listeners[1].statuses[-1], 'SUCCEEDED')
+            self.assertEqual(monitor.getTaskCount(), 2)
+        finally:
+            GlobusTaskMonitor.INITIAL_INTERVAL = 2
+
+    def test19GlobusTaskBatcher(self):
+        from girder.plugins.wt_data_manager.lib.handlers.globus_monitor import \
+            GlobusTaskBatcher
+
+        class FakeMonitor:
+            def __init__(self):
+                self.watched = {}
+
+            def watch(self, user, taskId, listener):
+                self.watched[taskId] = listener
+
+        class FakeHandler:
+            def __init__(self, user):
+                self.user = user
+                self.statuses = []
+
+            def taskUpdated(self, task):
+                self.statuses.append(task['status'])
+
+        submitted = []
+
+        def submit(handlers):
+            submitted.append(handlers)
+            return 'task%s' % len(submitted)
+
+        GlobusTaskBatcher.COALESCE_WINDOW = 0.2
+        monitor = FakeMonitor()
+        batcher = GlobusTaskBatcher(monitor, submit)
+        try:
+            handlers = [FakeHandler(self.user) for i in range(4)]
+            for handler in handlers[:3]:
+                batcher.add(('endpoint1', self.user['_id']), handler)
+            batcher.add(('endpoint2', self.user['_id']), handlers[3])
+            time.sleep(0.6)
+            # one task per source endpoint
+            self.assertEqual(sorted(len(batch) for batch in submitted), [1, 3])
+            for listener in monitor.watched.values():
+                listener.taskUpdated({'status': 'SUCCEEDED'})
+            self.assertEqual([handler.statuses for handler in handlers], [['SUCCEEDED']] * 4)
+        finally:
+            GlobusTaskBatcher.COALESCE_WINDOW = 2
+
+    def test20HttpZipMembers(self):
+        import io
+        import zipfile
+
+        self.testServer = Server()
+        self.testServer.start()
+        try:
+            members = {}
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, 'w') as zf:
+                for i in range(5):
+                    members['dir/member%s' % i] = b''.join(content(i, 10000 * (i + 1)))
+                    zf.writestr('dir/member%s' % i, members['dir/member%s' % i],
+                                compress_type=zipfile.ZIP_DEFLATED)
+            self.testServer.addFile('/archive.zip', buf.getvalue())
+
+            items = []
+            for name, data in sorted(members.items()):
+                resp = self.request(path='/file', method='POST', user=self.user, params={
+                    'parentType': 'folder',
+                    'parentId': self.testFolder['_id'],
+                    'name': name.replace('/', '_'),
+                    'linkUrl': self.testServer.getUrl() + '/archive.zip?path=' + name,
+                    'size': len(data)
+                })
+                self.assertStatusOk(resp)
+                items.append(self.model('item').load(resp.json['itemId'], user=self.user))
+            dataSet = self.makeDataSet(items)
+            session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                             dataSet=dataSet)
+            for item in items:
+                self.model('lock', 'wt_data_manager').acquireLock(self.user, session['_id'],
+                                                                  item['_id'])
+            for item, name in zip(items, sorted(members)):
+                psPath = self.waitForFile(self.reloadItem(item))
+                with open(psPath, 'rb') as f:
+                    self.assertEqual(f.read(), members[name])
+            # the central directory was only read once
+            stats = self.apiroot.dm.cacheManager.transferManager.zipDirectoryCache.getStats()
+            self.assertEqual(stats['misses'], 1)
+
+            self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+        finally:
+            self.testServer.stop()
+
+    def test21ProgressWriter(self):
+        from girder.plugins.wt_data_manager.lib.progress_writer import ProgressWriter
+        from girder.plugins.wt_data_manager.constants import TransferStatus
+
+        transferModel = self.model('transfer', 'wt_data_manager')
+        session = self.model('session', 'wt_data_manager').createSession(
+            self.user, dataSet=self.makeDataSet(self.gfiles))
+        transfers = [transferModel.createTransfer(self.user, item['_id'], session['_id'])
+                     for item in self.gfiles[:2]]
+        writer = ProgressWriter(self.model('setting'))
+        for i, transfer in enumerate(transfers):
+            writer.update(transfer['_id'], MB, 1000)
+            writer.update(transfer['_id'], MB, 2000 * (i + 1))
+        writer.flush()
+        for i, transfer in enumerate(transfers):
+            transfer = transferModel.load(transfer['_id'], force=True)
+            self.assertEqual(transfer['status'], TransferStatus.TRANSFERRING)
+            self.assertEqual(transfer['transferred'], 2000 * (i + 1))
+
+        # late progress does not overwrite a final state
+        transferModel.setStatus(transfers[0]['_id'], TransferStatus.DONE, size=MB,
+                                transferred=MB)
+        writer.update(transfers[0]['_id'], MB, 3000)
+        writer.flush()
+        transfer = transferModel.load(transfers[0]['_id'], force=True)
+        self.assertEqual(transfer['status'], TransferStatus.DONE)
+        self.assertEqual(transfer['transferred'], MB)
+
+        self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+
+    def test22BandwidthLimiter(self):
+        from girder.plugins.wt_data_manager.lib.bandwidth import BandwidthLimiter
+        import threading
+
+        # two users share the global limit, so each gets half of it
+        limiter = BandwidthLimiter({'dm.bandwidth_limit': MB, 'dm.user_bandwidth_limit': 0})
+        elapsed = {}
+
+        def transfer(userId):
+            start = time.time()
+            for i in range(16):
+                limiter.throttle(userId, MB // 32)
+            elapsed[userId] = time.time() - start
+
+        threads = [threading.Thread(target=transfer, args=(userId,)) for userId in 'ab']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for userId in 'ab':
+            self.assertGreater(elapsed[userId], 0.8)
+            self.assertLess(elapsed[userId], 2)
+
+    def test23SharedSourceTransfers(self):
+        self.testServer = Server()
+        self.testServer.start()
+        try:
+            # two items pointing to the same (slow) URL, spelled differently
+            port = self.testServer.server.server_port
+            digest = hashlib.sha256(b''.join(content(0, MB))).hexdigest()
+            items = []
+            # the second transfer uses the digest of the first, whatever the case of the
+            # algorithm name
+            for i, (host, alg) in enumerate([('localhost', 'sha256'), ('LOCALHOST', 'SHA256')]):
+                resp = self.request(path='/file', method='POST', user=self.user, params={
+                    'parentType': 'folder',
+                    'parentId': self.testFolder['_id'],
+                    'name': 'shared%s' % i,
+                    'linkUrl': 'http://%s:%s/1M?delay=1' % (host, port),
+                    'size': MB
+                })
+                self.assertStatusOk(resp)
+                item = self.model('item').load(resp.json['itemId'], user=self.user)
+                items.append(self.model('item').setMetadata(item, {'checksum': {alg: digest}}))
+            dataSet = self.makeDataSet(items)
+            session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                             dataSet=dataSet)
+            for item in items:
+                self.model('lock', 'wt_data_manager').acquireLock(self.user, session['_id'],
+                                                                  item['_id'])
+            for item in items:
+                psPath = self.waitForFile(self.reloadItem(item))
+                with open(psPath, 'rb') as f:
+                    self.assertEqual(f.read(), b''.join(content(0, MB)))
+            self.assertEqual([self.reloadItem(item)['dm']['checksum'] for item in items],
+                             [{'sha256': digest}, {'SHA256': digest}])
+            # only one of them was downloaded
+            self.assertEqual(len([r for r in self.testServer.getRequests() if r[0] == 'GET']),
+                             1)
+
+            self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+        finally:
+            self.testServer.stop()
+
+    def test24ContentAddressedStorage(self):
+        self.model('setting').set('dm.content_addressed_storage', True)
+        self.testServer = Server()
+        self.testServer.start()
+        gc = self.apiroot.dm.getFileGC()
+        gc.pause()
+        try:
+            # two items with the same contents at different URLs
+            port = self.testServer.server.server_port
+            items = []
+            for i in range(2):
+                resp = self.request(path='/file', method='POST', user=self.user, params={
+                    'parentType': 'folder',
+                    'parentId': self.testFolder['_id'],
+                    'name': 'blob%s' % i,
+                    'linkUrl': 'http://localhost:%s/1M?copy=%s' % (port, i),
+                    'size': MB
+                })
+                self.assertStatusOk(resp)
+                items.append(self.model('item').load(resp.json['itemId'], user=self.user))
+            dataSet = self.makeDataSet(items)
+            session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                             dataSet=dataSet)
+            for item in items:
+                self.model('lock', 'wt_data_manager').acquireLock(self.user, session['_id'],
+                                                                  item['_id'])
+            paths = [self.waitForFile(self.reloadItem(item)) for item in items]
+            self.assertEqual(paths[0], paths[1])
+            with open(paths[0], 'rb') as f:
+                data = f.read()
+            self.assertEqual(data, b''.join(content(0, MB)))
+
+            blobId = 'sha256:%s' % hashlib.sha256(data).hexdigest()
+            blobModel = self.model('blob', 'wt_data_manager')
+            self.assertEqual(blobModel.load(blobId, force=True)['refCount'], 2)
+            for item in items:
+                self.assertFalse(os.path.exists(gc.pathMapper.getPSPath(item['_id'])))
+            lockModel = self.model('lock', 'wt_data_manager')
+            for lock in list(lockModel.listLocks(self.user, session['_id'])):
+                lockModel.releaseLock(self.user, lock)
+            self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+
+            # the blob is only deleted with the last item that uses it
+            self.assertTrue(gc.deleteFile(items[0]['_id']))
+            self.assertTrue(os.path.exists(paths[0]))
+            self.assertEqual(blobModel.load(blobId, force=True)['refCount'], 1)
+            self.assertTrue(gc.deleteFile(items[1]['_id']))
+            self.assertFalse(os.path.exists(paths[0]))
+            self.assertIsNone(blobModel.load(blobId, force=True))
+        finally:
+            gc.resume()
+            self.testServer.stop()
+            self.model('setting').set('dm.content_addressed_storage', False)
+
+    def test25AsyncTransferEngine(self):
+        from girder.plugins.wt_data_manager.lib import async_engine
+        if not async_engine.isAvailable():
+            self.skipTest('aiohttp is not installed')
+        import aiohttp
+
+        def responseError(status):
+            return aiohttp.ClientResponseError(None, (), status=status)
+
+        self.assertTrue(async_engine.isTemporaryError(responseError(503)))
+        self.assertTrue(async_engine.isTemporaryError(responseError(429)))
+        self.assertFalse(async_engine.isTemporaryError(responseError(404)))
+        self.assertTrue(async_engine.isTemporaryError(aiohttp.ServerDisconnectedError()))
+        self.assertFalse(async_engine.isTemporaryError(PermissionError('Permission denied')))
+
+        transferManager = self.apiroot.dm.cacheManager.transferManager
+        threadedScheduler = transferManager.scheduler
+        transferManager.scheduler = async_engine.AsyncTransferScheduler(
+            transferManager.settings, transferManager)
+        self.testServer = Server()
+        self.testServer.start()
+        try:
+            # more slow transfers than there are worker threads
+            self.model('setting').set('dm.transfer_worker_count', 2)
+            port = self.testServer.server.server_port
+            items = []
+            for i in range(8):
+                resp = self.request(path='/file', method='POST', user=self.user, params={
+                    'parentType': 'folder',
+                    'parentId': self.testFolder['_id'],
+                    'name': 'async%s' % i,
+                    'linkUrl': 'http://localhost:%s/100K?delay=1&i=%s' % (port, i),
+                    'size': 100 * 1024
+                })
+                self.assertStatusOk(resp)
+                items.append(self.model('item').load(resp.json['itemId'], user=self.user))
+            dataSet = self.makeDataSet(items)
+            session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                             dataSet=dataSet)
+            start = time.time()
+            for item in items:
+                self.model('lock', 'wt_data_manager').acquireLock(self.user, session['_id'],
+                                                                  item['_id'])
+            for item in items:
+                psPath = self.waitForFile(self.reloadItem(item))
+                with open(psPath, 'rb') as f:
+                    self.assertEqual(f.read(), b''.join(content(0, 100 * 1024)))
+            # the transfers ran concurrently, even though there are only two threads
+            self.assertLess(time.time() - start, 4)
+            self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+        finally:
+            self.model('setting').set('dm.transfer_worker_count', 16)
+            transferManager.scheduler = threadedScheduler
+            self.testServer.stop()
+
+    def test26TransferProcessPool(self):
+        from girder.plugins.wt_data_manager.lib.process_pool import TransferProcessPool
+
+        transferManager = self.apiroot.dm.cacheManager.transferManager
+        transferManager.processPool = TransferProcessPool(1)
+        self.testServer = Server()
+        self.testServer.start()
+        try:
+            self.createHttpFile()
+            data = b''.join(content(0, MB))
+            digest = hashlib.sha256(data).hexdigest()
+            self.model('item').setMetadata(self.httpItem, {'checksum': {'sha256': digest}})
+            dataSet = self.makeDataSet([self.httpItem])
+            session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                             dataSet=dataSet)
+            lock = self.model('lock', 'wt_data_manager').acquireLock(self.user, session['_id'],
+                                                                     self.httpItem['_id'])
+            psPath = self.waitForFile(self.reloadItem(self.httpItem))
+            with open(psPath, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            # the checksum was computed in the transfer process
+            self.assertEqual(self.reloadItem(self.httpItem)['dm']['checksum'],
+                             {'sha256': digest})
+
+            self.model('lock', 'wt_data_manager').releaseLock(self.user, lock)
+            self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+        finally:
+            transferManager.processPool = None
+            self.testServer.stop()
+
+    def test27Metrics(self):
+        dataSet = self.makeDataSet(self.gfiles)
+        session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                         dataSet=dataSet)
+        lockModel = self.model('lock', 'wt_data_manager')
+        lock = lockModel.acquireLock(self.user, session['_id'], self.gfiles[2]['_id'])
+        self.waitForFile(self.reloadItem(self.gfiles[2]))
+        # the item is cached now
+        lock2 = lockModel.acquireLock(self.user, session['_id'], self.gfiles[2]['_id'])
+        # locks acquired in batches are counted individually
+        batch = lockModel.acquireLocks(self.user, session['_id'], [self.gfiles[2]['_id']] * 2)
+
+        resp = self.request('/dm/metrics', method='GET', user=self.user, isJson=False)
+        self.assertStatus(resp, 403)
+        resp = self.request('/dm/metrics', method='GET', user=self.admin, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain'))
+        metrics = {}
+        for line in self.getBody(resp).splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                metrics[name] = float(value)
+        self.assertGreaterEqual(metrics['dm_lock_acquisitions_total{result="miss"}'], 1)
+        self.assertGreaterEqual(metrics['dm_lock_acquisitions_total{result="hit"}'], 3)
+        self.assertGreaterEqual(metrics['dm_lock_acquire_seconds_count'], 4)
+        self.assertEqual(metrics['dm_lock_acquire_seconds_count'],
+                         metrics['dm_lock_acquire_seconds_bucket{le="+Inf"}'])
+        self.assertGreaterEqual(metrics['dm_transfer_bytes_total{handler="Local"}'], MB)
+        self.assertGreaterEqual(metrics['dm_transfers_total{handler="Local",outcome="done"}'], 1)
+        self.assertIn('dm_transfer_queue_wait_seconds_count{scheme="local"}', metrics)
+        self.assertIn('dm_transfers_queued', metrics)
+
+        lockModel.releaseLock(self.user, lock)
+        lockModel.releaseLock(self.user, lock2)
+        lockModel.releaseLocks(self.user, batch)
+        self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+
+    def test28BatchLocks(self):
+        dataSet = self.makeDataSet(self.gfiles)
+        session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                         dataSet=dataSet)
+        itemIds = [str(item['_id']) for item in self.gfiles]
+
+        # one of the items is not in the session
+        resp = self.request('/dm/lock/batch', method='POST', user=self.user,
+                            type='application/json', body=json.dumps({
+                                'sessionId': str(session['_id']),
+                                'itemIds': itemIds + [str(self.gfiles2[0]['_id'])]
+                            }))
+        self.assertStatus(resp, 404)
+        self.assertEqual(len(list(self.model('lock', 'wt_data_manager').listLocks(
+            self.user, session['_id']))), 0)
+
+        # the first item is locked twice
+        resp = self.request('/dm/lock/batch', method='POST', user=self.user,
+                            type='application/json', body=json.dumps({
+                                'sessionId': str(session['_id']),
+                                'itemIds': itemIds + itemIds[:1],
+                                'priority': 'bulk'
+                            }))
+        self.assertStatusOk(resp)
+        locks = resp.json
+        self.assertEqual([lock['itemId'] for lock in locks], itemIds + itemIds[:1])
+        for item in self.gfiles:
+            self.waitForFile(self.reloadItem(item))
+        self.assertEqual(self.reloadItem(self.gfiles[0])['dm']['lockCount'], 2)
+        self.assertEqual(self.reloadItem(self.gfiles[1])['dm']['lockCount'], 1)
+        transfers = list(self.model('transfer', 'wt_data_manager').list(
+            user=self.user, sessionId=session['_id'], discardOld=False))
+        self.assertEqual(len(transfers), len(self.gfiles))
+
+        lockIds = [lock['_id'] for lock in locks]
+        resp = self.request('/dm/lock/batch', method='DELETE', user=self.user2,
+                            type='application/json', body=json.dumps({'lockIds': lockIds}))
+        self.assertStatus(resp, 403)
+
+        resp = self.request('/dm/lock/batch', method='DELETE', user=self.user,
+                            type='application/json', body=json.dumps({'lockIds': lockIds}))
+        self.assertStatusOk(resp)
+        for item in self.gfiles:
+            self.assertEqual(self.reloadItem(item)['dm']['lockCount'], 0)
+        self.assertEqual(len(list(self.model('lock', 'wt_data_manager').listLocks(
+            self.user, session['_id']))), 0)
+
+        # the items are cached now
+        resp = self.request('/dm/lock/batch', method='POST', user=self.user,
+                            type='application/json', body=json.dumps({
+                                'sessionId': str(session['_id']),
+                                'itemIds': itemIds
+                            }))
+        self.assertStatusOk(resp)
+        self.model('lock', 'wt_data_manager').releaseLocks(
+            self.user, [{'_id': ObjectId(lock['_id']), 'itemId': ObjectId(lock['itemId'])}
+                        for lock in resp.json])
+        self.assertEqual(len(list(self.model('transfer', 'wt_data_manager').list(
+            user=self.user, sessionId=session['_id'], discardOld=False))), len(self.gfiles))
+        self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+
+    def test29DeleteNotification(self):
+        import threading
+        from girder.plugins.wt_data_manager.models.lock import Lock
+
+        dataSet = self.makeDataSet(self.gfiles)
+        session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                         dataSet=dataSet)
+        lockModel = self.model('lock', 'wt_data_manager')
+        item = self.gfiles[3]
+        lockModel.releaseLock(self.user, lockModel.acquireLock(self.user, session['_id'],
+                                                               item['_id']))
+        self.waitForFile(self.reloadItem(item))
+        self.assertTrue(lockModel.tryLockForDeletion(item['_id']))
+
+        pollIntervals = (Lock.DELETE_POLL_INTERVAL, Lock.DELETE_POLL_MAX_INTERVAL)
+        Lock.DELETE_POLL_INTERVAL = Lock.DELETE_POLL_MAX_INTERVAL = 30
+        locks = []
+        thread = threading.Thread(target=lambda: locks.append(
+            lockModel.acquireLock(self.user, session['_id'], item['_id'])))
+        try:
+            thread.start()
+            time.sleep(0.5)
+            # waiting for the delete
+            self.assertEqual(Lock.deleteNotifier.getWaiterCount(str(item['_id'])), 1)
+            self.assertEqual(locks, [])
+            start = time.time()
+            lockModel.unlockForDeletion(item['_id'])
+            thread.join(5)
+            # woken right away rather than after the poll interval
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual(len(locks), 1)
+            self.assertEqual(self.reloadItem(item)['dm']['lockCount'], 1)
+        finally:
+            Lock.DELETE_POLL_INTERVAL, Lock.DELETE_POLL_MAX_INTERVAL = pollIntervals
+            thread.join()
+        lockModel.releaseLock(self.user, locks[0])
+        self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+
+        # without notifications, polling starts fast and backs off
+        checks = []
+        Lock.deleteNotifier.waitFor('none', lambda: checks.append(time.time()), timeout=0.6,
+                                    interval=0.01, maxInterval=0.16)
+        self.assertGreaterEqual(len(checks), 5)
+        self.assertLess(len(checks), 15)
+
+    def test30DeleteSessionReleasesLocks(self):
+        dataSet = self.makeDataSet(self.gfiles)
+        session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                         dataSet=dataSet)
+        lockModel = self.model('lock', 'wt_data_manager')
+        # through the REST API, which stores the session id as a string, and in bulk
+        resp = self.request('/dm/lock', method='POST', user=self.user, params={
+            'sessionId': str(session['_id']),
+            'itemId': str(self.gfiles[0]['_id'])
+        })
+        self.assertStatusOk(resp)
+        lockModel.acquireLocks(self.user, session['_id'],
+                               [item['_id'] for item in self.gfiles])
+        for item in self.gfiles:
+            self.waitForFile(self.reloadItem(item))
+        self.assertEqual(self.reloadItem(self.gfiles[0])['dm']['lockCount'], 2)
+
+        unlocked = []
+        events.bind('dm.itemsUnlocked', 'test30', lambda event: unlocked.extend(event.info))
+        try:
+            self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+        finally:
+            events.unbind('dm.itemsUnlocked', 'test30')
+        self.assertEqual(lockModel.find({'itemId': {'$in': [item['_id'] for item in
+                                                            self.gfiles]}}).count(), 0)
+        for item in self.gfiles:
+            self.assertEqual(self.reloadItem(item)['dm']['lockCount'], 0)
+        self.assertEqual(sorted(unlocked), sorted(item['_id'] for item in self.gfiles))
+
+    def test31LockLeases(self):
+        dataSet = self.makeDataSet(self.gfiles)
+        session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                         dataSet=dataSet)
+        lockModel = self.model('lock', 'wt_data_manager')
+        item = self.gfiles[0]
+        self.model('setting').set('dm.lock_lease_duration', 2)
+        try:
+            lock = lockModel.acquireLock(self.user, session['_id'], item['_id'])
+            self.assertIn('expires', lock)
+            self.waitForFile(self.reloadItem(item))
+
+            resp = self.request('/dm/session/%s/heartbeat' % session['_id'], method='PUT',
+                                user=self.user)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json['renewed'], 1)
+            self.assertGreaterEqual(lockModel.load(lock['_id'], force=True)['expires'],
+                                    lock['expires'])
+
+            # no more heartbeats; unless the reaper got to it first, the lock is released here
+            time.sleep(2.5)
+            self.assertIn(lockModel.releaseExpiredLocks(), [0, 1])
+            self.assertIsNone(lockModel.load(lock['_id'], force=True))
+            self.assertEqual(self.reloadItem(item)['dm']['lockCount'], 0)
+
+            # locks claimed by a reaper that died before releasing them are claimed again,
+            # but only once the claim is stale
+            lock = lockModel.acquireLock(self.user, session['_id'], item['_id'])
+            claimed = datetime.datetime.utcnow()
+            lockModel.collection.update_one({'_id': lock['_id']}, {'$set': {
+                'expires': claimed - datetime.timedelta(seconds=1),
+                'reaper': ObjectId(), 'reaped': claimed}})
+            self.assertEqual(lockModel.releaseExpiredLocks(), 0)
+            self.assertIsNotNone(lockModel.load(lock['_id'], force=True))
+            stale = datetime.timedelta(seconds=lockModel.REAPER_CLAIM_TIMEOUT + 1)
+            lockModel.collection.update_one({'_id': lock['_id']},
+                                            {'$set': {'reaped': claimed - stale}})
+            self.assertEqual(lockModel.releaseExpiredLocks(), 1)
+            self.assertIsNone(lockModel.load(lock['_id'], force=True))
+            self.assertEqual(self.reloadItem(item)['dm']['lockCount'], 0)
+        finally:
+            self.model('setting').set('dm.lock_lease_duration', 0)
+        self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+
+    def test32WaitForItem(self):
+        from girder.plugins.wt_data_manager.models.lock import Lock as LockModel
+
+        # slow enough for the waits to start before the transfer is done
+        self.testServer = Server(delay=1)
+        self.testServer.start()
+        try:
+            self.createHttpFile()
+            dataSet = self.makeDataSet([self.httpItem])
+            session = self.model('session', 'wt_data_manager').createSession(self.user,
+                                                                             dataSet=dataSet)
+            lockModel = self.model('lock', 'wt_data_manager')
+            lock = lockModel.acquireLock(self.user, session['_id'], self.httpItem['_id'])
+
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(
+                lockModel.waitForItem(lock, 30))) for i in range(3)]
+            for thread in threads:
+                thread.start()
+            key = str(self.httpItem['_id'])
+            deadline = time.time() + 10
+            while LockModel.transferNotifier.getWaiterCount(key) < 3:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.01)
+
+            resp = self.request('/dm/lock/%s/wait' % lock['_id'], user=self.user,
+                                params={'timeout': 30})
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json['state'], 'cached')
+            psPath = resp.json['psPath']
+            with open(psPath, 'rb') as f:
+                self.assertEqual(f.read(), b''.join(content(0, MB)))
+            for thread in threads:
+                thread.join(10)
+            self.assertEqual([(r['state'], r['psPath']) for r in results],
+                             [('cached', psPath)] * 3)
+            self.assertEqual(LockModel.transferNotifier.getWaiterCount(key), 0)
+
+            resp = self.request('/dm/lock/%s/wait' % lock['_id'], user=self.user,
+                                params={'timeout': -1})
+            self.assertStatus(resp, 400)
+            # rather than waiting for less than requested
+            resp = self.request('/dm/lock/%s/wait' % lock['_id'], user=self.user,
+                                params={'timeout': 60})
+            self.assertStatus(resp, 400)
+
+            lockModel.releaseLock(self.user, lock)
+            self.model('session', 'wt_data_manager').deleteSession(self.user, session)
+        finally:
+            self.testServer.stop()
+
+    def test33TransferErrorClassification(self):
+        from girder.plugins.wt_data_manager.lib.handlers.http import isTemporaryError
+        from girder.plugins.wt_data_manager.lib.tm_utils import NetworkError
+        import errno
+        import requests
+
+        def httpError(status):
+            resp = requests.Response()
+            resp.status_code = status
+            return requests.HTTPError(response=resp)
+
+        for status in (500, 502, 503, 408, 429):
+            self.assertTrue(isTemporaryError(httpError(status)), status)
+        for status in (400, 401, 403, 404, 410):
+            self.assertFalse(isTemporaryError(httpError(status)), status)
+        self.assertTrue(isTemporaryError(requests.ConnectionError()))
+        self.assertTrue(isTemporaryError(requests.Timeout()))
+        self.assertTrue(isTemporaryError(NetworkError('Connection closed')))
+        self.assertFalse(isTemporaryError(OSError(errno.ENOSPC, 'No space left on device')))
+        self.assertFalse(isTemporaryError(PermissionError(errno.EACCES, 'Permission denied')))
+
+        transferManager = self.apiroot.dm.cacheManager.transferManager
+        item = self.gfiles[0]
+        interrupted = {
+            'dm.transferInProgress': True,
+            'dm.transfer.userId': self.user['_id'],
+            'dm.transfer.sessionId': ObjectId()
+        }
+        # not restarted, since nobody holds a lock on the item any more
+        interrupted['dm.lockCount'] = 0
+        self.model('item').update({'_id': item['_id']}, {'$set': interrupted})
+        psPath = transferManager.pathMapper.getPSPath(item['_id'])
+        os.makedirs(os.path.dirname(psPath), exist_ok=True)
+        for path in [psPath, psPath + '.resume']:
+            with open(path, 'wb') as f:
+                f.write(b'partial')
+        transferManager.restartInterruptedTransfers()
+        item = self.reloadItem(item)
+        self.assertFalse(item['dm']['transferInProgress'])
+        self.assertFalse(item['dm'].get('transferError', False))
+        # the partial data is not kept around
+        self.assertFalse(os.path.exists(psPath))
+        self.assertFalse(os.path.exists(psPath + '.resume'))
+
+        # not restarted, since it failed too many times
+        interrupted['dm.lockCount'] = 1
+        interrupted['dm.errorCount'] = transferManager.MAX_RESTART_ERRORS
+        self.model('item').update({'_id': item['_id']}, {'$set': interrupted})
+        transferManager.restartInterruptedTransfers()
+        item = self.reloadItem(item)
+        self.assertFalse(item['dm']['transferInProgress'])
+        self.assertTrue(item['dm']['transferError'])
+        self.model('item').update({'_id': item['_id']}, {'$set': {'dm.lockCount': 0}})
+
+    def test34SharedSourcePriority(self):
+        from girder.plugins.wt_data_manager.lib.transfer_manager import \
+            TransferManager, TransferScheduler
+        from girder.plugins.wt_data_manager.constants import TransferPriority
+
+        class QueueOnlyScheduler(TransferScheduler):
+            def _ensureWorkers(self, count):
+                pass
+
+        class Handler:
+            def __init__(self, itemId):
+                self.itemId = itemId
+
+            def getSourceKey(self):
+                return 'http://example.com/shared'
+
+            def getSourceUrl(self):
+                return 'http://example.com/shared'
+
+            def getPhysicalPath(self):
+                return '/nonexistent'
+
+            def getItemId(self):
+                return self.itemId
+
+        cacheManager = self.apiroot.dm.cacheManager
+        transferManager = TransferManager(cacheManager.transferManager.settings,
+                                          cacheManager.pathMapper, QueueOnlyScheduler)
+        leaderId = ObjectId()
+        followerId = ObjectId()
+        transferManager._scheduleTransfer(leaderId, ObjectId(), Handler(leaderId),
+                                          TransferPriority.BULK)
+        transferManager._scheduleTransfer(followerId, ObjectId(), Handler(followerId),
+                                          TransferPriority.NORMAL)
+        # the follower only waits for the leader, which is promoted to its priority
+        self.assertEqual(len(transferManager.scheduler.queue), 1)
+        entry = transferManager.scheduler.queue[0]
+        self.assertEqual(entry.itemId, leaderId)
+        self.assertEqual(entry.priority, TransferPriority.NORMAL)
+        # and likewise when the priority of the follower is raised later
+        transferManager.raisePriority(followerId, TransferPriority.INTERACTIVE)
+        self.assertEqual(entry.priority, TransferPriority.INTERACTIVE)
+
+    def test35AdaptiveBuffer(self):
+        from girder.plugins.wt_data_manager.lib.handlers.common import AdaptiveBuffer
+        import io
+
+        class ShortReader(io.RawIOBase):
+            # returns at most 1000 bytes per read, like a slow socket
+            def __init__(self, data):
+                self.data = io.BytesIO(data)
+
+            def readable(self):
+                return True
+
+            def readinto(self, b):
+                return self.data.readinto(memoryview(b)[:1000])
+
+        buffer = AdaptiveBuffer()
+        self.assertIsNone(buffer.view)
+        self.assertEqual(buffer.size, AdaptiveBuffer.MIN_SIZE)
+        # slow or partial reads do not grow the buffer
+        buffer.observe(buffer.size, buffer.size, AdaptiveBuffer.FAST_READ_TIME * 2)
+        buffer.observe(buffer.size, buffer.size // 2, 0)
+        self.assertEqual(buffer.size, AdaptiveBuffer.MIN_SIZE)
+        # fast, full reads double it, up to the maximum
+        buffer.observe(buffer.size, buffer.size, 0)
+        self.assertEqual(buffer.size, 2 * AdaptiveBuffer.MIN_SIZE)
+        for i in range(20):
+            buffer.observe(buffer.size, buffer.size, 0)
+        self.assertEqual(buffer.size, AdaptiveBuffer.MAX_SIZE)
+
+        data = os.urandom(3000)
+        buffer = AdaptiveBuffer()
+        inf = ShortReader(data)
+        received = []
+        while True:
+            view = buffer.readFrom(inf)
+            if len(view) == 0:
+                break
+            self.assertLessEqual(len(view), 1000)
+            received.append(bytes(view))
+        self.assertEqual(b''.join(received), data)
+        self.assertEqual(buffer.size, AdaptiveBuffer.MIN_SIZE)
+        # at the end of the stream, reads keep returning nothing
+        self.assertEqual(len(buffer.readFrom(inf)), 0)
+
+        inf = io.BytesIO(data)
+        self.assertEqual(bytes(buffer.readFrom(inf, limit=100)), data[:100])
+        self.assertEqual(bytes(buffer.readFrom(inf)), data[100:])
+        self.assertEqual(len(buffer.readFrom(inf)), 0)
+
+    def test36SharedSourceProgressiveRead(self):
+        from girder.plugins.wt_data_manager.lib.transfer_manager import \
+            TransferManager, TransferScheduler
+        from girder.plugins.wt_data_manager.constants import TransferPriority
+
+        class QueueOnlyScheduler(TransferScheduler):
+            def _ensureWorkers(self, count):
+                pass
+
+        class Handler:
+            def __init__(self, itemId, psPath):
+                self.itemId = itemId
+                self.psPath = psPath
+
+            def getSourceKey(self):
+                return 'http://example.com/shared'
+
+            def getSourceUrl(self):
+                return 'http://example.com/shared'
+
+            def getPhysicalPath(self):
+                return self.psPath
+
+            def getItemId(self):
+                return self.itemId
+
+        tmpDir = tempfile.mkdtemp()
+        try:
+            cacheManager = self.apiroot.dm.cacheManager
+            transferManager = TransferManager(cacheManager.transferManager.settings,
+                                              cacheManager.pathMapper, QueueOnlyScheduler)
+            leaderPath = os.path.join(tmpDir, 'leader')
+            leader = Handler(ObjectId(), leaderPath)
+            followerId = ObjectId()
+            transferManager._scheduleTransfer(leader.itemId, ObjectId(), leader,
+                                              TransferPriority.NORMAL)
+            with open(leaderPath, 'wb') as f:
+                f.write(b'x' * 1000)
+            leader.watermark.advance(1000)
+            transferManager._scheduleTransfer(followerId, ObjectId(),
+                                              Handler(followerId, os.path.join(tmpDir, 'f')),
+                                              TransferPriority.NORMAL)
+
+            # readers of the follower item read the file of the leader as it progresses
+            watermark = transferManager.getWatermark(followerId)
+            self.assertEqual(watermark.psPath, leaderPath)
+            self.assertEqual(watermark.waitFor(1, timeout=1), 1000)
+            with open(leaderPath, 'ab') as f:
+                f.write(b'y' * 1000)
+            leader.watermark.advance(2000)
+            self.assertEqual(watermark.waitFor(1001, timeout=1), 2000)
+            with open(watermark.psPath, 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 1000 + b'y' * 1000)
+
+            # the follower is only finished once its own transfer completes
+            leader.watermark.finish()
+            self.assertEqual(watermark.waitFor(2000, timeout=1), 2000)
+            self.assertFalse(watermark.finished)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test37TransferProcessIsolation(self):
+        from girder.plugins.wt_data_manager.lib.process_pool import \
+            TransferProcessPool, _getPluginPaths
+
+        # set up a transfer process as the pool does, but with models that cannot be used
+        script = '\n'.join([
+            'import runpy',
+            'from girder.utility.model_importer import ModelImporter',
+            'def model(*args, **kwargs):',
+            '    raise AssertionError("transfer process used model %s" % (args,))',
+            'ModelImporter.model = staticmethod(model)',
+            'runpy.run_path(%r)["registerPlugins"](%r)' % (TransferProcessPool.MAIN_PATH,
+                                                           _getPluginPaths()),
+            'from girder.plugins.wt_data_manager.lib import process_pool',
+            'from girder.plugins.wt_data_manager.lib.handlers import http, local, zip',
+            'process_pool._ProcessTransferManager(None)',
+            'import girder.models',
+            'assert not girder.models._dbClients, "transfer process connected to the database"'
+        ])
+        proc = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT)
+        self.assertEqual(proc.returncode, 0, proc.stdout.decode())
@@ -10,8 +10,10 @@ from .resources.fs import FS
 from girder.models.setting import Setting
 from girder.utility import setting_utilities
 from girder.constants import SettingDefault, AccessType
-from .lib import transfer_manager, file_gc, cache_manager, path_mapper
-from girder import events
+from .lib import transfer_manager, async_engine, file_gc, cache_manager, path_mapper, notifier
+from .lib.lease_reaper import LeaseReaper
+from .models.lock import Lock as LockModel
+from girder import events, logger
 from girder.models.item import Item as ItemModel
 
 
@@ -21,6 +23,23 @@ from girder.models.item import Item as ItemModel
     PluginSettings.GC_RUN_INTERVAL,
     PluginSettings.GC_COLLECT_START_FRACTION,
     PluginSettings.GC_COLLECT_END_FRACTION,
+    PluginSettings.TRANSFER_WORKER_COUNT,
+    PluginSettings.TRANSFER_HOST_LIMIT,
+    PluginSettings.TRANSFER_SCHEME_LIMITS,
+    PluginSettings.TRANSFER_PRIORITY_AGING_INTERVAL,
+    PluginSettings.HTTP_POOL_SIZE,
+    PluginSettings.HTTP_POOL_IDLE_TIMEOUT,
+    PluginSettings.HTTP_RANGED_CONNECTIONS,
+    PluginSettings.HTTP_RANGED_MIN_SIZE,
+    PluginSettings.ZIP_CACHE_SIZE,
+    PluginSettings.TRANSFER_PROGRESS_INTERVAL,
+    PluginSettings.BANDWIDTH_LIMIT,
+    PluginSettings.USER_BANDWIDTH_LIMIT,
+    PluginSettings.CONTENT_ADDRESSED_STORAGE,
+    PluginSettings.TRANSFER_ENGINE,
+    PluginSettings.TRANSFER_PROCESS_COUNT,
+    PluginSettings.CHANGE_STREAMS,
+    PluginSettings.LOCK_LEASE_DURATION,
 })
 def validateOtherSettings(event):
     pass
@@ -38,6 +57,35 @@ def load(info):
     SettingDefault.defaults[PluginSettings.GC_COLLECT_START_FRACTION] = 0.5
     # stop collecting when below %50 usage
     SettingDefault.defaults[PluginSettings.GC_COLLECT_END_FRACTION] = 0.5
+    SettingDefault.defaults[PluginSettings.TRANSFER_WORKER_COUNT] = 16
+    # at most 4 simultaneous transfers from the same host
+    SettingDefault.defaults[PluginSettings.TRANSFER_HOST_LIMIT] = 4
+    SettingDefault.defaults[PluginSettings.TRANSFER_SCHEME_LIMITS] = {}
+    # queued transfers move up one priority class every minute
+    SettingDefault.defaults[PluginSettings.TRANSFER_PRIORITY_AGING_INTERVAL] = 60
+    # keep up to 8 connections per HTTP host and close them after 2 minutes of inactivity
+    SettingDefault.defaults[PluginSettings.HTTP_POOL_SIZE] = 8
+    SettingDefault.defaults[PluginSettings.HTTP_POOL_IDLE_TIMEOUT] = 2 * 60
+    # download files over 128MB using 4 parallel range requests
+    SettingDefault.defaults[PluginSettings.HTTP_RANGED_CONNECTIONS] = 4
+    SettingDefault.defaults[PluginSettings.HTTP_RANGED_MIN_SIZE] = 128 * MB
+    # keep the central directories of the 16 most recently used zip archives
+    SettingDefault.defaults[PluginSettings.ZIP_CACHE_SIZE] = 16
+    # write the progress of all transfers to the database once a second
+    SettingDefault.defaults[PluginSettings.TRANSFER_PROGRESS_INTERVAL] = 1
+    # no bandwidth limits
+    SettingDefault.defaults[PluginSettings.BANDWIDTH_LIMIT] = 0
+    SettingDefault.defaults[PluginSettings.USER_BANDWIDTH_LIMIT] = 0
+    # store each cached file under its own item id rather than by content
+    SettingDefault.defaults[PluginSettings.CONTENT_ADDRESSED_STORAGE] = False
+    # run each transfer on its own thread
+    SettingDefault.defaults[PluginSettings.TRANSFER_ENGINE] = 'threaded'
+    # run transfers in the server process
+    SettingDefault.defaults[PluginSettings.TRANSFER_PROCESS_COUNT] = 0
+    # only notice deletes done by other processes by polling
+    SettingDefault.defaults[PluginSettings.CHANGE_STREAMS] = False
+    # locks do not expire
+    SettingDefault.defaults[PluginSettings.LOCK_LEASE_DURATION] = 0
 
     settings = Setting()
     session = Session()
@@ -46,7 +94,15 @@ def load(info):
     fs = FS()
 
     pathMapper = path_mapper.PathMapper(settings)
-    transferManager = transfer_manager.SimpleTransferManager(settings, pathMapper)
+    schedulerClass = transfer_manager.TransferScheduler
+    if settings.get(PluginSettings.TRANSFER_ENGINE) == 'asyncio':
+        if async_engine.isAvailable():
+            schedulerClass = async_engine.AsyncTransferScheduler
+        else:
+            logger.warning('The asyncio transfer engine requires aiohttp; '
+                           'using the threaded engine instead')
+    transferManager = transfer_manager.SimpleTransferManager(settings, pathMapper,
+                                                             schedulerClass)
 
     # a GC that does nothing
     # fileGC = file_gc.DummyFileGC(settings, pathMapper)
@@ -60,6 +116,14 @@ def load(info):
         )
     )
     cacheManager = cache_manager.SimpleCacheManager(settings, transferManager, fileGC, pathMapper)
+    if settings.get(PluginSettings.CHANGE_STREAMS):
+        notifier.ChangeStreamListener(ItemModel().collection, LockModel.FIELD_DELETE_IN_PROGRESS,
+                                      LockModel.deleteNotifier).start()
+        # set when a transfer starts and cleared when it finishes or fails
+        notifier.ChangeStreamListener(ItemModel().collection,
+                                      LockModel.FIELD_TRANSFER_IN_PROGRESS,
+                                      LockModel.transferNotifier).start()
+    LeaseReaper(settings, LockModel()).start()
     dm = DM(cacheManager)
     info['apiRoot'].dm = dm
     info['apiRoot'].dm.route('GET', ('session',), session.listSessions)
@@ -67,12 +131,16 @@ def load(info):
     info['apiRoot'].dm.route('POST', ('session',), session.createSession)
     info['apiRoot'].dm.route('PUT', ('session', ':id',), session.modifySession)
     info['apiRoot'].dm.route('DELETE', ('session', ':id'), session.removeSession)
+    info['apiRoot'].dm.route('PUT', ('session', ':id', 'heartbeat'), session.heartbeat)
 
     info['apiRoot'].dm.route('POST', ('lock',), lock.acquireLock)
+    info['apiRoot'].dm.route('POST', ('lock', 'batch'), lock.acquireLocks)
+    info['apiRoot'].dm.route('DELETE', ('lock', 'batch'), lock.releaseLocks)
     info['apiRoot'].dm.route('DELETE', ('lock', ':id'), lock.releaseLock)
     info['apiRoot'].dm.route('GET', ('lock', ':id'), lock.getLock)
     info['apiRoot'].dm.route('GET', ('lock',), lock.listLocks)
     info['apiRoot'].dm.route('GET', ('lock', ':id', 'download'), lock.downloadItem)
+    info['apiRoot'].dm.route('GET', ('lock', ':id', 'wait'), lock.waitForItem)
 
     info['apiRoot'].dm.route('GET', ('session', ':id', 'object'), session.getObject)
     info['apiRoot'].dm.route('GET', ('session', ':id', 'lock',), lock.listLocksForSession)
@@ -88,17 +156,31 @@ def load(info):
     info['apiRoot'].dm.route('GET', ('fs', ':id', 'evict'), lock.evict)
 
     info['apiRoot'].dm.route('PUT', ('clearCache',), dm.clearCache)
+    info['apiRoot'].dm.route('GET', ('stats',), dm.getStats)
+    info['apiRoot'].dm.route('GET', ('metrics',), dm.getMetrics)
 
     def itemLocked(event):
         dict = event.info
-        cacheManager.itemLocked(dict['user'], dict['itemId'], dict['sessionId'])
+        cacheManager.itemLocked(dict['user'], dict['itemId'], dict['sessionId'],
+                                dict['priority'])
+
+    def transferRequested(event):
+        cacheManager.transferRequested(event.info['itemId'], event.info['priority'])
 
     def itemUnlocked(event):
         cacheManager.itemUnlocked(event.info)
 
+    def itemsUnlocked(event):
+        cacheManager.itemsUnlocked(event.info)
+
     def fileDownloaded(event):
         cacheManager.fileDownloaded(event.info)
 
+    def getWatermark(event):
+        watermark = transferManager.getWatermark(event.info['itemId'])
+        if watermark is not None:
+            event.addResponse(watermark)
+
     def sessionCreated(event):
         cacheManager.sessionCreated(event.info)
 
@@ -109,6 +191,9 @@ def load(info):
     events.bind('dm.sessionDeleted', 'sessionDeleted', sessionDeleted)
     # TODO: add session file changes
     events.bind('dm.itemLocked', 'itemLocked', itemLocked)
+    events.bind('dm.transferRequested', 'transferRequested', transferRequested)
     events.bind('dm.itemUnlocked', 'itemUnlocked', itemUnlocked)
+    events.bind('dm.itemsUnlocked', 'itemsUnlocked', itemsUnlocked)
     events.bind('dm.fileDownloaded', 'fileDownloaded', fileDownloaded)
+    events.bind('dm.getWatermark', 'getWatermark', getWatermark)
     ItemModel().exposeFields(level=AccessType.READ, fields={'dm'})
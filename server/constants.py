@@ -8,6 +8,23 @@ class PluginSettings:
     GC_RUN_INTERVAL = 'dm.gc_run_interval'
     GC_COLLECT_START_FRACTION = 'dm.gc_collect_start_fraction'
     GC_COLLECT_END_FRACTION = 'dm.gc_collect_end_fraction'
+    TRANSFER_WORKER_COUNT = 'dm.transfer_worker_count'
+    TRANSFER_HOST_LIMIT = 'dm.transfer_host_limit'
+    TRANSFER_SCHEME_LIMITS = 'dm.transfer_scheme_limits'
+    TRANSFER_PRIORITY_AGING_INTERVAL = 'dm.transfer_priority_aging_interval'
+    HTTP_POOL_SIZE = 'dm.http_pool_size'
+    HTTP_POOL_IDLE_TIMEOUT = 'dm.http_pool_idle_timeout'
+    HTTP_RANGED_CONNECTIONS = 'dm.http_ranged_connections'
+    HTTP_RANGED_MIN_SIZE = 'dm.http_ranged_min_size'
+    ZIP_CACHE_SIZE = 'dm.zip_cache_size'
+    TRANSFER_PROGRESS_INTERVAL = 'dm.transfer_progress_interval'
+    BANDWIDTH_LIMIT = 'dm.bandwidth_limit'
+    USER_BANDWIDTH_LIMIT = 'dm.user_bandwidth_limit'
+    CONTENT_ADDRESSED_STORAGE = 'dm.content_addressed_storage'
+    TRANSFER_ENGINE = 'dm.transfer_engine'
+    TRANSFER_PROCESS_COUNT = 'dm.transfer_process_count'
+    CHANGE_STREAMS = 'dm.change_streams'
+    LOCK_LEASE_DURATION = 'dm.lock_lease_duration'
 
 
 class TransferStatus:
@@ -17,3 +34,15 @@ class TransferStatus:
     DONE = 3
     FAILED = 4
     FAILED_TEMPORARILY = 5
+
+
+class TransferPriority:
+    INTERACTIVE = 0
+    NORMAL = 1
+    BULK = 2
+
+    NAMES = {
+        'interactive': INTERACTIVE,
+        'normal': NORMAL,
+        'bulk': BULK
+    }
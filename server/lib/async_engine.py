@@ -0,0 +1,173 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+import traceback
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .handlers.http import Http, acceptsRanges
+from .handlers.partial import ResumeRecord, getValidator
+from .tm_utils import TransferException, NetworkError, isTemporaryStatus
+from .transfer_manager import TransferScheduler
+
+
+def isAvailable():
+    return aiohttp is not None
+
+
+class AsyncTransferScheduler(TransferScheduler):
+    """
+    A scheduler that runs HTTP transfers as coroutines on a single asyncio event loop,
+    so that the number of transfers in flight is not limited by the number of threads.
+    Writes to disk, as well as database updates, are done by a small pool of IO_THREADS
+    threads, which the coroutines wait for without blocking the loop.
+
+    Transfers that cannot run on the loop (local copies, archive members, Globus,
+    Girder files, and HTTP transfers that use range requests or resume an earlier
+    transfer) run on threads, as with the threaded scheduler, and at most
+    dm.transfer_worker_count of them run at the same time. In particular, a transfer
+    that fails on the loop after saving a resume record is resumed on a thread, with
+    range requests for the missing parts. Queueing, priorities and per-host and
+    per-scheme limits are the same for both kinds of transfers.
+    """
+    IO_THREADS = 4
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, settings, transferManager):
+        TransferScheduler.__init__(self, settings, transferManager)
+        self.loop = None
+        self.session = None
+        self.blockingLimit = 0
+        self.blockingRunning = 0
+
+    def submit(self, entry):
+        # decided up front, since checking for a resume record requires disk access
+        entry.onLoop = self.canRunOnLoop(entry.transferHandler)
+        TransferScheduler.submit(self, entry)
+
+    def canRunOnLoop(self, handler):
+        if not isinstance(handler, Http) or handler.isZipMember():
+            return False
+        if handler.getConnectionCount() > 1:
+            return False
+        record = ResumeRecord.load(handler.psPath)
+        return record is None or not record.isFor(handler.url, handler.flen)
+
+    def _ensureWorkers(self, count):
+        # called with the lock held
+        self.blockingLimit = count
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.ioExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=AsyncTransferScheduler.IO_THREADS, thread_name_prefix='DM Transfer IO')
+        self.blockingExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=count, thread_name_prefix='DM Transfer Worker')
+        threading.Thread(target=self.loop.run_forever, name='DM Transfer Loop',
+                         daemon=True).start()
+        threading.Thread(target=self._dispatch, name='DM Transfer Dispatcher',
+                         daemon=True).start()
+
+    def _dispatch(self):
+        while True:
+            entry = self.take()
+            asyncio.run_coroutine_threadsafe(self._run(entry), self.loop)
+
+    def take(self):
+        entry = TransferScheduler.take(self)
+        if not entry.onLoop:
+            with self.cond:
+                self.blockingRunning += 1
+        return entry
+
+    def release(self, entry):
+        if not entry.onLoop:
+            with self.cond:
+                self.blockingRunning -= 1
+        TransferScheduler.release(self, entry)
+
+    def _isEligible(self, entry, hostLimit, schemeLimits):
+        if not entry.onLoop and self.blockingRunning >= self.blockingLimit:
+            return False
+        return TransferScheduler._isEligible(self, entry, hostLimit, schemeLimits)
+
+    async def _run(self, entry):
+        handler = entry.transferHandler
+        try:
+            if entry.onLoop:
+                await self._transferHttp(handler)
+            else:
+                await self.loop.run_in_executor(self.blockingExecutor,
+                                                self.transferManager.runHandler, handler)
+            if not handler.isAsynchronous():
+                await self._io(self.transferManager.transferCompleted, entry.transferId,
+                               handler)
+        except Exception as ex:  # noqa
+            traceback.print_exc()
+            await self._io(self.transferManager.transferFailed, entry.transferId, handler, ex)
+        finally:
+            self.release(entry)
+
+    def _io(self, fn, *args):
+        return self.loop.run_in_executor(self.ioExecutor, fn, *args)
+
+    def getSession(self):
+        if self.session is None:
+            # concurrency is limited by the scheduler, not by the connector
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0),
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=300))
+        return self.session
+
+    async def _transferHttp(self, handler):
+        # the equivalent of Http._transfer() for a single request
+        try:
+            self.transferManager.transferProgress(handler.transferId, handler.flen, 0)
+            await self._io(handler.mkdirs)
+            await self._io(handler.start_checksum)
+            # if this fails, the resume record is kept for the next attempt
+            await self._copyHttp(handler)
+            try:
+                await self._io(handler.verify_checksum)
+            finally:
+                await self._io(handler.discardResumeRecord)
+        except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as ex:
+            raise TransferException(message=str(ex), cause=ex, fatal=not isTemporaryError(ex))
+
+    async def _copyHttp(self, handler):
+        async with self.getSession().get(handler.url, headers=handler.headers) as resp:
+            resp.raise_for_status()
+            validator = getValidator(resp.headers)
+            if acceptsRanges(resp.headers) and validator is not None:
+                handler.record = ResumeRecord(handler.psPath, handler.url, handler.flen,
+                                              validator)
+            fd = await self._io(handler.openOutput, True)
+            try:
+                offset = 0
+                async for buf in resp.content.iter_chunked(AsyncTransferScheduler.CHUNK_SIZE):
+                    await self._io(handler.writeChunk, fd, offset, buf)
+                    offset += len(buf)
+                    wait = self.transferManager.bandwidthLimiter.reserve(
+                        handler.user['_id'], len(buf))
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+            finally:
+                await self._io(os.close, fd)
+                await self._io(handler.saveResumeRecord)
+            expected = resp.headers.get('Content-Length')
+            if 'Content-Encoding' not in resp.headers and expected is not None and \
+                    handler.transferred != int(expected):
+                raise NetworkError('Connection closed after %s of %s bytes of %s' %
+                                   (handler.transferred, expected, handler.url))
+
+
+def isTemporaryError(ex):
+    # the equivalent of handlers.http.isTemporaryError() for aiohttp
+    if isinstance(ex, aiohttp.ClientResponseError):
+        return isTemporaryStatus(ex.status)
+    return isinstance(ex, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                           asyncio.TimeoutError, NetworkError, ConnectionError))
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from .. import constants
+
+
+class TokenBucket:
+    """
+    A token bucket that allows going into debt: a consumer takes the tokens it needs
+    and then waits for as long as it takes for the bucket to no longer be in debt. This
+    allows consumers to use chunks of any size. The rate can change between calls.
+    """
+    # how many seconds worth of tokens can be accumulated while idle
+    BURST = 1.0
+
+    def __init__(self):
+        self.tokens = 0.0
+        self.lastUpdate = time.time()
+
+    def reserve(self, n, rate, now):
+        """
+        Takes n tokens and returns the number of seconds to wait before using them.
+        """
+        self.tokens = min(self.tokens + (now - self.lastUpdate) * rate, rate * TokenBucket.BURST)
+        self.lastUpdate = now
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / rate
+
+
+class BandwidthLimiter:
+    """
+    Limits the rate at which transfers move data. The total rate is limited by the
+    dm.bandwidth_limit setting, which is shared fairly between users that are actively
+    transferring data. The rate of each user can be further limited by the
+    dm.user_bandwidth_limit setting. Limits are in bytes per second and a non-positive
+    limit means no limit.
+    """
+    # a user is active if it transferred data in the last ACTIVE_WINDOW seconds
+    ACTIVE_WINDOW = 2.0
+    # how often the limits are re-read from the settings
+    SETTINGS_REFRESH_INTERVAL = 5.0
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.globalBucket = TokenBucket()
+        self.userBuckets = {}
+        self.lastUsed = {}
+        self.limits = None
+        self.limitsTime = 0
+
+    def getLimits(self, now):
+        if self.limits is None or now - self.limitsTime > \
+                BandwidthLimiter.SETTINGS_REFRESH_INTERVAL:
+            self.limits = (
+                float(self.settings.get(constants.PluginSettings.BANDWIDTH_LIMIT)),
+                float(self.settings.get(constants.PluginSettings.USER_BANDWIDTH_LIMIT))
+            )
+            self.limitsTime = now
+        return self.limits
+
+    def throttle(self, userId, n):
+        """
+        Called after n bytes were transferred on behalf of a user. Waits for as long as
+        needed to keep the rates within the limits.
+        """
+        wait = self.reserve(userId, n)
+        if wait > 0:
+            time.sleep(wait)
+
+    def reserve(self, userId, n):
+        """
+        Accounts for n bytes transferred on behalf of a user and returns the number of
+        seconds to wait before transferring more, for callers that cannot sleep.
+        """
+        now = time.time()
+        with self.lock:
+            globalLimit, userLimit = self.getLimits(now)
+            if globalLimit <= 0 and userLimit <= 0:
+                return 0
+            self.lastUsed[userId] = now
+            self._forgetIdleUsers(now)
+            userRate = userLimit
+            wait = 0
+            if globalLimit > 0:
+                wait = self.globalBucket.reserve(n, globalLimit, now)
+                fairShare = globalLimit / len(self.lastUsed)
+                if userRate <= 0 or fairShare < userRate:
+                    userRate = fairShare
+            bucket = self.userBuckets.setdefault(userId, TokenBucket())
+            wait = max(wait, bucket.reserve(n, userRate, now))
+            # a user that is waiting is still active
+            self.lastUsed[userId] = now + wait
+        return wait
+
+    def _forgetIdleUsers(self, now):
+        for userId, lastUsed in list(self.lastUsed.items()):
+            if now - lastUsed > BandwidthLimiter.ACTIVE_WINDOW:
+                del self.lastUsed[userId]
+                self.userBuckets.pop(userId, None)
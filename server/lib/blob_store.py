@@ -0,0 +1,97 @@
+import hashlib
+import os
+import shutil
+import threading
+
+from .. import constants
+from .tm_utils import Models
+
+
+class BlobStore:
+    """
+    Content-addressed private storage, enabled by the dm.content_addressed_storage
+    setting. Transferred files are moved into blobs named after the digest of their
+    contents, so items with identical contents share a single file. Each blob counts the
+    cached items that use it and is only deleted once none do.
+
+    The digest is the one computed while the file was transferred, if any, and is
+    otherwise computed using DEFAULT_ALGORITHM. Files with the same contents but digests
+    computed with different algorithms are stored separately.
+    """
+    DEFAULT_ALGORITHM = 'sha256'
+    READ_SIZE = 4 * 1024 * 1024
+
+    # Keeps the blob documents consistent with the files. Shared by all instances.
+    lock = threading.Lock()
+
+    def __init__(self, settings, pathMapper):
+        self.settings = settings
+        self.pathMapper = pathMapper
+
+    def isEnabled(self):
+        return bool(self.settings.get(constants.PluginSettings.CONTENT_ADDRESSED_STORAGE))
+
+    def add(self, path, digest=None):
+        """
+        Adds a reference to the blob with the contents of the file at path, creating the
+        blob if needed, and returns a (blobId, blobPath) tuple. The file at path is left
+        in place and can be removed once nothing reads it any more.
+        """
+        if digest is None:
+            digest = (BlobStore.DEFAULT_ALGORITHM, self.computeDigest(path))
+        alg, value = digest[0].lower(), digest[1].lower()
+        blobId = '%s:%s' % (alg, value)
+        blobPath = self.pathMapper.getBlobPath(alg, value)
+        with BlobStore.lock:
+            Models.blobModel.addReference(blobId, blobPath, os.path.getsize(path))
+            if not os.path.exists(blobPath):
+                try:
+                    os.makedirs(os.path.dirname(blobPath), exist_ok=True)
+                    self._link(path, blobPath)
+                except Exception:
+                    Models.blobModel.removeReference(blobId)
+                    raise
+        return blobId, blobPath
+
+    def _link(self, path, blobPath):
+        tmpPath = blobPath + '.tmp'
+        try:
+            os.link(path, tmpPath)
+        except FileExistsError:
+            os.remove(tmpPath)
+            os.link(path, tmpPath)
+        except OSError:
+            # e.g., not supported by the filesystem
+            shutil.copyfile(path, tmpPath)
+        os.replace(tmpPath, blobPath)
+
+    def release(self, blobId):
+        """
+        Removes a reference to a blob and deletes the blob file if no cached item uses it
+        any more. Returns True if the file was deleted.
+        """
+        with BlobStore.lock:
+            blob = Models.blobModel.removeReference(blobId)
+            if blob is None or blob['refCount'] > 0:
+                return False
+            try:
+                os.remove(blob['path'])
+            except FileNotFoundError:
+                pass
+            return True
+
+    def exists(self, blobId):
+        return Models.blobModel.findOne({'_id': blobId}, fields=['_id']) is not None
+
+    def computeDigest(self, path):
+        hash = hashlib.new(BlobStore.DEFAULT_ALGORITHM)
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(BlobStore.READ_SIZE)
+                if not data:
+                    break
+                hash.update(data)
+        return hash.hexdigest()
+
+    def getStats(self):
+        return Models.blobModel.getStats()
@@ -1,4 +1,5 @@
 from .tm_utils import Models
+from ..constants import TransferPriority
 
 
 class CacheManager:
@@ -9,12 +10,19 @@ class CacheManager:
         self.pathMapper = pathMapper
         self.lockModel = Models.lockModel
 
-    def itemLocked(self, user, itemId, sessionId):
+    def itemLocked(self, user, itemId, sessionId, priority=TransferPriority.NORMAL):
+        pass
+
+    def transferRequested(self, itemId, priority):
         pass
 
     def itemUnlocked(self, itemId):
         pass
 
+    def itemsUnlocked(self, itemIds):
+        for itemId in itemIds:
+            self.itemUnlocked(itemId)
+
     def fileDownloaded(self, info):
         pass
 
@@ -32,10 +40,15 @@ class SimpleCacheManager(CacheManager):
     def __init__(self, settings, transferManager, fileGC, pathMapper):
         CacheManager.__init__(self, settings, transferManager, fileGC, pathMapper)
 
-    def itemLocked(self, user, itemId, sessionId):
+    def itemLocked(self, user, itemId, sessionId, priority=TransferPriority.NORMAL):
         # initiates transfer immediately
-        self.transferManager.startTransfer(user, itemId, sessionId)
-        CacheManager.itemLocked(self, user, itemId, sessionId)
+        self.transferManager.startTransfer(user, itemId, sessionId, priority)
+        CacheManager.itemLocked(self, user, itemId, sessionId, priority)
+
+    def transferRequested(self, itemId, priority):
+        # the item is already being transferred on behalf of another lock; make sure
+        # the transfer is not held back by a lower priority than this lock needs
+        self.transferManager.raisePriority(itemId, priority)
 
     def itemUnlocked(self, itemId):
         # notifies GC
@@ -50,5 +63,6 @@ class SimpleCacheManager(CacheManager):
         pass
 
     def sessionDeleted(self, session):
-        # also nothing; we mark as unused on close()
-        pass
+        # locks that were not released on close() would otherwise keep the items
+        # of the session in the cache forever
+        self.lockModel.unlockAll(None, session)
@@ -1,6 +1,9 @@
 from __future__ import with_statement
 
 from .tm_utils import Models
+from .blob_store import BlobStore
+from .metrics import Metrics
+from .handlers.partial import ResumeRecord
 from ..models.lock import Lock
 from ..models.psinfo import PSInfo
 from .. import constants
@@ -20,11 +23,19 @@ class FileGC:
         self.settings = settings
         self.lockModel = Models.lockModel
         self.pathMapper = pathMapper
+        self.blobStore = BlobStore(settings, pathMapper)
 
     def deleteFile(self, itemId):
         if self.lockModel.tryLockForDeletion(itemId):
             try:
+                blobId = self.lockModel.getBlobId(itemId)
+                if blobId is not None:
+                    # other cached items may still use the blob
+                    self.blobStore.release(blobId)
+                    self.lockModel.fileDeleted(itemId)
+                    return True
                 path = self.pathMapper.getPSPath(itemId)
+                ResumeRecord.discard(path)
                 os.remove(path)
                 self.lockModel.fileDeleted(itemId)
                 return True
@@ -105,7 +116,10 @@ class PeriodicFileGC(FileGC):
         with self.collectLock:
             if self.paused:
                 return
+            start = time.time()
             self._collect()
+            Metrics.gcRuns.inc()
+            Metrics.gcDuration.observe(time.time() - start)
 
     def _collect(self):
         # If total used space is over some collectThreshold, possibly a percentage of total space:
@@ -116,7 +130,14 @@ class PeriodicFileGC(FileGC):
         if self.shouldCollect():
             candidates = self.getCollectionCandidates()
             used = 0
+            blobs = set()
             for c in candidates:
+                # items that share a blob only take space once
+                blobId = c.get('dm', {}).get('blob')
+                if blobId is not None:
+                    if blobId in blobs:
+                        continue
+                    blobs.add(blobId)
                 used = used + self.fileSize(c)
 
             self.sortCandidates(candidates)
@@ -124,7 +145,10 @@ class PeriodicFileGC(FileGC):
             collected = 0
             for c in candidates:
                 if self.collectFile(c):
-                    collected = collected + self.fileSize(c)
+                    Metrics.gcEvictedFiles.inc()
+                    if not self.isFileShared(c):
+                        collected = collected + self.fileSize(c)
+                        Metrics.gcEvictedBytes.inc(self.fileSize(c))
                     if self.shouldStopCollecting(used, collected):
                         # keep an authoritative account of space used that isn't likely to drift
                         self.updateUsedSpace(used - collected)
@@ -139,6 +163,11 @@ class PeriodicFileGC(FileGC):
     def fileSize(self, item):
         return item['size']
 
+    def isFileShared(self, item):
+        # true if deleting the file of an item did not free any space
+        blobId = item.get('dm', {}).get('blob')
+        return blobId is not None and self.blobStore.exists(blobId)
+
     def sortCandidates(self, list):
         list.sort(key=lambda x: self.collectionStrategy.itemSortKey(x))
 
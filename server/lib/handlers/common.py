@@ -1,15 +1,146 @@
 import hashlib
 import os
+import shutil
+import threading
+import time
+import urllib.parse
 
-from girder.constants import AccessType
-from girder.models.item import Item
 from girder.plugins.wholetale.lib import Verificators
 
+from ..blob_store import BlobStore
 from ..tm_utils import TransferHandler, TransferException
 
 
+class StreamingChecksum:
+    """
+    Computes the digest of a file while it is being written, so that it does not have
+    to be read back once the transfer is done. Data written sequentially is hashed as
+    it goes by. Data written out of order (e.g., by parallel range requests) is hashed
+    from the output file as soon as it becomes contiguous, which is normally while it
+    is still in the page cache.
+    """
+    READ_SIZE = 2**22  # 4MB chunks
+
+    def __init__(self, alg, expected):
+        self.alg = alg
+        self.expected = expected
+        self.hash = hashlib.new(alg.lower())
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def update(self, data):
+        with self.lock:
+            self.hash.update(data)
+            self.offset += len(data)
+
+    def feed(self, fd, offset, data, contiguousEnd):
+        """
+        Called after data was written to fd at offset. The contiguousEnd is the number
+        of bytes that were written without gaps from the beginning of the file.
+        """
+        # If another thread is busy hashing, it, or a later call, will pick this data up
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if offset == self.offset:
+                self.hash.update(data)
+                self.offset += len(data)
+            self._catchUp(fd, contiguousEnd)
+        finally:
+            self.lock.release()
+
+    def catchUp(self, fd, end):
+        """
+        Hashes the data in fd up to end, which must have been written without gaps.
+        """
+        with self.lock:
+            self._catchUp(fd, end)
+
+    def _catchUp(self, fd, end):
+        while self.offset < end:
+            data = os.pread(fd, min(StreamingChecksum.READ_SIZE, end - self.offset), self.offset)
+            if not data:
+                raise IOError('Unexpected end of file while computing checksum')
+            self.hash.update(data)
+            self.offset += len(data)
+
+    def finish(self, path):
+        """
+        Hashes whatever part of the file at path was not fed to this checksum and returns
+        the hex digest.
+        """
+        with self.lock, open(path, 'rb') as fp:
+            fp.seek(self.offset)
+            while True:
+                data = fp.read(StreamingChecksum.READ_SIZE)
+                if not data:
+                    break
+                self.hash.update(data)
+                self.offset += len(data)
+            return self.hash.hexdigest()
+
+
+class AdaptiveBuffer:
+    """
+    A buffer that is reused for all the reads of a copy, so that copying does not
+    allocate memory for every chunk. It starts at MIN_SIZE and doubles, up to MAX_SIZE,
+    every time a read fills it in less than FAST_READ_TIME seconds. Fast streams are
+    thus copied in large chunks, while slow streams still commit data and report
+    progress regularly.
+    """
+    MIN_SIZE = 64 * 1024
+    MAX_SIZE = 4 * 1024 * 1024
+    FAST_READ_TIME = 0.05
+
+    def __init__(self):
+        self.size = AdaptiveBuffer.MIN_SIZE
+        self.buf = None
+        self.view = None
+
+    def readFrom(self, inf, limit=None):
+        """
+        Reads at most limit bytes from inf into the buffer and returns a view of the data,
+        which is only valid until the next read. The view is empty at the end of inf.
+        """
+        if self.buf is None or len(self.buf) != self.size:
+            # views returned earlier keep the old buffer alive for as long as needed
+            self.buf = bytearray(self.size)
+            self.view = memoryview(self.buf)
+        view = self.view if limit is None else self.view[:limit]
+        start = time.time()
+        n = inf.readinto(view) or 0
+        self.observe(len(view), n, time.time() - start)
+        return view[:n]
+
+    def observe(self, requested, n, elapsed):
+        """
+        Adjusts the size based on a read of n out of requested bytes that took elapsed
+        seconds. Used directly by streams that cannot read into a buffer.
+        """
+        if requested == n == self.size and elapsed < AdaptiveBuffer.FAST_READ_TIME:
+            self.size = min(self.size * 2, AdaptiveBuffer.MAX_SIZE)
+
+
+def normalizeUrl(url):
+    """
+    Returns a canonical form of a URL, such that URLs that differ only in the case of the
+    scheme and host, an explicit default port or a fragment are considered equal.
+    """
+    parsed = urllib.parse.urlparse(url)
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    for defaultScheme, defaultPort in (('http', ':80'), ('https', ':443')):
+        if scheme == defaultScheme and netloc.endswith(defaultPort):
+            netloc = netloc[:-len(defaultPort)]
+    return urllib.parse.urlunparse((scheme, netloc, parsed.path or '/', parsed.params,
+                                    parsed.query, ''))
+
+
 class UrlTransferHandler(TransferHandler):
     _headers = None
+    checksum = None
+    verifiedChecksum = None
+    digest = None
 
     def __init__(self, url, transferId, itemId, psPath, user, transferManager):
         TransferHandler.__init__(self, transferId, itemId, psPath, user, transferManager)
@@ -22,6 +153,35 @@ class UrlTransferHandler(TransferHandler):
         except KeyError:
             pass
 
+    def getSourceUrl(self):
+        return self.url
+
+    def getSourceKey(self):
+        # the headers may carry credentials, so only share downloads made with the same ones
+        return (normalizeUrl(self.url), tuple(sorted(self.headers.items())))
+
+    def copyFrom(self, other):
+        self.mkdirs()
+        tmpPath = self.psPath + '.tmp'
+        try:
+            os.link(other.getPhysicalPath(), tmpPath)
+        except FileExistsError:
+            os.remove(tmpPath)
+            os.link(other.getPhysicalPath(), tmpPath)
+        except OSError:
+            # e.g., not supported by the filesystem
+            shutil.copyfile(other.getPhysicalPath(), tmpPath)
+        os.replace(tmpPath, self.psPath)
+        self.start_checksum()
+        if self.checksum is not None:
+            digest = other.getDigest()
+            # algorithm names in metadata may be in any case
+            if digest is not None and digest[0].lower() == self.checksum.alg.lower():
+                # same contents, so there is no need to read the file again
+                self._checkDigest(digest[1])
+            else:
+                self.verify_checksum()
+
     @property
     def headers(self):
         if self._headers:
@@ -34,35 +194,51 @@ class UrlTransferHandler(TransferHandler):
         except OSError:
             pass
 
-    def verify_checksum(self):
-        item = Item().load(self.itemId, user=self.user, level=AccessType.READ)
-        if (checksums := item.get("meta", {}).get("checksum")):
+    def start_checksum(self):
+        """
+        Must be called before any data is written. Sets up the streaming computation of
+        the checksum of the file if the item has one in its metadata, or if the digest is
+        needed for content-addressed storage.
+        """
+        self.checksum = None
+        # use the item loaded with the handler; transfer processes do not use the database
+        if (checksums := self.item.get("meta", {}).get("checksum")):
             alg, value = list(checksums.items())[0]  # Get just one
-            h = hashlib.new(alg.lower())
-
-            with open(self.psPath, "rb") as fp:
-                while True:
-                    data = fp.read(2**22)  # 4MB chunks
-                    if not data:
-                        break
-                    h.update(data)
-            if h.hexdigest() != value:
+            self.checksum = StreamingChecksum(alg, value)
+        elif self.transferManager.blobStore.isEnabled():
+            self.checksum = StreamingChecksum(BlobStore.DEFAULT_ALGORITHM, None)
+
+    def verify_checksum(self):
+        if self.checksum is None:
+            return
+        self._checkDigest(self.checksum.finish(self.psPath))
+
+    def _checkDigest(self, value):
+        if self.checksum.expected is not None:
+            if value != self.checksum.expected:
                 os.remove(self.psPath)
                 raise TransferException(
                     message=f"Checksum verification failed for item:{self.itemId}",
                     fatal=True
                 )
+            self.verifiedChecksum = {self.checksum.alg: self.checksum.expected}
+        self.digest = (self.checksum.alg, value)
 
+    def getChecksum(self):
+        return self.verifiedChecksum
+
+    def getDigest(self):
+        return self.digest
 
-class FileLikeUrlTransferHandler(UrlTransferHandler):
-    BUFSZ = 32768
 
+class FileLikeUrlTransferHandler(UrlTransferHandler):
     def __init__(self, url, transferId, itemId, psPath, user, transferManager):
         UrlTransferHandler.__init__(self, url, transferId, itemId, psPath, user, transferManager)
 
     def transfer(self):
         self.transferManager.transferProgress(self.transferId, self.flen, 0)
         self.mkdirs()
+        self.start_checksum()
         with open(self.psPath, 'wb') as outf, self.openInputStream() as inf:
             self.transferBytes(outf, inf)
         self.verify_checksum()
@@ -70,12 +246,17 @@ class FileLikeUrlTransferHandler(UrlTransferHandler):
     def openInputStream(self):
         raise NotImplementedError()
 
-    def transferBytes(self, outf, inf):
-        crt = 0
+    def transferBytes(self, outf, inf, crt=0):
+        buffer = AdaptiveBuffer()
         while True:
-            buf = inf.read(FileLikeUrlTransferHandler.BUFSZ)
+            buf = buffer.readFrom(inf)
             if not buf:
                 break
             outf.write(buf)
+            if self.checksum is not None:
+                self.checksum.update(buf)
             crt = crt + len(buf)
+            outf.flush()
+            self.bytesCommitted(crt)
             self.updateTransferProgress(self.flen, crt)
+            self.throttle(len(buf))
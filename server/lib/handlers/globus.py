@@ -1,4 +1,5 @@
 from ..tm_utils import TransferHandler, TransferException
+from .globus_monitor import GlobusTaskMonitor, GlobusTaskBatcher
 from girder.plugins.globus_handler.server import Server
 from girder.plugins.globus_handler.clients import Clients
 from threading import Lock
@@ -7,15 +8,20 @@ from girder.utility.model_importer import ModelImporter
 from girder import logger
 from urllib.parse import urlparse
 import uuid
-import time
 import shutil
 import os
 
 
 class Globus(TransferHandler):
+    # shared by all Globus transfers
+    monitor = None
+    batcher = None
+    monitorLock = Lock()
+
     def __init__(self, url, transferId, itemId, psPath, user, transferManager):
         TransferHandler.__init__(self, transferId, itemId, psPath, user, transferManager)
         self.url = url
+        self.tmpName = None
         self.server = None
         self.serverLock = Lock()
         self.clients = Clients()
@@ -23,63 +29,96 @@ class Globus(TransferHandler):
     def isManaged(self):
         return True
 
+    def getSourceUrl(self):
+        return self.url
+
+    def isAsynchronous(self):
+        return True
+
     def transfer(self):
-        # this isn't very scalable and there isn't much wisdom in wasting a thread on a transfer
-        # that is directed by another machine, but we waste an entire process or more on the
-        # gridftp server processes anyway, so this may not quite be the bottleneck
+        # Only queues the item. It is submitted as part of a task together with other
+        # items from the same endpoint and user, and the task is then followed by the
+        # monitor, which calls taskUpdated() until the task is done.
         self._maybeStartServer()
-        userEndpointId = self.server.getUserEndpointId(self.user)
-        tc = self.clients.getUserTransferClient(self.user)
+        self.tmpName = str(uuid.uuid4())
+        self._getBatcher().add((self._getSourceEndpointId(), str(self.user['_id'])), self)
 
-        tmpName = str(uuid.uuid4())
-        transfer = TransferData(tc, self._getSourceEndpointId(), userEndpointId,
-                                label=str(self.transferId))
+    @staticmethod
+    def submitTask(handlers):
+        first = handlers[0]
+        userEndpointId = first.server.getUserEndpointId(first.user)
+        tc = first.clients.getUserTransferClient(first.user)
+
+        label = str(first.transferId)
+        if len(handlers) > 1:
+            label = '%s and %s more' % (label, len(handlers) - 1)
+        transfer = TransferData(tc, first._getSourceEndpointId(), userEndpointId, label=label)
         transfer['notify_on_succeeded'] = False
         transfer['notify_on_failed'] = False
         transfer['notify_on_inactive'] = False
-        transfer.add_item(self._getSourcePath(), tmpName)
+        for handler in handlers:
+            transfer.add_item(handler._getSourcePath(), handler.tmpName)
         res = tc.submit_transfer(transfer)
         if res['code'] != 'Accepted':
             raise Exception('Transfer submission failed: %s - %s' % (res.code, res.message))
         taskId = res['task_id']
-        self._updateTransfer(tmpName, taskId)
-        while True:
-            task = tc.get_task(taskId)
-            status = task['status']
-            if status == 'ACTIVE':
-                # update bytes
-                self.transferManager.transferProgress(self.transferId, -1,
-                                                      task['bytes_transferred'])
-            elif status == 'INACTIVE':
-                # credential expiration
-                # TODO: deal with this properly or ensure it does not happen
-                msg = 'Credential expired for Globus task %s, transfer %s.' % (taskId,
-                                                                               self.transferId)
-                logger.warn(msg)
-                raise TransferException(message=msg, fatal=True)
-            elif status == 'SUCCEEDED':
-                dir = os.path.dirname(self.psPath)
-                try:
-                    os.makedirs(dir)
-                except OSError:
-                    if not os.path.exists(dir):
-                        raise TransferException(message='Could not create transfer destination '
-                                                        'directory: %s' % dir, fatal=True)
-                shutil.move('%s/%s' % (self.server.getUserDir(self.user), tmpName), self.psPath)
-                return
-            elif status == 'FAILED':
-                if task['fatal_error']:
-                    raise TransferException(
-                        message='Globus transfer %s failed: %s' %
-                        (self.transferId, task['fatal_error']['description']),
-                        fatal=True)
-                else:
-                    raise Exception(message='Globus transfer %s failed for unknown reasons' %
-                                    self.transferId, fatal=False)
+        for handler in handlers:
+            handler._updateTransfer(handler.tmpName, taskId)
+        return taskId
+
+    def taskUpdated(self, task):
+        if task['status'] == 'ACTIVE':
+            # update bytes
+            self.transferManager.transferProgress(self.transferId, -1,
+                                                  task['bytes_transferred'])
+            return
+        try:
+            self._taskEnded(task)
+        except Exception as ex:  # noqa
+            self.transferManager.transferFailed(self.transferId, self, ex)
+        else:
+            self.transferManager.transferCompleted(self.transferId, self)
+
+    def _taskEnded(self, task):
+        taskId = task['task_id']
+        status = task['status']
+        if status == 'INACTIVE':
+            # credential expiration
+            # TODO: deal with this properly or ensure it does not happen
+            msg = 'Credential expired for Globus task %s, transfer %s.' % (taskId,
+                                                                           self.transferId)
+            logger.warn(msg)
+            raise TransferException(message=msg, fatal=True)
+        elif status == 'SUCCEEDED':
+            dir = os.path.dirname(self.psPath)
+            try:
+                os.makedirs(dir)
+            except OSError:
+                if not os.path.exists(dir):
+                    raise TransferException(message='Could not create transfer destination '
+                                                    'directory: %s' % dir, fatal=True)
+            shutil.move('%s/%s' % (self.server.getUserDir(self.user), self.tmpName),
+                        self.psPath)
+        elif status == 'FAILED':
+            if task['fatal_error']:
+                raise TransferException(
+                    message='Globus transfer %s failed: %s' %
+                    (self.transferId, task['fatal_error']['description']),
+                    fatal=True)
             else:
-                raise Exception(messsage='Unknown globus task status %s for transfer %s' %
-                                (status, self.transferId), fatal=False)
-            time.sleep(10)
+                raise TransferException(message='Globus transfer %s failed for unknown reasons' %
+                                        self.transferId, fatal=False)
+        else:
+            raise TransferException(message='Unknown globus task status %s for transfer %s' %
+                                    (status, self.transferId), fatal=False)
+
+    def _getBatcher(self):
+        with Globus.monitorLock:
+            if Globus.monitor is None:
+                Globus.monitor = GlobusTaskMonitor(self.clients)
+                Globus.monitor.start()
+                Globus.batcher = GlobusTaskBatcher(Globus.monitor, Globus.submitTask)
+            return Globus.batcher
 
     def _getSourceEndpointId(self):
         up = urlparse(self.url)
@@ -0,0 +1,168 @@
+import threading
+import time
+
+from girder import logger
+
+
+class _WatchedTask:
+    def __init__(self, user, taskId, listener, interval):
+        self.user = user
+        self.taskId = taskId
+        self.listener = listener
+        self.interval = interval
+        self.nextPoll = time.time() + interval
+
+    def backOff(self, factor, maxInterval):
+        self.interval = min(self.interval * factor, maxInterval)
+        self.nextPoll = time.time() + self.interval
+
+
+class GlobusTaskMonitor(threading.Thread):
+    """
+    Follows the progress of all outstanding Globus tasks using a single thread. Tasks
+    that are due are polled in batches, one request per user and batch. Each task is
+    polled frequently at first and less frequently as it keeps running, so that short
+    tasks finish quickly without long tasks generating many requests.
+
+    Listeners must implement ``taskUpdated(task)``, which is called with the task document
+    after every poll. Once a task is no longer active, it is called one last time and
+    the task is forgotten.
+    """
+    INITIAL_INTERVAL = 2
+    MAX_INTERVAL = 60
+    BACKOFF_FACTOR = 1.5
+    BATCH_SIZE = 100
+
+    def __init__(self, clients):
+        threading.Thread.__init__(self, name='DM Globus Task Monitor')
+        self.daemon = True
+        self.clients = clients
+        self.tasks = {}
+        self.cond = threading.Condition()
+
+    def watch(self, user, taskId, listener):
+        with self.cond:
+            self.tasks[taskId] = _WatchedTask(user, taskId, listener,
+                                              GlobusTaskMonitor.INITIAL_INTERVAL)
+            self.cond.notify()
+
+    def getTaskCount(self):
+        with self.cond:
+            return len(self.tasks)
+
+    def run(self):
+        while True:
+            byUser = {}
+            for watched in self._waitForDueTasks():
+                byUser.setdefault(watched.user['_id'], []).append(watched)
+            for tasks in byUser.values():
+                for i in range(0, len(tasks), GlobusTaskMonitor.BATCH_SIZE):
+                    self._poll(tasks[i:i + GlobusTaskMonitor.BATCH_SIZE])
+
+    def _waitForDueTasks(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                due = [t for t in self.tasks.values() if t.nextPoll <= now]
+                if due:
+                    return due
+                timeout = None
+                if self.tasks:
+                    timeout = min(t.nextPoll for t in self.tasks.values()) - now
+                self.cond.wait(timeout)
+
+    def _poll(self, batch):
+        try:
+            tc = self.clients.getUserTransferClient(batch[0].user)
+            ids = ','.join(str(watched.taskId) for watched in batch)
+            for task in tc.task_list(filter='task_id:%s' % ids, limit=len(batch)):
+                self._dispatch(task)
+        except Exception as ex:  # noqa
+            # most likely a temporary problem; the tasks are polled again later
+            logger.warning('Failed to poll Globus tasks: %s' % ex)
+        finally:
+            with self.cond:
+                for watched in batch:
+                    watched.backOff(GlobusTaskMonitor.BACKOFF_FACTOR,
+                                    GlobusTaskMonitor.MAX_INTERVAL)
+
+    def _dispatch(self, task):
+        with self.cond:
+            watched = self.tasks.get(task['task_id'])
+            if watched is None:
+                return
+            if task['status'] != 'ACTIVE':
+                del self.tasks[task['task_id']]
+        try:
+            watched.listener.taskUpdated(task)
+        except Exception as ex:  # noqa
+            logger.warning('Error handling update of Globus task %s: %s' % (watched.taskId, ex))
+
+
+class _TaskBatch:
+    def __init__(self, user):
+        self.user = user
+        self.handlers = []
+
+    def taskUpdated(self, task):
+        if task['status'] == 'ACTIVE' and len(self.handlers) > 1:
+            # the progress of a task cannot be attributed to its individual items
+            return
+        for handler in self.handlers:
+            handler.taskUpdated(task)
+
+
+class GlobusTaskBatcher:
+    """
+    Groups Globus transfers with the same source endpoint and user into a single
+    multi-item Globus task. A batch is submitted when it reaches MAX_ITEMS or
+    COALESCE_WINDOW seconds after its first transfer was added, whichever comes first.
+    The submit function is called with the list of handlers in a batch, must submit a
+    task containing all of them and return its id. The task is then followed by the
+    monitor and its outcome is passed to each handler.
+    """
+    COALESCE_WINDOW = 2
+    MAX_ITEMS = 1000
+
+    def __init__(self, monitor, submit):
+        self.monitor = monitor
+        self.submit = submit
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, handler):
+        full = None
+        with self.lock:
+            batch = self.pending.get(key)
+            if batch is None:
+                batch = _TaskBatch(handler.user)
+                self.pending[key] = batch
+                timer = threading.Timer(GlobusTaskBatcher.COALESCE_WINDOW, self._expired,
+                                        args=(key, batch))
+                timer.daemon = True
+                timer.start()
+            batch.handlers.append(handler)
+            if len(batch.handlers) >= GlobusTaskBatcher.MAX_ITEMS:
+                del self.pending[key]
+                full = batch
+        if full is not None:
+            self._submit(full)
+
+    def _expired(self, key, batch):
+        with self.lock:
+            if self.pending.get(key) is not batch:
+                # already submitted because it was full
+                return
+            del self.pending[key]
+        self._submit(batch)
+
+    def _submit(self, batch):
+        try:
+            taskId = self.submit(batch.handlers)
+        except Exception as ex:  # noqa
+            logger.warning('Failed to submit Globus task for %s items: %s' %
+                           (len(batch.handlers), ex))
+            for handler in batch.handlers:
+                handler.transferManager.transferFailed(handler.transferId, handler, ex)
+            return
+        self.monitor.watch(batch.user, taskId, batch)
@@ -1,29 +1,289 @@
-import functools
-import urllib
-import zipfile
+import concurrent.futures
+import os
+import queue
+import socket
+import threading
+import time
+import urllib.parse
 
-import httpio
 import requests
+import urllib3
 
-from .common import FileLikeUrlTransferHandler
+from ... import constants
+from ..tm_utils import TransferException, NetworkError, isTemporaryStatus
+from .common import FileLikeUrlTransferHandler, AdaptiveBuffer
+from .partial import ResumeRecord, getValidator
 
 
 class Http(FileLikeUrlTransferHandler):
-    def openInputStream(self):
+    # large files are split into ranges of this size, which are then fetched by
+    # dm.http_ranged_connections parallel requests
+    RANGE_SIZE = 32 * 1024 * 1024
+    # how often, in bytes, the resume record of a partial transfer is saved
+    RESUME_SAVE_INTERVAL = 16 * 1024 * 1024
+
+    def __init__(self, url, transferId, itemId, psPath, user, transferManager):
+        FileLikeUrlTransferHandler.__init__(self, url, transferId, itemId, psPath, user,
+                                            transferManager)
+        self.progressLock = threading.Lock()
+        self.transferred = 0
+        self.lastSaved = 0
+        self.record = None
+
+    def __getstate__(self):
+        state = FileLikeUrlTransferHandler.__getstate__(self)
+        del state['progressLock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.progressLock = threading.Lock()
+
+    def isZipMember(self):
         parsed = urllib.parse.urlparse(self.url)
-        if parsed.path and parsed.path.endswith('.zip') and parsed.query:
-            qs = urllib.parse.parse_qs(parsed.query)
-            path = qs['path'][0]
-            fp = httpio.open(urllib.parse.urlunparse((parsed.scheme, parsed.netloc, parsed.path,
-                                                      '', '', '')), headers=self.headers)
-            zf = zipfile.ZipFile(fp)
-            try:
-                return zipfile.Path(zf, path).open(mode="rb")
-            except ValueError:
-                return zipfile.Path(zf, path).open()
+        return bool(parsed.path and parsed.path.endswith('.zip') and parsed.query)
+
+    def getArchiveUrl(self):
+        parsed = urllib.parse.urlparse(self.url)
+        return urllib.parse.urlunparse((parsed.scheme, parsed.netloc, parsed.path, '', '', ''))
+
+    def getZipMemberPath(self):
+        qs = urllib.parse.parse_qs(urllib.parse.urlparse(self.url).query)
+        return qs['path'][0]
+
+    def isAsynchronous(self):
+        # zip members are extracted in batches, which complete their transfers
+        return self.isZipMember()
+
+    def transfer(self):
+        if self.isZipMember():
+            self.transferManager.zipBatcher.transfer(self.getArchiveUrl(), self.headers, self)
+            return
+        try:
+            self._transfer()
+        except (requests.RequestException, urllib3.exceptions.HTTPError, IOError) as ex:
+            # After a network problem, the partial file and its resume record are kept,
+            # so that a new attempt can continue from where this one stopped.
+            raise TransferException(message=str(ex), cause=ex, fatal=not isTemporaryError(ex))
+
+    def getConnectionCount(self):
+        """
+        Returns the number of parallel range requests to use for this file, which is 1 if
+        the file is small enough to be transferred with a single request.
+        """
+        connections = int(self.transferManager.settings.get(
+            constants.PluginSettings.HTTP_RANGED_CONNECTIONS))
+        minSize = int(self.transferManager.settings.get(
+            constants.PluginSettings.HTTP_RANGED_MIN_SIZE))
+        if connections > 1 and self.flen >= minSize:
+            return connections
+        return 1
+
+    def _transfer(self):
+        session = self.transferManager.httpSessionPool.getSession(self.url)
+        connections = self.getConnectionCount()
+
+        self.record = ResumeRecord.load(self.psPath)
+        if self.record is not None and not self.record.isFor(self.url, self.flen):
+            self.discardResumeRecord()
+
+        self.mkdirs()
+        self.start_checksum()
+        if self.record is None and connections == 1:
+            self.transferStream(session)
         else:
-            resp = requests.get(self.url, stream=True, headers=self.headers)
-            if resp.headers.get("Content-Encoding") in ("gzip",):
-                resp.raw.read = functools.partial(resp.raw.read, decode_content=True)
+            self.transferRanges(session, connections)
+        try:
+            self.verify_checksum()
+        finally:
+            self.discardResumeRecord()
+
+    def transferStream(self, session):
+        self.transferManager.transferProgress(self.transferId, self.flen, 0)
+        with session.get(self.url, stream=True, headers=self.headers) as resp:
             resp.raise_for_status()  # Throw an exception in case transfer failed
-            return resp.raw
+            validator = getValidator(resp.headers)
+            if acceptsRanges(resp.headers) and validator is not None:
+                self.record = ResumeRecord(self.psPath, self.url, self.flen, validator)
+            fd = self.openOutput(truncate=True)
+            try:
+                self.copyResponse(resp, fd, 0)
+            finally:
+                os.close(fd)
+                self.saveResumeRecord()
+            expected = resp.headers.get('Content-Length')
+            if 'Content-Encoding' not in resp.headers and expected is not None and \
+                    self.transferred != int(expected):
+                raise NetworkError('Connection closed after %s of %s bytes of %s' %
+                                   (self.transferred, expected, self.url))
+
+    def transferRanges(self, session, connections):
+        probe = session.head(self.url, headers=self.headers, allow_redirects=True)
+        if not probe.ok or not acceptsRanges(probe.headers) or \
+                probe.headers.get('Content-Length') != str(self.flen):
+            self.discardResumeRecord()
+            self.transferStream(session)
+            return
+
+        validator = getValidator(probe.headers)
+        if self.record is not None and not self.record.canResume(validator):
+            # the source changed since the partial file was written
+            self.discardResumeRecord()
+        resuming = self.record is not None
+        if not resuming:
+            self.record = ResumeRecord(self.psPath, self.url, self.flen, validator)
+
+        ranges = queue.Queue()
+        for start, end in self.record.done.missing(self.flen):
+            for rangeStart in range(start, end, Http.RANGE_SIZE):
+                ranges.put((rangeStart, min(rangeStart + Http.RANGE_SIZE, end)))
+        self.transferred = self.record.done.size()
+        self.lastSaved = self.transferred
+        self.transferManager.transferProgress(self.transferId, self.flen, self.transferred)
+        self.bytesCommitted(self.record.done.prefixEnd())
+        stop = threading.Event()
+        workers = max(min(connections, ranges.qsize()), 1)
+
+        fd = self.openOutput(truncate=not resuming)
+        try:
+            if not resuming:
+                self.preallocate(fd, self.flen)
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers,
+                    thread_name_prefix='DM Ranged Transfer[%s]' % self.itemId) as executor:
+                futures = [executor.submit(self._fetchRanges, session, fd, ranges, stop)
+                           for _ in range(workers)]
+                for future in concurrent.futures.as_completed(futures):
+                    if future.exception() is not None:
+                        # tell the other parts to give up and wait for them
+                        stop.set()
+                        raise future.exception()
+        finally:
+            os.close(fd)
+            self.saveResumeRecord()
+
+    def openOutput(self, truncate):
+        # readable, so that the checksum can catch up on ranges written out of order
+        flags = os.O_RDWR | os.O_CREAT
+        if truncate:
+            flags |= os.O_TRUNC
+        return os.open(self.psPath, flags, 0o666)
+
+    def preallocate(self, fd, size):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            # not available on this platform or not supported by the filesystem
+            os.ftruncate(fd, size)
+
+    def _fetchRanges(self, session, fd, ranges, stop):
+        while not stop.is_set():
+            try:
+                start, end = ranges.get_nowait()
+            except queue.Empty:
+                return
+            self._fetchRange(session, fd, start, end, stop)
+
+    def _fetchRange(self, session, fd, start, end, stop):
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes=%s-%s' % (start, end - 1)
+        validator = self.record.validator
+        if validator is not None:
+            # if the source changed, we get the whole thing instead of a range
+            headers['If-Range'] = validator.get('etag', validator.get('lastModified'))
+        with session.get(self.url, headers=headers, stream=True) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise NetworkError('Server did not honor range request for %s' % self.url)
+            self.copyResponse(resp, fd, start, end, stop)
+
+    def copyResponse(self, resp, fd, start, end=None, stop=None):
+        # The original handler only decoded gzip, so keep it that way
+        decode = resp.headers.get('Content-Encoding') in ('gzip',)
+        offset = start
+        # urllib3 cannot read into a buffer, but larger reads still reduce the per-chunk
+        # overhead of fast responses
+        buffer = AdaptiveBuffer()
+        while end is None or offset < end:
+            if stop is not None and stop.is_set():
+                return
+            n = buffer.size if end is None else min(buffer.size, end - offset)
+            readStart = time.time()
+            buf = resp.raw.read(n, decode_content=decode)
+            buffer.observe(n, len(buf), time.time() - readStart)
+            if not buf:
+                if end is not None:
+                    raise NetworkError('Premature end of range %s-%s of %s' %
+                                       (start, end, self.url))
+                return
+            self.writeChunk(fd, offset, buf)
+            self.throttle(len(buf))
+            offset += len(buf)
+
+    def writeChunk(self, fd, offset, buf):
+        os.pwrite(fd, buf, offset)
+        contiguousEnd = self.bytesWritten(offset, len(buf))
+        if self.checksum is not None:
+            self.checksum.feed(fd, offset, buf, contiguousEnd)
+        self.bytesCommitted(contiguousEnd)
+
+    def bytesWritten(self, offset, n):
+        """
+        Records that n bytes were written at offset and returns the number of bytes
+        written without gaps from the beginning of the file.
+        """
+        with self.progressLock:
+            self.transferred += n
+            if self.record is not None:
+                self.record.done.add(offset, offset + n)
+                if self.transferred - self.lastSaved >= Http.RESUME_SAVE_INTERVAL:
+                    # the data was already handed to the OS, so it survives a crash
+                    # of this process
+                    self.record.save()
+                    self.lastSaved = self.transferred
+            self.updateTransferProgress(self.flen, self.transferred)
+            if self.record is not None:
+                return self.record.done.prefixEnd()
+            # without a record, the data can only come from a single stream
+            return self.transferred
+
+    def saveResumeRecord(self):
+        with self.progressLock:
+            if self.record is not None:
+                self.record.save()
+
+    def discardResumeRecord(self):
+        self.record = None
+        ResumeRecord.discard(self.psPath)
+
+    def extractMember(self, inf):
+        """
+        Called by the zip batcher with a file object positioned at the data of the archive
+        member that this handler transfers.
+        """
+        self.transferManager.transferProgress(self.transferId, self.flen, 0)
+        self.mkdirs()
+        self.start_checksum()
+        with open(self.psPath, 'wb') as outf:
+            self.transferBytes(outf, inf)
+        self.verify_checksum()
+
+
+def isTemporaryError(ex):
+    """
+    Returns True if a transfer that failed with ex may succeed if it is tried again, which
+    is the case for connection problems, timeouts and server errors. Other HTTP errors
+    (e.g., 404) and local IO errors (e.g., a full disk) are permanent.
+    """
+    if isinstance(ex, requests.HTTPError):
+        return ex.response is None or isTemporaryStatus(ex.response.status_code)
+    return isinstance(ex, (requests.ConnectionError, requests.Timeout,
+                           requests.exceptions.ChunkedEncodingError,
+                           urllib3.exceptions.HTTPError, NetworkError, ConnectionError,
+                           socket.timeout))
+
+
+def acceptsRanges(headers):
+    # ranges of an encoded body refer to the encoded bytes, so they are of no use here
+    return headers.get('Accept-Ranges', '').lower() == 'bytes' and \
+        'Content-Encoding' not in headers
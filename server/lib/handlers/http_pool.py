@@ -0,0 +1,100 @@
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ... import constants
+
+
+class _PooledSession:
+    def __init__(self, session, adapter):
+        self.session = session
+        self.adapter = adapter
+        self.lastUsed = time.time()
+
+    def getConnectionCount(self):
+        count = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                count += pool.num_connections
+        return count
+
+
+class HttpSessionPool:
+    """
+    A process-wide set of requests sessions, one per (scheme, host), shared by all HTTP
+    transfers. Sharing sessions allows connections (and the DNS/TCP/TLS setup that goes
+    with them) to be reused by consecutive transfers from the same host. Sessions that
+    are not used for longer than the configured idle timeout are closed.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.requestCounts = {}
+        self.retiredConnectionCounts = {}
+
+    def getSession(self, url):
+        parsed = urllib.parse.urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        idleTimeout = float(self.settings.get(constants.PluginSettings.HTTP_POOL_IDLE_TIMEOUT))
+        with self.lock:
+            self._closeIdleSessions(idleTimeout)
+            pooled = self.sessions.get(key)
+            if pooled is None:
+                pooled = self._createSession(key)
+                self.sessions[key] = pooled
+            pooled.lastUsed = time.time()
+            return pooled.session
+
+    def _createSession(self, key):
+        poolSize = int(self.settings.get(constants.PluginSettings.HTTP_POOL_SIZE))
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.hooks['response'].append(lambda resp, *args, **kwargs: self._countRequest(key))
+        return _PooledSession(session, adapter)
+
+    def _countRequest(self, key):
+        with self.lock:
+            self.requestCounts[key] = self.requestCounts.get(key, 0) + 1
+
+    def _closeIdleSessions(self, idleTimeout):
+        # Closing a session only closes idle connections; responses that are still being
+        # read keep their connection until they are done, so this is safe to do while
+        # transfers are running
+        now = time.time()
+        for key, pooled in list(self.sessions.items()):
+            if now - pooled.lastUsed > idleTimeout:
+                self._retire(key, pooled)
+
+    def _retire(self, key, pooled):
+        self.retiredConnectionCounts[key] = \
+            self.retiredConnectionCounts.get(key, 0) + pooled.getConnectionCount()
+        del self.sessions[key]
+        pooled.session.close()
+
+    def getStats(self):
+        """
+        Returns, for each host, the number of requests made, the number of connections
+        opened to serve them and the number of requests that reused an existing connection.
+        """
+        with self.lock:
+            stats = {}
+            for key, requestCount in self.requestCounts.items():
+                connectionCount = self.retiredConnectionCounts.get(key, 0)
+                if key in self.sessions:
+                    connectionCount += self.sessions[key].getConnectionCount()
+                stats['%s://%s' % key] = {
+                    'requests': requestCount,
+                    'connections': connectionCount,
+                    'reused': max(requestCount - connectionCount, 0),
+                    'open': key in self.sessions
+                }
+            return stats
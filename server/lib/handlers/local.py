@@ -1,8 +1,20 @@
+import errno
+import fcntl
+import os
 from urllib.parse import urlparse
 from .common import FileLikeUrlTransferHandler
 
+# errors indicating that a kernel copy mechanism cannot be used for a pair of files,
+# in which case the next one is tried
+_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY}
+
 
 class Local(FileLikeUrlTransferHandler):
+    # ioctl request used to clone (reflink) a file on filesystems such as btrfs or XFS
+    FICLONE = 0x40049409
+    # size of the kernel copies; progress is reported after each one
+    COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
     def __init__(self, url, transferId, itemId, psPath, user, transferManager):
         FileLikeUrlTransferHandler.__init__(self, url, transferId, itemId, psPath, user,
                                             transferManager)
@@ -10,3 +22,70 @@ class Local(FileLikeUrlTransferHandler):
     def openInputStream(self):
         parsedUrl = urlparse(self.url)
         return open(parsedUrl.path, 'rb')
+
+    def transfer(self):
+        # The data is copied by the kernel if possible, so that it does not have to go
+        # through this process. If none of the kernel mechanisms work, the buffered copy
+        # takes over from wherever they stopped.
+        self.transferManager.transferProgress(self.transferId, self.flen, 0)
+        self.mkdirs()
+        self.start_checksum()
+        # the output is readable, so that the checksum can be computed from it
+        with open(self.psPath, 'w+b') as outf, self.openInputStream() as inf:
+            if self.clone(inf.fileno(), outf.fileno()):
+                # nothing is copied, so there is nothing to throttle
+                crt = os.fstat(outf.fileno()).st_size
+                self.copied(outf.fileno(), crt, 0)
+            else:
+                crt = self.copyFileRange(inf.fileno(), outf.fileno(), 0)
+                crt = self.sendfile(inf.fileno(), outf.fileno(), crt)
+                inf.seek(crt)
+                outf.seek(crt)
+                self.transferBytes(outf, inf, crt)
+        self.verify_checksum()
+
+    def clone(self, infd, outfd):
+        try:
+            fcntl.ioctl(outfd, Local.FICLONE, infd)
+            return True
+        except OSError as ex:
+            if ex.errno not in _UNSUPPORTED:
+                raise
+            return False
+
+    def copyFileRange(self, infd, outfd, crt):
+        if not hasattr(os, 'copy_file_range'):
+            return crt
+        try:
+            while True:
+                n = os.copy_file_range(infd, outfd, Local.COPY_CHUNK_SIZE, crt, crt)
+                if n == 0:
+                    return crt
+                crt += n
+                self.copied(outfd, crt, n)
+        except OSError as ex:
+            if ex.errno not in _UNSUPPORTED:
+                raise
+            return crt
+
+    def sendfile(self, infd, outfd, crt):
+        os.lseek(outfd, crt, os.SEEK_SET)
+        try:
+            while True:
+                n = os.sendfile(outfd, infd, crt, Local.COPY_CHUNK_SIZE)
+                if n == 0:
+                    return crt
+                crt += n
+                self.copied(outfd, crt, n)
+        except OSError as ex:
+            if ex.errno not in _UNSUPPORTED:
+                raise
+            return crt
+
+    def copied(self, outfd, crt, n):
+        if self.checksum is not None:
+            # the data was just written, so this should mostly hit the page cache
+            self.checksum.catchUp(outfd, crt)
+        self.bytesCommitted(crt)
+        self.updateTransferProgress(self.flen, crt)
+        self.throttle(n)
@@ -0,0 +1,146 @@
+import json
+import os
+
+
+class ByteRanges:
+    """
+    A set of disjoint [start, end) byte ranges, kept sorted and merged.
+    """
+
+    def __init__(self, ranges=None):
+        self.ranges = []
+        for start, end in ranges or []:
+            self.add(start, end)
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        result = []
+        for s, e in self.ranges:
+            if e < start or s > end:
+                result.append([s, e])
+            else:
+                # overlapping or adjacent; merge
+                start = min(start, s)
+                end = max(end, e)
+        result.append([start, end])
+        result.sort()
+        self.ranges = result
+
+    def size(self):
+        return sum(e - s for s, e in self.ranges)
+
+    def missing(self, size):
+        """
+        Returns the list of [start, end) ranges in [0, size) that are not in this set.
+        """
+        result = []
+        crt = 0
+        for s, e in self.ranges:
+            if s > crt:
+                result.append([crt, min(s, size)])
+            crt = max(crt, e)
+        if crt < size:
+            result.append([crt, size])
+        return result
+
+    def prefixEnd(self):
+        """
+        Returns the end of the range starting at zero, that is, the number of bytes that
+        are available without gaps from the beginning of the file.
+        """
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    def toList(self):
+        return [list(r) for r in self.ranges]
+
+
+def getValidator(headers):
+    """
+    Returns the part of a set of HTTP response headers that can be used to check whether
+    a resource has changed, or None if the response does not contain such information.
+    Weak ETags are ignored since they cannot be used with range requests.
+    """
+    validator = {}
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        validator['etag'] = etag
+    lastModified = headers.get('Last-Modified')
+    if lastModified:
+        validator['lastModified'] = lastModified
+    return validator or None
+
+
+class ResumeRecord:
+    """
+    Keeps track of the parts of a file that were transferred, together with the
+    validator of the source at the time of the transfer. The record is stored next to
+    the partial file, so that a transfer that is interrupted by a restart or a temporary
+    failure can be continued from where it left off.
+    """
+    SUFFIX = '.resume'
+
+    def __init__(self, psPath, url, size, validator, done=None):
+        self.psPath = psPath
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.done = done or ByteRanges()
+
+    @staticmethod
+    def getPath(psPath):
+        return psPath + ResumeRecord.SUFFIX
+
+    @staticmethod
+    def load(psPath):
+        if not os.path.exists(psPath):
+            return None
+        try:
+            with open(ResumeRecord.getPath(psPath)) as f:
+                data = json.load(f)
+            return ResumeRecord(psPath, data['url'], data['size'], data['validator'],
+                                ByteRanges(data['done']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def discard(psPath):
+        try:
+            os.remove(ResumeRecord.getPath(psPath))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def discardPartial(psPath):
+        """
+        Removes the partial file of a transfer that will not be resumed, together with its
+        record.
+        """
+        ResumeRecord.discard(psPath)
+        try:
+            os.remove(psPath)
+        except FileNotFoundError:
+            pass
+
+    def isFor(self, url, size):
+        return self.url == url and self.size == size
+
+    def canResume(self, validator):
+        return self.validator is not None and self.validator == validator
+
+    def save(self):
+        if self.validator is None:
+            # there would be no way to tell if the partial data is still valid
+            return
+        path = ResumeRecord.getPath(self.psPath)
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump({
+                'url': self.url,
+                'size': self.size,
+                'validator': self.validator,
+                'done': self.done.toList()
+            }, f)
+        os.replace(tmpPath, path)
@@ -0,0 +1,280 @@
+import collections
+import io
+import struct
+import threading
+import time
+import zipfile
+
+from ... import constants
+from ..tm_utils import TransferException, NetworkError
+from .http import Http, isTemporaryError
+
+
+# local file header; see the ZIP specification, section 4.3.7
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\003\004'
+LOCAL_HEADER_NAME_LENGTH = 10
+LOCAL_HEADER_EXTRA_LENGTH = 11
+
+
+class HttpRangeFile(io.RawIOBase):
+    """
+    A read-only, seekable file backed by HTTP range requests. Reads are not buffered
+    and each read results in a request, so this should normally be wrapped in an
+    io.BufferedReader.
+    """
+
+    def __init__(self, sessionPool, url, headers=None):
+        io.RawIOBase.__init__(self)
+        # the file may outlive a session, so get one from the pool for each request
+        self.sessionPool = sessionPool
+        self.url = url
+        self.headers = headers or {}
+        self.pos = 0
+        resp = self.sessionPool.getSession(url).head(url, headers=self.headers,
+                                                     allow_redirects=True)
+        resp.raise_for_status()
+        self.size = int(resp.headers['Content-Length'])
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            raise ValueError('Invalid whence: %s' % whence)
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.size or len(b) == 0:
+            return 0
+        end = min(self.pos + len(b), self.size) - 1
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes=%s-%s' % (self.pos, end)
+        resp = self.sessionPool.getSession(self.url).get(self.url, headers=headers)
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            raise IOError('Server does not support range requests for %s' % self.url)
+        data = resp.content
+        n = len(data)
+        b[:n] = data
+        self.pos += n
+        return n
+
+
+class ZipDirectoryCache:
+    """
+    Keeps the parsed central directories of the most recently used remote zip archives,
+    so that transferring many members of an archive does not require downloading and
+    parsing its central directory each time. The number of archives that are kept is
+    given by the dm.zip_cache_size setting.
+    """
+
+    # size of the range requests made when reading central directories
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, settings, sessionPool):
+        self.settings = settings
+        self.sessionPool = sessionPool
+        self.archives = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url, headers):
+        # credentials may give access to different versions of a resource
+        key = (url, tuple(sorted(headers.items())))
+        with self.lock:
+            zf = self.archives.get(key)
+            if zf is not None:
+                self.archives.move_to_end(key)
+                self.hits += 1
+                return zf
+            self.misses += 1
+        # Parsing requires a few round trips, so do not hold the lock. Concurrent
+        # misses for the same archive may parse it more than once, which is harmless.
+        zf = self._open(url, headers)
+        size = int(self.settings.get(constants.PluginSettings.ZIP_CACHE_SIZE))
+        with self.lock:
+            self.archives[key] = zf
+            self.archives.move_to_end(key)
+            while len(self.archives) > max(size, 0):
+                self.archives.popitem(last=False)
+        return zf
+
+    def _open(self, url, headers):
+        raw = HttpRangeFile(self.sessionPool, url, headers=headers)
+        return zipfile.ZipFile(io.BufferedReader(raw, buffer_size=ZipDirectoryCache.READ_SIZE))
+
+    def getStats(self):
+        with self.lock:
+            return {'archives': len(self.archives), 'hits': self.hits, 'misses': self.misses}
+
+
+class _ForwardReader:
+    """
+    Reads a response to a range request that starts at a given offset in a file, while
+    keeping track of the position in the file. Only moving forward is possible.
+    """
+
+    def __init__(self, resp, start):
+        self.raw = resp.raw
+        self.pos = start
+
+    def seekable(self):
+        return False
+
+    def read(self, n):
+        data = self.raw.read(n, decode_content=False)
+        self.pos += len(data)
+        return data
+
+    def skipTo(self, offset):
+        if offset < self.pos:
+            raise IOError('Cannot move back from %s to %s' % (self.pos, offset))
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, ZipBatcher.SKIP_SIZE)):
+                raise NetworkError('Premature end of archive data at %s' % self.pos)
+
+    def readExactly(self, n):
+        data = self.read(n)
+        if len(data) != n:
+            raise NetworkError('Premature end of archive data at %s' % self.pos)
+        return data
+
+
+class ZipBatcher:
+    """
+    Transfers members of remote zip archives. Members of an archive that are requested
+    within COALESCE_WINDOW seconds of each other are extracted together, in the order
+    in which they appear in the archive, using as few range requests as possible. A
+    new request is only made when the gap between two requested members is larger
+    than MAX_GAP. The first member of a batch only waits for others if members of the
+    same archive are queued.
+
+    The first handler of a batch does the work for all of them. The others return
+    immediately and their transfers are completed by the first one.
+    """
+    COALESCE_WINDOW = 0.5
+    MAX_GAP = 4 * 1024 * 1024
+    SKIP_SIZE = 1024 * 1024
+
+    def __init__(self, directoryCache, sessionPool):
+        self.directoryCache = directoryCache
+        self.sessionPool = sessionPool
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def transfer(self, url, headers, handler):
+        key = self._getKey(url, headers)
+        with self.lock:
+            batch = self.pending.get(key)
+            if batch is not None:
+                batch.append(handler)
+                return
+            batch = [handler]
+            self.pending[key] = batch
+        if self._hasQueuedMembers(key, handler):
+            time.sleep(ZipBatcher.COALESCE_WINDOW)
+        with self.lock:
+            del self.pending[key]
+        self._extract(url, headers, batch)
+
+    def _getKey(self, url, headers):
+        return (url, tuple(sorted(headers.items())))
+
+    def _hasQueuedMembers(self, key, handler):
+        # Members of the archive that are waiting for a worker join the batch when they
+        # start. If there are none, waiting would only delay this transfer.
+        def isMember(other):
+            if not isinstance(other, Http) or not other.isZipMember():
+                return False
+            return self._getKey(other.getArchiveUrl(), other.headers) == key
+
+        return handler.transferManager.scheduler.isQueued(isMember)
+
+    def _extract(self, url, headers, batch):
+        try:
+            zf = self.directoryCache.get(url, headers)
+        except Exception as ex:  # noqa
+            for handler in batch:
+                self._failed(handler, ex)
+            return
+        members = []
+        for handler in batch:
+            try:
+                members.append((zf.getinfo(handler.getZipMemberPath()), handler))
+            except KeyError as ex:
+                self._failed(handler, TransferException(
+                    message='No such archive member: %s' % handler.getZipMemberPath(),
+                    cause=ex, fatal=True))
+        members.sort(key=lambda member: member[0].header_offset)
+        for start, end, span in self._getSpans(zf, members):
+            self._extractSpan(url, headers, start, end, span)
+
+    def _getSpans(self, zf, members):
+        # a member ends where the next one (or the central directory) starts
+        offsets = sorted(info.header_offset for info in zf.infolist()) + [zf.start_dir]
+        nextOffset = {offsets[i]: offsets[i + 1] for i in range(len(offsets) - 1)}
+        spans = []
+        for info, handler in members:
+            end = nextOffset[info.header_offset]
+            if spans and info.header_offset - spans[-1][1] <= ZipBatcher.MAX_GAP:
+                spans[-1][1] = max(spans[-1][1], end)
+                spans[-1][2].append((info, handler))
+            else:
+                spans.append([info.header_offset, end, [(info, handler)]])
+        return spans
+
+    def _extractSpan(self, url, headers, start, end, span):
+        remaining = list(span)
+        try:
+            requestHeaders = dict(headers)
+            requestHeaders['Range'] = 'bytes=%s-%s' % (start, end - 1)
+            session = self.sessionPool.getSession(url)
+            with session.get(url, headers=requestHeaders, stream=True) as resp:
+                resp.raise_for_status()
+                if resp.status_code != 206:
+                    raise IOError('Server did not honor range request for %s' % url)
+                reader = _ForwardReader(resp, start)
+                while remaining:
+                    info, handler = remaining.pop(0)
+                    try:
+                        if info.flag_bits & 0x1:
+                            raise TransferException(
+                                message='Encrypted archive members are not supported',
+                                fatal=True)
+                        reader.skipTo(info.header_offset)
+                        self._skipLocalHeader(reader)
+                        handler.extractMember(zipfile.ZipExtFile(reader, 'r', info))
+                    except Exception as ex:  # noqa
+                        # if the problem is with the connection, the next members fail too
+                        self._failed(handler, ex)
+                    else:
+                        handler.transferManager.transferCompleted(handler.transferId, handler)
+        except Exception as ex:  # noqa
+            for info, handler in remaining:
+                self._failed(handler, ex)
+
+    def _skipLocalHeader(self, reader):
+        header = LOCAL_HEADER.unpack(reader.readExactly(LOCAL_HEADER.size))
+        if header[0] != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile('Bad local file header at %s' % reader.pos)
+        reader.readExactly(header[LOCAL_HEADER_NAME_LENGTH] + header[LOCAL_HEADER_EXTRA_LENGTH])
+
+    def _failed(self, handler, ex):
+        if not isinstance(ex, TransferException):
+            # a corrupt archive or an unsupported compression method is also permanent
+            ex = TransferException(message=str(ex), cause=ex, fatal=not isTemporaryError(ex))
+        handler.transferManager.transferFailed(handler.transferId, handler, ex)
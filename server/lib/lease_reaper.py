@@ -0,0 +1,38 @@
+import time
+from threading import Thread
+
+from girder import logger
+
+from ..constants import PluginSettings
+
+
+class LeaseReaper(Thread):
+    """
+    Periodically releases the locks whose lease has expired, e.g., because the client
+    that held them stopped sending heartbeats. Does nothing while leases are disabled.
+    """
+    MAX_INTERVAL = 60
+
+    def __init__(self, settings, lockModel):
+        Thread.__init__(self, name='DM Lease Reaper')
+        self.daemon = True
+        self.settings = settings
+        self.lockModel = lockModel
+
+    def getInterval(self):
+        duration = float(self.settings.get(PluginSettings.LOCK_LEASE_DURATION))
+        if duration <= 0:
+            return LeaseReaper.MAX_INTERVAL
+        # expired locks are released at most a quarter of a lease late
+        return min(max(duration / 4, 1), LeaseReaper.MAX_INTERVAL)
+
+    def run(self):
+        while True:
+            time.sleep(self.getInterval())
+            try:
+                if float(self.settings.get(PluginSettings.LOCK_LEASE_DURATION)) > 0:
+                    count = self.lockModel.releaseExpiredLocks()
+                    if count > 0:
+                        logger.info('Released %s expired locks' % count)
+            except Exception:  # noqa
+                logger.error('Failed to release expired locks', exc_info=1)
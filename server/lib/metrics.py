@@ -0,0 +1,192 @@
+import bisect
+import threading
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        # values by tuple of label values
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelNames)
+
+    def _formatLabels(self, key, extra=()):
+        pairs = list(zip(self.labelNames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.TYPE)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            lines.extend(self._renderValue(key, value))
+        return lines
+
+    def _renderValue(self, key, value):
+        return ['%s%s %s' % (self.name, self._formatLabels(key), _formatNumber(value))]
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        # for counts that are kept elsewhere, e.g., by the HTTP connection pool
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """
+    A histogram with fixed bucket boundaries. Each observation only increments the count
+    of the bucket it falls in; the cumulative counts are computed when rendering.
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, buckets, labelNames=()):
+        _Metric.__init__(self, name, help, labelNames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, count=1, **labels):
+        # count is the number of identical observations, e.g., for the items of a batch
+        index = bisect.bisect_left(self.buckets, value)
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # counts (including one for +Inf), sum
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+            state[0][index] += count
+            state[1] += value * count
+
+    def _renderValue(self, key, state):
+        counts, total = state
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], counts):
+            cumulative += count
+            le = bound if bound == '+Inf' else _formatNumber(bound)
+            lines.append('%s_bucket%s %s' % (self.name, self._formatLabels(key, [('le', le)]),
+                                             cumulative))
+        lines.append('%s_sum%s %s' % (self.name, self._formatLabels(key), _formatNumber(total)))
+        lines.append('%s_count%s %s' % (self.name, self._formatLabels(key), cumulative))
+        return lines
+
+
+class MetricRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labelNames=()):
+        return self._add(Counter(name, help, labelNames))
+
+    def gauge(self, name, help, labelNames=()):
+        return self._add(Gauge(name, help, labelNames))
+
+    def histogram(self, name, help, buckets, labelNames=()):
+        return self._add(Histogram(name, help, buckets, labelNames))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _formatNumber(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# in seconds, from a millisecond to an hour
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+                   300, 900, 3600]
+# in bytes per second, from 64KB/s to 4GB/s
+THROUGHPUT_BUCKETS = [64 * 1024 * 4 ** i for i in range(9)]
+
+
+class Metrics:
+    """
+    The in-memory metrics of this process, exposed at GET /dm/metrics.
+    """
+    registry = MetricRegistry()
+
+    transfers = registry.counter(
+        'dm_transfers_total', 'Finished transfers, by handler and outcome',
+        ['handler', 'outcome'])
+    transferBytes = registry.counter(
+        'dm_transfer_bytes_total', 'Bytes transferred by completed transfers', ['handler'])
+    transferThroughput = registry.histogram(
+        'dm_transfer_throughput_bytes_per_second',
+        'Throughput of completed transfers, from the time they started running',
+        THROUGHPUT_BUCKETS, ['handler'])
+    transferQueueWait = registry.histogram(
+        'dm_transfer_queue_wait_seconds', 'Time spent by transfers waiting to start',
+        LATENCY_BUCKETS, ['scheme'])
+    timeToCached = registry.histogram(
+        'dm_time_to_cached_seconds',
+        'Time from scheduling a transfer to the item being cached', LATENCY_BUCKETS,
+        ['handler'])
+    transfersQueued = registry.gauge(
+        'dm_transfers_queued', 'Transfers waiting to start')
+    transfersRunning = registry.gauge(
+        'dm_transfers_running', 'Transfers running')
+
+    lockAcquireLatency = registry.histogram(
+        'dm_lock_acquire_seconds', 'Time taken to acquire a lock', LATENCY_BUCKETS)
+    lockAcquisitions = registry.counter(
+        'dm_lock_acquisitions_total',
+        'Locks acquired, by whether the item was cached (hit), a transfer was started (miss) '
+        'or a transfer was already in progress (pending)', ['result'])
+
+    gcRuns = registry.counter('dm_gc_runs_total', 'Runs of the file garbage collector')
+    gcDuration = registry.histogram(
+        'dm_gc_duration_seconds', 'Duration of file garbage collector runs', LATENCY_BUCKETS)
+    gcEvictedFiles = registry.counter(
+        'dm_gc_evicted_files_total', 'Cached files evicted by the garbage collector')
+    gcEvictedBytes = registry.counter(
+        'dm_gc_evicted_bytes_total', 'Bytes freed by the garbage collector')
+
+    httpPoolRequests = registry.counter(
+        'dm_http_pool_requests_total', 'HTTP requests made, by host', ['host'])
+    httpPoolConnections = registry.counter(
+        'dm_http_pool_connections_total', 'HTTP connections opened, by host', ['host'])
+    zipCacheLookups = registry.counter(
+        'dm_zip_cache_lookups_total', 'Lookups of zip archive central directories',
+        ['result'])
+    zipCacheArchives = registry.gauge(
+        'dm_zip_cache_archives', 'Zip archive central directories in the cache')
+    transferProcesses = registry.gauge(
+        'dm_transfer_processes', 'Transfer processes, by state', ['state'])
@@ -0,0 +1,126 @@
+import threading
+import time
+
+from girder import logger
+from pymongo.errors import OperationFailure, PyMongoError
+
+
+class _Entry:
+    def __init__(self):
+        self.condition = threading.Condition()
+        # incremented by each notification, so that waiters can tell whether they missed one
+        self.generation = 0
+        self.waiters = 0
+
+
+class KeyedNotifier:
+    """
+    Lets threads wait for something to happen to a given key, e.g., an item ID, and other
+    threads tell them that it may have happened. All threads waiting on a key are woken
+    by a single notification. Only keys that are waited on take any memory.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def waitFor(self, key, check, timeout=None, interval=None, maxInterval=None):
+        """
+        Calls check() until it returns something other than None, and returns that. The
+        check is repeated whenever notify() is called for the key and, if interval is
+        set, at least every interval seconds, which covers changes made by processes
+        that do not notify this one. If maxInterval is set, the interval doubles after
+        each check, up to maxInterval. Returns None if timeout seconds pass first.
+        """
+        entry = self._addWaiter(key)
+        try:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                with entry.condition:
+                    generation = entry.generation
+                result = check()
+                if result is not None:
+                    return result
+                wait = interval
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                with entry.condition:
+                    # a notification between the check and here must not be lost
+                    if entry.generation == generation:
+                        entry.condition.wait(wait)
+                if interval is not None and maxInterval is not None:
+                    interval = min(interval * 2, maxInterval)
+        finally:
+            self._removeWaiter(key, entry)
+
+    def notify(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            with entry.condition:
+                entry.generation += 1
+                entry.condition.notify_all()
+
+    def getWaiterCount(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return 0 if entry is None else entry.waiters
+
+    def _addWaiter(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = _Entry()
+            entry.waiters += 1
+            return entry
+
+    def _removeWaiter(self, key, entry):
+        with self.lock:
+            entry.waiters -= 1
+            if entry.waiters == 0:
+                del self.entries[key]
+
+
+class ChangeStreamListener(threading.Thread):
+    """
+    Calls notifier.notify(str(id)) whenever a document of a collection is updated by any
+    process in a way that sets a given (dotted) field. This uses a MongoDB change stream,
+    which requires MongoDB to run as a replica set; otherwise, the listener logs an error
+    and stops.
+    """
+    RETRY_INTERVAL = 10
+
+    def __init__(self, collection, field, notifier):
+        threading.Thread.__init__(self, name='DM Change Stream Listener')
+        self.daemon = True
+        self.collection = collection
+        self.field = field
+        self.notifier = notifier
+
+    def getPipeline(self):
+        # the names of updated fields are dotted paths, which $match cannot address
+        return [{'$match': {
+            'operationType': 'update',
+            '$expr': {'$in': [self.field, {'$map': {
+                'input': {'$objectToArray': '$updateDescription.updatedFields'},
+                'in': '$$this.k'
+            }}]}
+        }}]
+
+    def run(self):
+        while True:
+            try:
+                with self.collection.watch(self.getPipeline()) as stream:
+                    for change in stream:
+                        self.notifier.notify(str(change['documentKey']['_id']))
+            except OperationFailure:
+                logger.error('Cannot watch %s for changes to %s' %
+                             (self.collection.name, self.field), exc_info=1)
+                return
+            except PyMongoError:
+                logger.warning('Change stream on %s interrupted' % self.collection.name,
+                               exc_info=1)
+                time.sleep(ChangeStreamListener.RETRY_INTERVAL)
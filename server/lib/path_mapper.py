@@ -9,3 +9,7 @@ class PathMapper:
         root = self.settings.get(constants.PluginSettings.PRIVATE_STORAGE_PATH)
         sItemId = str(itemId)
         return root + '/' + sItemId[0] + '/' + sItemId[1] + '/' + sItemId
+
+    def getBlobPath(self, alg, digest):
+        root = self.settings.get(constants.PluginSettings.PRIVATE_STORAGE_PATH)
+        return root + '/blobs/' + alg + '/' + digest[0:2] + '/' + digest[2:4] + '/' + digest
@@ -0,0 +1,25 @@
+# The entry point of transfer processes, which TransferProcessPool runs with
+# runpy.run_path() in a fresh interpreter. Girder loads plugins from their directories
+# rather than importing them, so the packages of the plugins have to be set up before any
+# of their modules can be imported. Only the packages are created; the __init__ modules
+# of the plugins, which set up the server, are not run.
+import sys
+import types
+
+import girder.plugins
+
+
+def registerPlugins(plugins):
+    for name, path in plugins.items():
+        if name not in sys.modules:
+            module = types.ModuleType(name)
+            module.__path__ = path
+            sys.modules[name] = module
+            setattr(girder.plugins, name.rpartition('.')[2], module)
+
+
+if __name__ == '__dm_transfer_process__':
+    # plugins and conn are passed by the pool
+    registerPlugins(plugins)  # noqa: F821
+    from girder.plugins.wt_data_manager.lib.process_pool import processMain
+    processMain(conn)  # noqa: F821
@@ -0,0 +1,216 @@
+import multiprocessing
+import os
+import queue
+import runpy
+import sys
+import threading
+import time
+import traceback
+
+from girder import logger
+
+from ..constants import PluginSettings
+from .blob_store import BlobStore
+from .handlers.http import Http
+from .handlers.http_pool import HttpSessionPool
+from .handlers.local import Local
+from .tm_utils import TransferException
+
+
+class TransferProcessPool:
+    """
+    Runs HTTP and local transfers in a fixed pool of worker processes, so that hashing,
+    decoding and decompression do not compete with request threads for the GIL of the
+    server process. Each process runs one transfer at a time. The transfer manager still
+    runs the transfer on one of its worker threads, which sends the handler to an idle
+    process and then relays the progress of the transfer back to the transfer manager
+    until the process reports the outcome. Everything that needs the database, such as
+    updating the transfer collection and triggering events, happens in this process.
+
+    The processes are started when the pool is created and replaced when they die. They
+    are forked from a forkserver, a separate process started from scratch, and not from
+    this process, since a process forked from a threaded one can deadlock on locks (e.g.,
+    of the logging module or of pymongo) held by threads at the time of the fork. The
+    processes therefore start with nothing imported; see process_main.py.
+    """
+    MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process_main.py')
+
+    def __init__(self, count):
+        self.count = count
+        self.context = multiprocessing.get_context('forkserver')
+        self.idle = queue.Queue()
+        for i in range(count):
+            self.idle.put(self._start())
+
+    def _start(self):
+        parentConn, childConn = self.context.Pipe()
+        process = self.context.Process(
+            target=runpy.run_path, args=(TransferProcessPool.MAIN_PATH,),
+            kwargs={'init_globals': {'conn': childConn, 'plugins': _getPluginPaths()},
+                    'run_name': '__dm_transfer_process__'},
+            name='DM Transfer Process', daemon=True)
+        process.start()
+        childConn.close()
+        return _WorkerProcess(process, parentConn)
+
+    def accepts(self, handler):
+        if isinstance(handler, Http):
+            # archive members are extracted in batches shared between handlers
+            return not handler.isZipMember()
+        return isinstance(handler, Local)
+
+    def run(self, handler, transferManager):
+        worker = self.idle.get()
+        if not worker.process.is_alive():
+            logger.warning('Transfer process %s exited; starting a new one' % worker.process.pid)
+            worker.stop()
+            worker = self._start()
+        try:
+            outcome = worker.run(handler, transferManager)
+        except Exception as ex:  # noqa
+            # the process died or is in an unknown state
+            logger.warning('Transfer process failed; starting a new one: %r' % ex)
+            worker.stop()
+            worker = self._start()
+            message = 'Transfer process failed: %r' % ex
+            raise TransferException(message=message, cause=IOError(message), fatal=False)
+        finally:
+            self.idle.put(worker)
+        if outcome[0] == 'failed':
+            raise _rebuildException(*outcome[1:])
+        for name, value in outcome[1].items():
+            setattr(handler, name, value)
+
+    def getStats(self):
+        return {'processes': self.count, 'idle': self.idle.qsize()}
+
+
+def _getPluginPaths():
+    # the packages of the loaded plugins, by module name
+    paths = {}
+    for name, module in list(sys.modules.items()):
+        if name.startswith('girder.plugins.') and name.count('.') == 2 and \
+                hasattr(module, '__path__'):
+            paths[name] = list(module.__path__)
+    return paths
+
+
+def _getSettings(settings):
+    # the current values of all settings of this plugin
+    return {value: settings.get(value) for name, value in vars(PluginSettings).items()
+            if not name.startswith('_')}
+
+
+def _rebuildException(message, causeMessage, fatal):
+    cause = None if causeMessage is None else Exception(causeMessage)
+    return TransferException(message=message, cause=cause, fatal=fatal)
+
+
+class _WorkerProcess:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+
+    def run(self, handler, transferManager):
+        self.conn.send((handler, _getSettings(transferManager.settings)))
+        while True:
+            message = self.conn.recv()
+            kind = message[0]
+            if kind == 'progress':
+                transferManager.transferProgress(handler.transferId, message[1], message[2])
+            elif kind == 'committed':
+                handler.bytesCommitted(message[1])
+            elif kind == 'reserve':
+                self.conn.send(transferManager.bandwidthLimiter.reserve(message[1],
+                                                                        message[2]))
+            else:
+                return message
+
+    def stop(self):
+        self.conn.close()
+        self.process.terminate()
+        self.process.join(1)
+
+
+class _Channel:
+    # handlers may send from several threads, e.g., for parallel range requests
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.conn.send(message)
+
+    def request(self, message):
+        with self.lock:
+            self.conn.send(message)
+            return self.conn.recv()
+
+
+class _ProcessWatermark:
+    def __init__(self, channel):
+        self.channel = channel
+
+    def advance(self, committed):
+        self.channel.send(('committed', committed))
+
+
+class _ProcessBandwidthLimiter:
+    def __init__(self, channel, settings):
+        self.channel = channel
+        self.settings = settings
+
+    def throttle(self, userId, n):
+        if float(self.settings.get(PluginSettings.BANDWIDTH_LIMIT)) <= 0 and \
+                float(self.settings.get(PluginSettings.USER_BANDWIDTH_LIMIT)) <= 0:
+            return
+        # the limits are shared with all transfers, so ask the server process
+        wait = self.channel.request(('reserve', userId, n))
+        if wait > 0:
+            time.sleep(wait)
+
+
+class _ProcessTransferManager:
+    """
+    What handlers see of the transfer manager when they run in a transfer process.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        # updated with the current settings for each transfer
+        self.settings = {}
+        self.httpSessionPool = HttpSessionPool(self.settings)
+        self.bandwidthLimiter = _ProcessBandwidthLimiter(channel, self.settings)
+        self.blobStore = BlobStore(self.settings, None)
+
+    def transferProgress(self, transferId, total, current):
+        self.channel.send(('progress', total, current))
+
+
+def processMain(conn):
+    channel = _Channel(conn)
+    transferManager = _ProcessTransferManager(channel)
+    while True:
+        try:
+            handler, settings = conn.recv()
+        except EOFError:
+            # the server process is gone
+            return
+        transferManager.settings.clear()
+        transferManager.settings.update(settings)
+        handler.transferManager = transferManager
+        handler.watermark = _ProcessWatermark(channel)
+        try:
+            handler.run()
+        except Exception as ex:  # noqa
+            traceback.print_exc()
+            if isinstance(ex, TransferException):
+                cause = ex.getCause()
+                conn.send(('failed', ex.getMessage(), None if cause is None else str(cause),
+                           ex.isFatal()))
+            else:
+                conn.send(('failed', str(ex), str(ex), True))
+        else:
+            conn.send(('done', {'verifiedChecksum': handler.getChecksum(),
+                                'digest': handler.getDigest()}))
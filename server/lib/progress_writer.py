@@ -0,0 +1,72 @@
+import threading
+import time
+
+from girder import logger
+
+from .. import constants
+from .tm_utils import Models
+
+
+class ProgressWriter(threading.Thread):
+    """
+    Collects the progress of running transfers and writes it to the transfer collection
+    in a single bulk operation every dm.transfer_progress_interval seconds, so that the
+    number of database writes does not grow with the number of concurrent transfers.
+    Only the latest progress of each transfer is written, together with the rate at
+    which the transfer progressed since the previous write. Status changes that matter,
+    such as a transfer finishing or failing, are still written immediately by the
+    transfer manager, and pending progress never overwrites them.
+    """
+
+    def __init__(self, settings):
+        threading.Thread.__init__(self, name='DM Transfer Progress Writer')
+        self.daemon = True
+        self.settings = settings
+        self.pending = {}
+        # transferId -> (time, size, transferred, rate) as of the last write
+        self.written = {}
+        self.lock = threading.Lock()
+        self.started = False
+
+    def update(self, transferId, size, transferred):
+        with self.lock:
+            self.pending[transferId] = (size, transferred)
+            if not self.started:
+                self.started = True
+                self.start()
+
+    def discard(self, transferId):
+        with self.lock:
+            self.pending.pop(transferId, None)
+            self.written.pop(transferId, None)
+
+    def run(self):
+        while True:
+            interval = float(self.settings.get(
+                constants.PluginSettings.TRANSFER_PROGRESS_INTERVAL))
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception:  # noqa
+                logger.error('Failed to write transfer progress', exc_info=1)
+
+    def flush(self):
+        now = time.time()
+        progress = {}
+        with self.lock:
+            for transferId, (size, transferred) in self.pending.items():
+                rate = 0
+                if transferId in self.written:
+                    lastTime, _, lastTransferred, _ = self.written[transferId]
+                    if now > lastTime:
+                        rate = max(transferred - lastTransferred, 0) / (now - lastTime)
+                progress[transferId] = (size, transferred, rate)
+            for transferId, (lastTime, size, transferred, rate) in self.written.items():
+                if transferId not in self.pending and rate != 0:
+                    # no progress since the last write
+                    progress[transferId] = (size, transferred, 0)
+            for transferId, (size, transferred, rate) in progress.items():
+                self.written[transferId] = (now, size, transferred, rate)
+            self.pending = {}
+        if progress:
+            Models.transferModel.setProgress(progress)
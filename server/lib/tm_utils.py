@@ -1,12 +1,26 @@
+import threading
+
 from girder.utility.model_importer import ModelImporter
 
 
+class _ModelAccessor:
+    # Models are only looked up when used, since creating them connects to the database,
+    # which transfer processes, which import handlers and hence this module, must not do
+    def __init__(self, name, plugin='_core'):
+        self.name = name
+        self.plugin = plugin
+
+    def __get__(self, instance, owner):
+        return ModelImporter.model(self.name, self.plugin)
+
+
 class Models:
-    itemModel = ModelImporter.model('item')
-    fileModel = ModelImporter.model('file')
-    userModel = ModelImporter.model('user')
-    transferModel = ModelImporter.model('transfer', 'wt_data_manager')
-    lockModel = ModelImporter.model('lock', 'wt_data_manager')
+    itemModel = _ModelAccessor('item')
+    fileModel = _ModelAccessor('file')
+    userModel = _ModelAccessor('user')
+    transferModel = _ModelAccessor('transfer', 'wt_data_manager')
+    lockModel = _ModelAccessor('lock', 'wt_data_manager')
+    blobModel = _ModelAccessor('blob', 'wt_data_manager')
 
 
 class TransferHandler:
@@ -22,6 +36,18 @@ class TransferHandler:
         self.flen = 0
         self.item = Models.itemModel.load(self.itemId, force=True)
         self.lastTransferred = 0
+        self.watermark = None
+        # set by the transfer manager, for metrics
+        self.scheduledTime = None
+        self.startTime = None
+
+    def __getstate__(self):
+        # handlers sent to a transfer process are given a transfer manager and a
+        # watermark that report back to this process
+        state = dict(self.__dict__)
+        state['transferManager'] = None
+        state['watermark'] = None
+        return state
 
     def _getFileFromItem(self):
         files = list(Models.itemModel.childFiles(item=self.item))
@@ -42,9 +68,54 @@ class TransferHandler:
     def getPhysicalPath(self):
         return self.psPath
 
+    def getChecksum(self):
+        """
+        Returns the verified checksum of the transferred file as a dictionary mapping
+        the hash algorithm to the hex digest, or None if the file was not verified.
+        """
+        return None
+
+    def getDigest(self):
+        """
+        Returns the digest of the transferred file as an (algorithm, hex digest) tuple if
+        it was computed during the transfer, or None otherwise.
+        """
+        return None
+
+    def getSourceKey(self):
+        """
+        Returns a key identifying the data this handler transfers, such that concurrent
+        transfers with the same key can share a single download, or None if the transfer
+        cannot be shared.
+        """
+        return None
+
+    def copyFrom(self, other):
+        """
+        Completes this transfer using the file transferred by a handler with the same
+        source key.
+        """
+        raise NotImplementedError()
+
+    def getSourceUrl(self):
+        """
+        Returns the URL this handler transfers from or None if the source cannot be
+        described by a URL. It is used to apply per-scheme and per-host limits.
+        """
+        return None
+
     def transfer(self):
         pass
 
+    def isAsynchronous(self):
+        """
+        Returns True if transfer() only starts the transfer, in which case the handler is
+        responsible for eventually calling transferCompleted() or transferFailed() on the
+        transfer manager. This allows transfers that are carried out by external services
+        to not hold a transfer worker.
+        """
+        return False
+
     def updateTransferProgress(self, size, transferred):
         # to avoid too many db requests, update only on:
         # - TRANSFER_UPDATE_MIN_CHUNK_SIZE AND
@@ -57,6 +128,23 @@ class TransferHandler:
             self.transferManager.transferProgress(self.transferId, total=size, current=transferred)
             self.lastTransferred = transferred
 
+    def throttle(self, n):
+        """
+        Should be called by handlers after moving n bytes. It waits for as long as needed
+        to keep the bandwidth used by transfers within the configured limits.
+        """
+        self.transferManager.bandwidthLimiter.throttle(self.user['_id'], n)
+
+    def bytesCommitted(self, end):
+        """
+        Should be called by handlers that write the file sequentially, or otherwise know
+        which part of it is complete, whenever the first end bytes of the file are written
+        and readable by other processes. This allows the file to be read before the
+        transfer is done.
+        """
+        if self.watermark is not None:
+            self.watermark.advance(end)
+
     def isManaged(self):
         """
         Returns True if this handler uses a managed transfer service. In principle,
@@ -68,6 +156,96 @@ class TransferHandler:
         return False
 
 
+class Watermark:
+    """
+    Tracks the number of bytes at the beginning of a file that is being transferred that
+    can be safely read. Readers can wait for a certain number of bytes to become available.
+    """
+
+    def __init__(self, psPath):
+        self.psPath = psPath
+        self.committed = 0
+        self.finished = False
+        self.error = None
+        self.condition = threading.Condition()
+        # watermarks of transfers that wait for this one to use its file
+        self.followers = []
+
+    def addFollower(self, follower):
+        """
+        Makes a watermark of a transfer that will use the file of this transfer follow
+        this one, so that its readers can read this file until that transfer completes.
+        """
+        with self.condition:
+            self.followers.append(follower)
+            follower.follow(self.psPath, self.committed)
+
+    def follow(self, psPath, committed):
+        with self.condition:
+            self.psPath = psPath
+            if committed > self.committed:
+                self.committed = committed
+            self.condition.notify_all()
+
+    def advance(self, committed):
+        with self.condition:
+            if committed > self.committed:
+                self.committed = committed
+                self.condition.notify_all()
+            followers = list(self.followers)
+        for follower in followers:
+            follower.advance(committed)
+
+    def finish(self, psPath=None):
+        # the file may be moved once the transfer is done
+        with self.condition:
+            if psPath is not None:
+                self.psPath = psPath
+            self.finished = True
+            self.condition.notify_all()
+            followers = list(self.followers)
+        # followers are finished when their own transfers complete
+        for follower in followers:
+            follower.follow(self.psPath, self.committed)
+
+    def fail(self, message):
+        with self.condition:
+            self.error = message
+            self.condition.notify_all()
+
+    def waitFor(self, end, timeout=None):
+        """
+        Waits until at least the first end bytes of the file can be read and returns the
+        number of bytes that can be read, or None if the transfer is finished and the
+        whole file can be read. Raises an IOError if the transfer fails first or if that
+        does not happen within timeout seconds.
+        """
+        def ready():
+            return self.committed >= end or self.finished or self.error is not None
+
+        with self.condition:
+            if not self.condition.wait_for(ready, timeout):
+                raise IOError('Transfer made no progress in %s seconds' % timeout)
+            if self.finished:
+                return None
+            if self.committed < end:
+                raise IOError('Transfer failed: %s' % self.error)
+            return self.committed
+
+
+class NetworkError(IOError):
+    """
+    Raised by handlers for connection problems that they detect themselves, e.g., a
+    response that ends early, so that they are not mistaken for local IO errors.
+    """
+
+
+def isTemporaryStatus(status):
+    # server errors, request timeouts and rate limiting; other errors will not go away
+    # by trying again
+    return status >= 500 or status in (408, 429)
+
+
 class TransferException(Exception):
     def __init__(self, message=None, cause=None, fatal=True):
         super().__init__(message)
@@ -1,31 +1,192 @@
-from ..constants import TransferStatus
+from .. import constants
+from ..constants import TransferStatus, TransferPriority
 from .handler_factory import HandlerFactory
-from .tm_utils import TransferHandler, Models, TransferException
+from .handlers.http_pool import HttpSessionPool
+from .handlers.partial import ResumeRecord
+from .handlers.zip import ZipDirectoryCache, ZipBatcher
+from .progress_writer import ProgressWriter
+from .bandwidth import BandwidthLimiter
+from .blob_store import BlobStore
+from .metrics import Metrics
+from .process_pool import TransferProcessPool
+from .tm_utils import TransferHandler, Models, TransferException, Watermark
+import collections
+import concurrent.futures
+import json
 import threading
 import os
+import time
 import traceback
+import urllib.parse
 from girder.utility import assetstore_utilities
 from girder.utility.model_importer import ModelImporter
 from girder.models.model_base import ValidationException
 from girder import events, logger
 
 
-class TransferThread(threading.Thread):
-    def __init__(self, itemId, transferId, transferHandler, transferManager):
-        threading.Thread.__init__(self, name='TransferThread[' + str(itemId) + ']')
-        self.daemon = True
+class ScheduledTransfer:
+    def __init__(self, itemId, transferId, transferHandler, priority=TransferPriority.NORMAL):
         self.itemId = itemId
         self.transferId = transferId
         self.transferHandler = transferHandler
-        self.transferManager = transferManager
+        self.priority = priority
+        url = transferHandler.getSourceUrl()
+        if url:
+            parsed = urllib.parse.urlparse(url)
+            # scheme-less URLs are interpreted as local paths by the handler factory
+            self.scheme = parsed.scheme or 'local'
+            self.host = parsed.netloc or None
+        else:
+            self.scheme = 'girder'
+            self.host = None
+        self.queuedTime = time.time()
+
+    def getSlots(self):
+        slots = [('scheme', self.scheme)]
+        if self.host is not None:
+            slots.append(('host', self.host))
+        return slots
+
+    def getEffectivePriority(self, now, agingInterval):
+        # A transfer is promoted by one priority class for every agingInterval seconds
+        # it spends in the queue, so that bulk transfers are not starved indefinitely
+        if agingInterval <= 0:
+            return self.priority
+        return self.priority - (now - self.queuedTime) / agingInterval
+
+
+class TransferWorker(threading.Thread):
+    def __init__(self, index, scheduler):
+        threading.Thread.__init__(self, name='DM Transfer Worker ' + str(index))
+        self.daemon = True
+        self.scheduler = scheduler
 
     def run(self):
+        while True:
+            entry = self.scheduler.take()
+            try:
+                self.runTransfer(entry)
+            finally:
+                self.scheduler.release(entry)
+
+    def runTransfer(self, entry):
+        transferManager = self.scheduler.transferManager
         try:
-            self.transferHandler.run()
-            self.transferManager.transferCompleted(self.transferId, self.transferHandler)
+            transferManager.runHandler(entry.transferHandler)
+            if not entry.transferHandler.isAsynchronous():
+                transferManager.transferCompleted(entry.transferId, entry.transferHandler)
         except Exception as ex:  # noqa
             traceback.print_exc()
-            self.transferManager.transferFailed(self.transferId, self.transferHandler, ex)
+            transferManager.transferFailed(entry.transferId, entry.transferHandler, ex)
+
+
+class TransferScheduler:
+    """
+    Runs transfers on a fixed pool of worker threads. Submitted transfers wait in a
+    queue (and in the QUEUED state in the transfer collection, which allows them to be
+    picked up again after a restart) until a worker is free and the concurrency limits
+    for their URL scheme and source host allow them to start. Among the transfers that
+    can start, the one with the best (lowest) aged priority is picked first.
+    """
+
+    def __init__(self, settings, transferManager):
+        self.settings = settings
+        self.transferManager = transferManager
+        self.queue = []
+        self.running = collections.Counter()
+        self.workers = []
+        self.cond = threading.Condition()
+
+    def submit(self, entry):
+        workerCount = int(self.settings.get(constants.PluginSettings.TRANSFER_WORKER_COUNT))
+        with self.cond:
+            self._ensureWorkers(workerCount)
+            self.queue.append(entry)
+            self.cond.notify()
+
+    def _ensureWorkers(self, count):
+        # the pool can only grow; shrinking it would require interrupting workers
+        while len(self.workers) < count:
+            worker = TransferWorker(len(self.workers), self)
+            self.workers.append(worker)
+            worker.start()
+
+    def take(self):
+        hostLimit, schemeLimits = self.getLimits()
+        # no aging if unset
+        agingInterval = float(self.settings.get(
+            constants.PluginSettings.TRANSFER_PRIORITY_AGING_INTERVAL) or 0)
+        with self.cond:
+            while True:
+                entry = self._pickEligible(hostLimit, schemeLimits, agingInterval)
+                if entry is not None:
+                    self.queue.remove(entry)
+                    for slot in entry.getSlots():
+                        self.running[slot] += 1
+                    entry.transferHandler.startTime = time.time()
+                    Metrics.transferQueueWait.observe(
+                        entry.transferHandler.startTime - entry.queuedTime, scheme=entry.scheme)
+                    return entry
+                self.cond.wait()
+
+    def release(self, entry):
+        with self.cond:
+            for slot in entry.getSlots():
+                self.running[slot] -= 1
+                if self.running[slot] <= 0:
+                    del self.running[slot]
+            self.cond.notify()
+
+    def _pickEligible(self, hostLimit, schemeLimits, agingInterval):
+        now = time.time()
+        best = None
+        bestKey = None
+        for entry in self.queue:
+            if not self._isEligible(entry, hostLimit, schemeLimits):
+                continue
+            key = (entry.getEffectivePriority(now, agingInterval), entry.queuedTime)
+            if best is None or key < bestKey:
+                best = entry
+                bestKey = key
+        return best
+
+    def _isEligible(self, entry, hostLimit, schemeLimits):
+        # a non-positive limit means that there is no limit
+        schemeLimit = schemeLimits.get(entry.scheme, 0)
+        if 0 < schemeLimit <= self.running[('scheme', entry.scheme)]:
+            return False
+        if entry.host is not None and 0 < hostLimit <= self.running[('host', entry.host)]:
+            return False
+        return True
+
+    def getLimits(self):
+        hostLimit = int(self.settings.get(constants.PluginSettings.TRANSFER_HOST_LIMIT))
+        schemeLimits = self.settings.get(constants.PluginSettings.TRANSFER_SCHEME_LIMITS)
+        if isinstance(schemeLimits, str):
+            schemeLimits = json.loads(schemeLimits)
+        return hostLimit, {scheme: int(limit) for scheme, limit in (schemeLimits or {}).items()}
+
+    def raisePriority(self, itemId, priority):
+        with self.cond:
+            for entry in self.queue:
+                if entry.itemId == itemId and priority < entry.priority:
+                    entry.priority = priority
+
+    def isQueued(self, predicate):
+        """
+        Returns True if the handler of any transfer waiting in the queue satisfies the
+        predicate.
+        """
+        with self.cond:
+            return any(predicate(entry.transferHandler) for entry in self.queue)
+
+    def getQueueLength(self):
+        with self.cond:
+            return len(self.queue)
+
+    def getRunningCount(self):
+        with self.cond:
+            return sum(count for slot, count in self.running.items() if slot[0] == 'scheme')
 
 
 class GirderDownloadTransferHandler(TransferHandler):
@@ -56,19 +217,47 @@ class GirderDownloadTransferHandler(TransferHandler):
             outf.write(chunk)
             crt = crt + len(chunk)
             self.updateTransferProgress(self.flen, crt)
+            outf.flush()
+            self.bytesCommitted(crt)
+            self.throttle(len(chunk))
 
 
 class TransferManager:
-    def __init__(self, settings, pathMapper):
+    # interrupted transfers of items that failed this many times in a row are not restarted
+    MAX_RESTART_ERRORS = 5
+    # threads that complete transfers that waited for a transfer of the same source
+    FOLLOWER_THREADS = 2
+
+    def __init__(self, settings, pathMapper, schedulerClass=TransferScheduler):
         self.settings = settings
         self.pathMapper = pathMapper
+        self.processPool = None
+        processCount = int(settings.get(constants.PluginSettings.TRANSFER_PROCESS_COUNT))
+        if processCount > 0:
+            self.processPool = TransferProcessPool(processCount)
         self.handlerFactory = HandlerFactory()
+        self.httpSessionPool = HttpSessionPool(settings)
+        self.zipDirectoryCache = ZipDirectoryCache(settings, self.httpSessionPool)
+        self.zipBatcher = ZipBatcher(self.zipDirectoryCache, self.httpSessionPool)
+        self.scheduler = schedulerClass(settings, self)
+        self.progressWriter = ProgressWriter(settings)
+        self.bandwidthLimiter = BandwidthLimiter(settings)
+        self.blobStore = BlobStore(settings, pathMapper)
+        # watermarks of transfers in progress, by item id
+        self.watermarks = {}
+        self.watermarksLock = threading.Lock()
+        # transfers in progress, by source key; see _scheduleTransfer()
+        self.flights = {}
+        self.flightsLock = threading.Lock()
+        self.followerExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=TransferManager.FOLLOWER_THREADS,
+            thread_name_prefix='DM Transfer Follower')
 
     def restartInterruptedTransfers(self):
         # transfers and item.dm.transferInProgress are not atomically
         # set, so use both to figure out what needs to be re-started
         activeTransfersFromItem = Models.lockModel.listDownloadingItems()
-        activeTransfers = Models.transferModel.listAll()
+        activeTransfers = Models.transferModel.listUnfinished()
 
         ids = set()
         data = []
@@ -78,38 +267,172 @@ class TransferManager:
             data.append({
                 'itemId': item['_id'],
                 'ownerId': item['dm']['transfer']['userId'],
-                'sessionId': item['dm']['transfer']['sessionId']
+                'sessionId': item['dm']['transfer']['sessionId'],
+                'priority': item['dm']['transfer'].get('priority', TransferPriority.NORMAL)
             })
         for transfer in activeTransfers:
             if not transfer['itemId'] in ids:
                 data.append(transfer)
 
         for item in data:
-            print('Restarting transfer for item ' + str(item))
             try:
+                if not self._checkRestart(item['itemId']):
+                    continue
+                logger.info('Restarting transfer for item %s' % item['itemId'])
                 user = self.getUser(item['ownerId'])
-                self.startTransfer(user, item['itemId'], item['sessionId'])
+                self.startTransfer(user, item['itemId'], item['sessionId'],
+                                   item.get('priority', TransferPriority.NORMAL))
             except Exception as ex:  # noqa
                 logger.warning('Failed to strart transfer for itemId %s. Reason: %s'
                                % (item['itemId'], str(ex)))
 
+    def _checkRestart(self, itemId):
+        """
+        Returns True if the interrupted transfer of an item should be restarted. Otherwise,
+        marks the transfer as failed and the item as no longer being transferred.
+        """
+        item = Models.itemModel.load(itemId, force=True, fields=['dm'])
+        if item is None:
+            # the item is gone; startTransfer() cleans up
+            return True
+        dm = item.get('dm', {})
+        errors = dm.get('errorCount', 0)
+        if dm.get('lockCount', 0) <= 0:
+            reason = 'Not restarted, since the item is no longer locked'
+            Models.lockModel.transferAbandoned(itemId)
+        elif errors >= TransferManager.MAX_RESTART_ERRORS:
+            reason = 'Not restarted after %s failed attempts' % errors
+            Models.lockModel.fileDownloadFailed(itemId, reason)
+        else:
+            return True
+        logger.info('Transfer for item %s: %s' % (itemId, reason))
+        Models.transferModel.failUnfinished(itemId, reason)
+        ResumeRecord.discardPartial(self.pathMapper.getPSPath(itemId))
+        return False
+
+    def runHandler(self, transferHandler):
+        if self.processPool is not None and self.processPool.accepts(transferHandler):
+            self.processPool.run(transferHandler, self)
+        else:
+            transferHandler.run()
+
     def getUser(self, userId):
         return Models.userModel.load(userId, force=True)
 
-    def startTransfer(self, user, itemId, sessionId):
+    def startTransfer(self, user, itemId, sessionId, priority=TransferPriority.NORMAL):
         pass
 
-    def _startTransferThread(self, itemId, transferId, transferHandler):
-        transferThread = TransferThread(itemId, transferId, transferHandler, self)
-        transferThread.start()
+    def raisePriority(self, itemId, priority):
+        self.scheduler.raisePriority(self._getLeaderItemId(itemId), priority)
+
+    def _getLeaderItemId(self, itemId):
+        # transfers waiting for a transfer of the same source are not in the scheduler
+        with self.flightsLock:
+            for flight in self.flights.values():
+                for followerId, follower in flight['followers']:
+                    if str(follower.getItemId()) == str(itemId):
+                        return flight['leader'].getItemId()
+        return itemId
+
+    def getWatermark(self, itemId):
+        """
+        Returns the watermark of the transfer in progress for an item, or None if the
+        item is not being transferred by this process.
+        """
+        with self.watermarksLock:
+            return self.watermarks.get(str(itemId))
+
+    def _releaseWatermark(self, transferHandler):
+        with self.watermarksLock:
+            key = str(transferHandler.getItemId())
+            if self.watermarks.get(key) is transferHandler.watermark:
+                del self.watermarks[key]
+
+    def _scheduleTransfer(self, itemId, transferId, transferHandler, priority):
+        transferHandler.scheduledTime = time.time()
+        transferHandler.watermark = Watermark(transferHandler.getPhysicalPath())
+        with self.watermarksLock:
+            self.watermarks[str(itemId)] = transferHandler.watermark
+        Models.transferModel.setStatus(transferId, TransferStatus.QUEUED)
+        # Transfers of the same source that is already being transferred wait for that
+        # transfer to finish and then use its result instead of downloading it again.
+        key = transferHandler.getSourceKey()
+        if key is not None:
+            with self.flightsLock:
+                flight = self.flights.get(key)
+                if flight is None:
+                    self.flights[key] = {'leader': transferHandler, 'followers': []}
+                else:
+                    flight['followers'].append((transferId, transferHandler))
+                    # readers of this item read the file of the leader in the meantime
+                    flight['leader'].watermark.addFollower(transferHandler.watermark)
+            if flight is not None:
+                # the leader must not hold up a more urgent follower
+                self.scheduler.raisePriority(flight['leader'].getItemId(), priority)
+                return
+        self.scheduler.submit(ScheduledTransfer(itemId, transferId, transferHandler, priority))
+
+    def _landFlight(self, transferHandler):
+        # returns the transfers waiting for this one, if any
+        key = transferHandler.getSourceKey()
+        if key is None:
+            return []
+        with self.flightsLock:
+            flight = self.flights.get(key)
+            if flight is None or flight['leader'] is not transferHandler:
+                return []
+            del self.flights[key]
+            return flight['followers']
 
     def transferCompleted(self, transferId, transferHandler):
+        itemId = transferHandler.getItemId()
+        psPath = transferHandler.getPhysicalPath()
+        blobId = None
+        if self.blobStore.isEnabled():
+            previousBlobId = Models.lockModel.getBlobId(itemId)
+            try:
+                blobId, psPath = self.blobStore.add(psPath, transferHandler.getDigest())
+            except Exception as ex:  # noqa
+                self.transferFailed(transferId, transferHandler, ex)
+                return
+        self.progressWriter.discard(transferId)
         flen = transferHandler.getTransferredByteCount()
         Models.transferModel.setStatus(transferId, TransferStatus.DONE, size=flen,
                                        transferred=flen, setTransferEndTime=True)
-        itemId = transferHandler.getItemId()
-        psPath = transferHandler.getPhysicalPath()
-        events.trigger('dm.fileDownloaded', info={'itemId': itemId, 'psPath': psPath})
+        self._recordCompletion(transferHandler, flen)
+        events.trigger('dm.fileDownloaded', info={'itemId': itemId, 'psPath': psPath,
+                                                  'checksum': transferHandler.getChecksum(),
+                                                  'blob': blobId})
+        if blobId is not None and previousBlobId is not None:
+            # the item was evicted without its blob being released
+            self.blobStore.release(previousBlobId)
+        # readers waiting on the watermark can now rely on dm.cached
+        self._releaseWatermark(transferHandler)
+        transferHandler.watermark.finish(psPath)
+        followers = self._landFlight(transferHandler)
+        if followers:
+            # copying (and possibly verifying) the file for each follower must not hold up
+            # the worker of this transfer
+            self.followerExecutor.submit(self._completeFollowers, transferHandler, followers,
+                                         blobId is not None)
+        elif blobId is not None:
+            # readers use the blob from now on
+            os.remove(transferHandler.getPhysicalPath())
+
+    def _completeFollowers(self, transferHandler, followers, removeSource):
+        try:
+            for followerId, follower in followers:
+                try:
+                    follower.copyFrom(transferHandler)
+                except Exception as ex:  # noqa
+                    self.transferFailed(followerId, follower, ex)
+                else:
+                    self.transferCompleted(followerId, follower)
+            if removeSource:
+                # readers and followers use the blob from now on
+                os.remove(transferHandler.getPhysicalPath())
+        except Exception:  # noqa
+            logger.error('Failed to complete shared transfers', exc_info=1)
 
     def transferFailed(self, transferId, transferHandler, exception):
         if isinstance(exception, TransferException):
@@ -119,34 +442,72 @@ class TransferManager:
             temporaryFailure = False
             message = str(exception)
 
+        self.progressWriter.discard(transferId)
         if temporaryFailure:
             Models.transferModel.setStatus(transferId, TransferStatus.FAILED_TEMPORARILY,
                                            error=message, setTransferEndTime=False)
         else:
             Models.transferModel.setStatus(transferId, TransferStatus.FAILED,
                                            error=message, setTransferEndTime=True)
+        Metrics.transfers.inc(handler=type(transferHandler).__name__,
+                              outcome='failed_temporarily' if temporaryFailure else 'failed')
         itemId = transferHandler.getItemId()
         Models.lockModel.fileDownloadFailed(itemId, message)
+        if not temporaryFailure:
+            # not resumed, and not counted against the size of the cache
+            ResumeRecord.discardPartial(transferHandler.getPhysicalPath())
+        self._releaseWatermark(transferHandler)
+        transferHandler.watermark.fail(message)
+        for followerId, follower in self._landFlight(transferHandler):
+            self.transferFailed(followerId, follower, exception)
 
     def transferProgress(self, transferId, total, current):
-        Models.transferModel.setStatus(transferId, TransferStatus.TRANSFERRING, size=total,
-                                       transferred=current)
+        self.progressWriter.update(transferId, total, current)
+
+    def _recordCompletion(self, transferHandler, flen):
+        now = time.time()
+        name = type(transferHandler).__name__
+        Metrics.transfers.inc(handler=name, outcome='done')
+        if transferHandler.scheduledTime is not None:
+            Metrics.timeToCached.observe(now - transferHandler.scheduledTime, handler=name)
+        if transferHandler.startTime is not None:
+            # transfers that shared the result of another one did not transfer anything
+            Metrics.transferBytes.inc(flen, handler=name)
+            if now > transferHandler.startTime:
+                Metrics.transferThroughput.observe(flen / (now - transferHandler.startTime),
+                                                   handler=name)
+
+    def updateMetrics(self):
+        # metrics that are kept by other components are copied when requested
+        Metrics.transfersQueued.set(self.scheduler.getQueueLength())
+        Metrics.transfersRunning.set(self.scheduler.getRunningCount())
+        for host, stats in self.httpSessionPool.getStats().items():
+            Metrics.httpPoolRequests.set(stats['requests'], host=host)
+            Metrics.httpPoolConnections.set(stats['connections'], host=host)
+        stats = self.zipDirectoryCache.getStats()
+        Metrics.zipCacheLookups.set(stats['hits'], result='hit')
+        Metrics.zipCacheLookups.set(stats['misses'], result='miss')
+        Metrics.zipCacheArchives.set(stats['archives'])
+        if self.processPool is not None:
+            stats = self.processPool.getStats()
+            Metrics.transferProcesses.set(stats['idle'], state='idle')
+            Metrics.transferProcesses.set(stats['processes'] - stats['idle'], state='busy')
 
 
 class SimpleTransferManager(TransferManager):
-    def __init__(self, settings, pathMapper):
-        TransferManager.__init__(self, settings, pathMapper)
+    def __init__(self, settings, pathMapper, schedulerClass=TransferScheduler):
+        TransferManager.__init__(self, settings, pathMapper, schedulerClass)
         self.restartInterruptedTransfers()
 
-    def startTransfer(self, user, itemId, sessionId):
+    def startTransfer(self, user, itemId, sessionId, priority=TransferPriority.NORMAL):
         # add transfer to transfer DB and initiate actual transfer
-        transfer = Models.transferModel.createTransfer(user, itemId, sessionId)
-        self.actualStartTransfer(user, transfer['_id'], itemId)
+        transfer = Models.transferModel.createTransfer(user, itemId, sessionId, priority)
+        self.actualStartTransfer(user, transfer['_id'], itemId, priority)
 
-    def actualStartTransfer(self, user, transferId, itemId):
+    def actualStartTransfer(self, user, transferId, itemId, priority=TransferPriority.NORMAL):
         Models.transferModel.setStatus(transferId, TransferStatus.INITIALIZING)
         transferHandler = self.getTransferHandler(transferId, itemId, user)
-        self._startTransferThread(itemId, transferId, transferHandler)
+        self._scheduleTransfer(itemId, transferId, transferHandler, priority)
 
     def getTransferHandler(self, transferId, itemId, user):
         item = Models.itemModel.load(itemId, force=True)
@@ -0,0 +1,50 @@
+from girder.models.model_base import Model
+from girder.constants import AccessType
+from pymongo.collection import ReturnDocument
+
+
+# A file in content-addressed private storage. The _id is '<algorithm>:<hex digest>'
+# and refCount is the number of cached items that use the file.
+class Blob(Model):
+    def initialize(self):
+        self.name = 'blob'
+        self.exposeFields(level=AccessType.READ, fields={'_id', 'path', 'size', 'refCount'})
+
+    def validate(self, blob):
+        return blob
+
+    def addReference(self, blobId, path, size):
+        return self.collection.find_one_and_update(
+            filter={'_id': blobId},
+            update={
+                '$inc': {'refCount': 1},
+                '$setOnInsert': {'path': path, 'size': size}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    def removeReference(self, blobId):
+        """
+        Removes a reference to a blob and deletes the blob document if it was the last
+        one. Returns the blob document as it was after the update, or None if there was
+        no such blob.
+        """
+        blob = self.collection.find_one_and_update(
+            filter={'_id': blobId},
+            update={'$inc': {'refCount': -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if blob is not None and blob['refCount'] <= 0:
+            self.collection.delete_one({'_id': blobId, 'refCount': {'$lte': 0}})
+        return blob
+
+    def getStats(self):
+        stats = {'count': 0, 'size': 0, 'references': 0}
+        for result in self.collection.aggregate([{'$group': {
+                '_id': None,
+                'count': {'$sum': 1},
+                'size': {'$sum': '$size'},
+                'references': {'$sum': '$refCount'}}}]):
+            stats = {key: result[key] for key in stats}
+        return stats
@@ -4,11 +4,18 @@
 
 from bson import objectid
 from girder.constants import AccessType
+from girder.models.setting import Setting
 from girder.utility.model_importer import ModelImporter
 from girder.models.model_base import AccessControlledModel
+from pymongo import UpdateOne
 from pymongo.collection import ReturnDocument
+import collections
+import datetime
 import time
 from girder import events
+from ..constants import PluginSettings, TransferPriority
+from ..lib.metrics import Metrics
+from ..lib.notifier import KeyedNotifier
 
 
 # This is the long-term item lock model. Locking in this context means
@@ -24,14 +31,39 @@ class Lock(AccessControlledModel):
     FIELD_PS_PATH = 'dm.psPath'
     FIELD_TRANSFER_ERROR = 'dm.transferError'
     FIELD_TRANSFER_ERROR_MESSAGE = 'dm.transferErrorMessage'
+    FIELD_CHECKSUM = 'dm.checksum'
+    FIELD_BLOB = 'dm.blob'
+    # fields of locks
+    FIELD_EXPIRES = 'expires'
+    FIELD_REAPER = 'reaper'
+    FIELD_REAPED = 'reaped'
 
     DOWNLOAD_BUF_SIZE = 65536
+    # downloads of items that are being transferred fail if the transfer makes no progress
+    # for this many seconds
+    DOWNLOAD_STALL_TIMEOUT = 120
+    # how often waits for deletes check the database, in case the delete was done by
+    # another process that this one is not notified about; the interval starts short,
+    # since deletes are quick, and backs off
+    DELETE_POLL_INTERVAL = 0.05
+    DELETE_POLL_MAX_INTERVAL = 1
+    # the same, for waits for transfers
+    TRANSFER_POLL_INTERVAL = 1
+    # expired locks claimed for release this many seconds ago are assumed to have been
+    # claimed by a process that died before releasing them, and are claimed again
+    REAPER_CLAIM_TIMEOUT = 300
+
+    # notified with the item ID when a delete is done
+    deleteNotifier = KeyedNotifier()
+    # notified with the item ID when a transfer finishes or fails
+    transferNotifier = KeyedNotifier()
 
     def initialize(self):
         self.name = 'lock'
         self.exposeFields(level=AccessType.READ, fields={'_id', 'userId', 'sessionId', 'itemId',
                                                          'ownerId'})
         self.itemModel = ModelImporter.model('item')
+        self.ensureIndices(['sessionId', 'itemId', Lock.FIELD_EXPIRES])
 
     def validate(self, lock):
         return lock
@@ -46,7 +78,8 @@ class Lock(AccessControlledModel):
             query['ownerId'] = ownerId
         return self.find(query)
 
-    def acquireLock(self, user, sessionId, itemId, ownerId=None):
+    def acquireLock(self, user, sessionId, itemId, ownerId=None,
+                    priority=TransferPriority.NORMAL):
         """
         Adds a new lock to an item.
 
@@ -58,8 +91,12 @@ class Lock(AccessControlledModel):
         :type itemId: string or ObjectId
         :param ownerId: The entity requesting the lock. If not specified, the session id is used
         :type ownerId: string or ObjectId
+        :param priority: The priority of the transfer, if one needs to be started. One of the
+         TransferPriority constants
+        :type priority: int
         """
 
+        start = time.time()
         if ownerId is None:
             ownerId = sessionId
 
@@ -72,18 +109,121 @@ class Lock(AccessControlledModel):
             'itemId': itemId,
             'ownerId': ownerId
         }
+        self._setLease(lock, self.getLeaseExpiry())
 
         self.setUserAccess(lock, user=user, level=AccessType.ADMIN)
         lock = self.save(lock)
 
-        self.waitForPendingDelete(itemId)
+        item = self.waitForPendingDelete(itemId)
 
-        if self.tryLock(user, sessionId, itemId, ownerId):
+        if self.tryLock(user, sessionId, itemId, ownerId, priority):
             # we own the transfer
             events.trigger('dm.itemLocked',
-                           info={'itemId': itemId, 'user': user, 'sessionId': sessionId})
+                           info={'itemId': itemId, 'user': user, 'sessionId': sessionId,
+                                 'priority': priority})
+            result = 'miss'
+        else:
+            events.trigger('dm.transferRequested',
+                           info={'itemId': itemId, 'priority': priority})
+            result = 'hit' if item.get('dm', {}).get('cached') else 'pending'
+        Metrics.lockAcquisitions.inc(result=result)
+        Metrics.lockAcquireLatency.observe(time.time() - start)
         return lock
 
+    def acquireLocks(self, user, sessionId, itemIds, ownerId=None,
+                     priority=TransferPriority.NORMAL):
+        """
+        Adds a lock to each of a list of items, with the same effect as calling
+        acquireLock() for each of them, but using a fixed number of database operations
+        for the whole list, plus one per item that needs to be transferred. Items that
+        appear more than once in the list get one lock for each time they appear.
+
+        :param user: The user initiating the request.
+        :type user: dict
+        :param sessionId: The ID of a session associated with the request.
+        :type sessionId: ObjectId
+        :param itemIds: The (Girder) items being locked
+        :type itemIds: list of string or ObjectId
+        :param ownerId: The entity requesting the locks. If not specified, the session id
+         is used
+        :type ownerId: string or ObjectId
+        :param priority: The priority of the transfers that need to be started. One of the
+         TransferPriority constants
+        :type priority: int
+        :return: The new locks, in the order of itemIds
+        """
+        start = time.time()
+        if ownerId is None:
+            ownerId = sessionId
+        itemIds = [objectid.ObjectId(itemId) for itemId in itemIds]
+        if not itemIds:
+            return []
+
+        locks = []
+        expires = self.getLeaseExpiry()
+        for itemId in itemIds:
+            lock = {
+                '_id': objectid.ObjectId(),
+                'userId': user['_id'],
+                'sessionId': sessionId,
+                'itemId': itemId,
+                'ownerId': ownerId
+            }
+            self._setLease(lock, expires)
+            locks.append(self.setUserAccess(lock, user=user, level=AccessType.ADMIN))
+        self.collection.insert_many(locks)
+
+        counts = collections.Counter(itemIds)
+        # Unlike acquireLock(), this increments the lock counts before waiting for pending
+        # deletes, since a bulk update cannot tell which items it skipped. This is just as
+        # safe: a delete cannot start once an item is locked, so a delete in progress
+        # started before, and the transfer decision below is only taken once it is done.
+        self.itemModel.collection.bulk_write([
+            UpdateOne({'_id': itemId}, {'$inc': {Lock.FIELD_LOCK_COUNT: count}})
+            for itemId, count in counts.items()
+        ], ordered=False)
+        self.waitForPendingDeletes(list(counts))
+
+        transferring = set()
+        cached = set()
+        for item in self.itemModel.find(
+                query={'_id': {'$in': list(counts)}},
+                fields=[Lock.FIELD_TRANSFER_IN_PROGRESS, Lock.FIELD_CACHED]):
+            if item.get('dm', {}).get('transferInProgress'):
+                transferring.add(item['_id'])
+            elif item.get('dm', {}).get('cached'):
+                cached.add(item['_id'])
+        started = self.tryLockMany(user, sessionId, set(counts) - transferring - cached,
+                                   priority)
+
+        for itemId, count in counts.items():
+            if itemId in started:
+                events.trigger('dm.itemLocked',
+                               info={'itemId': itemId, 'user': user, 'sessionId': sessionId,
+                                     'priority': priority})
+                result = 'miss'
+            elif itemId in cached:
+                result = 'hit'
+            else:
+                # being transferred, possibly by a concurrent call that won tryLockMany()
+                events.trigger('dm.transferRequested',
+                               info={'itemId': itemId, 'priority': priority})
+                result = 'pending'
+            Metrics.lockAcquisitions.inc(count, result=result)
+        # each lock took as long as the whole batch
+        Metrics.lockAcquireLatency.observe(time.time() - start, count=len(itemIds))
+        return locks
+
+    def waitForPendingDeletes(self, itemIds):
+        # the batch version of waitForPendingDelete(), for items whose lock count was
+        # already incremented
+        for item in list(self.itemModel.find(
+                query={'_id': {'$in': itemIds}, Lock.FIELD_DELETE_IN_PROGRESS: True},
+                fields=['_id'])):
+            self._waitForDelete(item['_id'], lambda itemId=item['_id']: self.itemModel.findOne(
+                query={'_id': itemId, Lock.FIELD_DELETE_IN_PROGRESS: {'$ne': True}},
+                fields=['_id']))
+
     def waitForPendingDelete(self, itemId):
         # In principle, writing ops should happen in a critical section.
         # However, entering a critical section may require an arbitrary
@@ -91,17 +231,19 @@ class Lock(AccessControlledModel):
         # using a queue and asynchronous events, but that's too much engineering.
         # Instead, we wait for deletion operations, since they are quick, and
         # implement downloads using a two step: lock the file to prevent its deletion,
-        # then poll for transfer status
-        done = False
-        while not done:
-            result = self.itemModel.update(
-                query={'_id': itemId, Lock.FIELD_DELETE_IN_PROGRESS: {'$ne': True}},
-                # make sure no deletes can creep in
-                update={'$inc': {Lock.FIELD_LOCK_COUNT: 1}},
-                multi=False)
-            done = result.matched_count > 0
-            if not done:
-                time.sleep(0.05)
+        # then poll for transfer status. Returns the cache state of the item.
+        return self._waitForDelete(itemId, lambda: self.itemModel.collection.find_one_and_update(
+            filter={'_id': itemId, Lock.FIELD_DELETE_IN_PROGRESS: {'$ne': True}},
+            # make sure no deletes can creep in
+            update={'$inc': {Lock.FIELD_LOCK_COUNT: 1}},
+            projection=[Lock.FIELD_CACHED],
+            return_document=ReturnDocument.AFTER))
+
+    def _waitForDelete(self, itemId, check):
+        # check() is retried when a delete is done; see unlockForDeletion()
+        return Lock.deleteNotifier.waitFor(str(itemId), check,
+                                           interval=Lock.DELETE_POLL_INTERVAL,
+                                           maxInterval=Lock.DELETE_POLL_MAX_INTERVAL)
 
     def tryLockForDeletion(self, itemId):
         result = self.itemModel.update(
@@ -119,6 +261,7 @@ class Lock(AccessControlledModel):
             query={'_id': itemId},
             update={'$set': {Lock.FIELD_DELETE_IN_PROGRESS: False}},
             multi=False)
+        Lock.deleteNotifier.notify(str(itemId))
 
     def evict(self, itemId):
         result = self.itemModel.update(
@@ -133,7 +276,7 @@ class Lock(AccessControlledModel):
             multi=False)
         print('Evicting %s. Matched: %s.' % (itemId, result.matched_count))
 
-    def tryLock(self, user, sessionId, itemId, ownerId):
+    def tryLock(self, user, sessionId, itemId, ownerId, priority=TransferPriority.NORMAL):
         # Luckily, Mongo updates are atomic
         result = self.itemModel.update(
             query={
@@ -146,6 +289,7 @@ class Lock(AccessControlledModel):
                     Lock.FIELD_TRANSFER_IN_PROGRESS: True,
                     'dm.transfer.userId': user['_id'],
                     'dm.transfer.sessionId': sessionId,
+                    'dm.transfer.priority': priority
                 },
                 # Unset transfer error when starting a new download so that
                 # it is not confused with a current error
@@ -156,6 +300,38 @@ class Lock(AccessControlledModel):
             multi=False)
         return result.matched_count > 0
 
+    def tryLockMany(self, user, sessionId, itemIds, priority=TransferPriority.NORMAL):
+        """
+        The batch version of tryLock(). Returns the set of items for which the caller
+        now owns the transfer.
+        """
+        if not itemIds:
+            return set()
+        # marks the items won by this call, so that they can be told apart from items
+        # won by concurrent calls
+        batchId = objectid.ObjectId()
+        self.itemModel.collection.bulk_write([
+            UpdateOne({
+                '_id': itemId,
+                Lock.FIELD_TRANSFER_IN_PROGRESS: {'$ne': True},
+                Lock.FIELD_CACHED: {'$ne': True}
+            }, {
+                '$set': {
+                    Lock.FIELD_TRANSFER_IN_PROGRESS: True,
+                    'dm.transfer.userId': user['_id'],
+                    'dm.transfer.sessionId': sessionId,
+                    'dm.transfer.priority': priority,
+                    'dm.transfer.batchId': batchId
+                },
+                '$unset': {
+                    Lock.FIELD_TRANSFER_ERROR: True
+                }
+            }) for itemId in itemIds
+        ], ordered=False)
+        return {item['_id'] for item in self.itemModel.find(
+            query={'_id': {'$in': list(itemIds)}, 'dm.transfer.batchId': batchId},
+            fields=['_id'])}
+
     def releaseLock(self, user, lock):
         itemId = lock['itemId']
         self.removeLock(lock)
@@ -163,6 +339,28 @@ class Lock(AccessControlledModel):
         if (self.unlock(itemId)):
             events.trigger('dm.itemUnlocked', info=itemId)
 
+    def releaseLocks(self, user, locks):
+        """
+        Releases a list of locks, with the same effect as calling releaseLock() for each of
+        them, but using a fixed number of database operations.
+        """
+        if not locks:
+            return
+        self.collection.delete_many({'_id': {'$in': [lock['_id'] for lock in locks]}})
+        counts = collections.Counter(lock['itemId'] for lock in locks)
+        self.itemModel.collection.bulk_write([
+            UpdateOne({'_id': itemId}, {
+                '$inc': {Lock.FIELD_LOCK_COUNT: -count},
+                '$currentDate': {Lock.FIELD_LAST_UNLOCKED: {'$type': 'timestamp'}}
+            }) for itemId, count in counts.items()
+        ], ordered=False)
+        # A concurrent release of the last other lock on one of these items may also
+        # report it as unlocked, which listeners must tolerate
+        unlocked = [item['_id'] for item in self.itemModel.find(
+            query={'_id': {'$in': list(counts)}, Lock.FIELD_LOCK_COUNT: 0}, fields=['_id'])]
+        if unlocked:
+            events.trigger('dm.itemsUnlocked', info=unlocked)
+
     def removeLock(self, lock):
         self.remove(lock)
 
@@ -181,32 +379,107 @@ class Lock(AccessControlledModel):
         # can't do [FIELD_LOCK_COUNT] unfortunately
         return result['dm']['lockCount'] == 0
 
+    def getLeaseExpiry(self):
+        """
+        Returns the time at which a lease taken or renewed now expires, or None if locks
+        do not expire.
+        """
+        duration = float(Setting().get(PluginSettings.LOCK_LEASE_DURATION))
+        if duration <= 0:
+            return None
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=duration)
+
+    def _setLease(self, lock, expires):
+        if expires is not None:
+            lock[Lock.FIELD_EXPIRES] = expires
+
+    def renewLeases(self, session):
+        """
+        Extends the leases of all the locks of a session. Returns the number of renewed
+        locks and their new expiry time, which is None if locks do not expire.
+        """
+        expires = self.getLeaseExpiry()
+        if expires is None:
+            return 0, None
+        result = self.collection.update_many({
+            'sessionId': {'$in': [session['_id'], str(session['_id'])]},
+            # already being released
+            Lock.FIELD_REAPER: {'$exists': False}
+        }, {'$set': {Lock.FIELD_EXPIRES: expires}})
+        return result.matched_count, expires
+
+    def releaseExpiredLocks(self):
+        """
+        Releases, in bulk, all locks whose lease has expired. Returns the number of
+        released locks.
+        """
+        # Claim the expired locks first, so that they cannot be renewed while they are
+        # being released and so that concurrent calls do not release them twice
+        reaperId = objectid.ObjectId()
+        now = datetime.datetime.utcnow()
+        staleClaim = now - datetime.timedelta(seconds=Lock.REAPER_CLAIM_TIMEOUT)
+        self.collection.update_many({
+            Lock.FIELD_EXPIRES: {'$lt': now},
+            '$or': [
+                {Lock.FIELD_REAPER: {'$exists': False}},
+                {Lock.FIELD_REAPED: {'$lt': staleClaim}}
+            ]
+        }, {'$set': {Lock.FIELD_REAPER: reaperId, Lock.FIELD_REAPED: now}})
+        locks = list(self.find({Lock.FIELD_REAPER: reaperId}, fields=['_id', 'itemId']))
+        self.releaseLocks(None, locks)
+        return len(locks)
+
     def unlockAll(self, user, session):
-        raise Exception('Not yet here')
+        """
+        Releases all the locks of a session, as releaseLocks() does.
+        """
+        # locks acquired through the REST API store the session id as a string
+        locks = list(self.find(
+            {'sessionId': {'$in': [session['_id'], str(session['_id'])]}},
+            fields=['_id', 'itemId']))
+        self.releaseLocks(user, locks)
 
     def fileDeleted(self, itemId):
         self.itemModel.update(
             query={'_id': itemId},
             update={
                 '$set': {Lock.FIELD_CACHED: False, Lock.FIELD_DELETE_IN_PROGRESS: False},
-                '$unset': {Lock.FIELD_PS_PATH: True}
+                '$unset': {Lock.FIELD_PS_PATH: True, Lock.FIELD_BLOB: True}
             },
             multi=False)
+        Lock.deleteNotifier.notify(str(itemId))
+
+    def getBlobId(self, itemId):
+        # the content-addressed blob holding the cached file of an item, if any
+        item = self.itemModel.findOne({'_id': itemId}, fields=[Lock.FIELD_BLOB])
+        if item is None:
+            return None
+        return item.get('dm', {}).get('blob')
 
     def fileDownloaded(self, info):
         itemId = info['itemId']
         psPath = info['psPath']
+        fields = {
+            Lock.FIELD_CACHED: True,
+            Lock.FIELD_TRANSFER_IN_PROGRESS: False,
+            Lock.FIELD_PS_PATH: psPath,
+            # failures since the last successful transfer
+            Lock.FIELD_ERROR_COUNT: 0
+        }
+        if info.get('checksum'):
+            # the checksum was verified during the transfer
+            fields[Lock.FIELD_CHECKSUM] = info['checksum']
+        if info.get('blob'):
+            fields[Lock.FIELD_BLOB] = info['blob']
         self.itemModel.update(
             query={'_id': itemId},
             update={
-                '$set': {
-                    Lock.FIELD_CACHED: True,
-                    Lock.FIELD_TRANSFER_IN_PROGRESS: False,
-                    Lock.FIELD_PS_PATH: psPath
-                },
+                '$set': fields,
                 '$unset': {
                     'dm.transfer.userId': True,
                     'dm.transfer.sessionId': True,
+                    'dm.transfer.priority': True,
+                    'dm.transfer.batchId': True,
                     Lock.FIELD_TRANSFER_ERROR: True,
                     Lock.FIELD_TRANSFER_ERROR_MESSAGE: True
                 },
@@ -215,6 +488,7 @@ class Lock(AccessControlledModel):
                 }
             },
             multi=False)
+        Lock.transferNotifier.notify(str(itemId))
 
     def fileDownloadFailed(self, itemId, errorMessage):
         self.itemModel.update(
@@ -228,13 +502,63 @@ class Lock(AccessControlledModel):
                 },
                 '$unset': {
                     'dm.transfer.userId': True,
-                    'dm.transfer.sessionId': True
+                    'dm.transfer.sessionId': True,
+                    'dm.transfer.priority': True,
+                    'dm.transfer.batchId': True
                 },
                 '$inc': {
                     Lock.FIELD_ERROR_COUNT: 1
                 },
             },
             multi=False)
+        Lock.transferNotifier.notify(str(itemId))
+
+    def transferAbandoned(self, itemId):
+        # an interrupted transfer that is not restarted; see restartInterruptedTransfers()
+        self.itemModel.update(
+            query={'_id': itemId},
+            update={
+                '$set': {Lock.FIELD_TRANSFER_IN_PROGRESS: False},
+                '$unset': {
+                    'dm.transfer.userId': True,
+                    'dm.transfer.sessionId': True,
+                    'dm.transfer.priority': True,
+                    'dm.transfer.batchId': True
+                }
+            },
+            multi=False)
+        Lock.transferNotifier.notify(str(itemId))
+
+    def waitForItem(self, lock, timeout):
+        """
+        Waits up to timeout seconds for the item locked by a lock to be cached or for its
+        transfer to fail. Returns a dictionary with the state of the item ('cached',
+        'failed' or, if the timeout passed first, 'pending') and, depending on the
+        state, the path of the cached file or the transfer error.
+        """
+        itemId = lock['itemId']
+
+        def check():
+            item = self.itemModel.findOne({'_id': itemId}, fields=[
+                Lock.FIELD_CACHED, Lock.FIELD_PS_PATH, Lock.FIELD_TRANSFER_ERROR,
+                Lock.FIELD_TRANSFER_ERROR_MESSAGE])
+            if item is None:
+                return {'itemId': itemId, 'state': 'failed', 'error': 'Item was deleted'}
+            dm = item.get('dm', {})
+            if dm.get('cached'):
+                return {'itemId': itemId, 'state': 'cached', 'psPath': dm.get('psPath')}
+            if dm.get('transferError'):
+                return {'itemId': itemId, 'state': 'failed',
+                        'error': dm.get('transferErrorMessage')}
+            return None
+
+        # all the requests waiting on an item are woken by one notification; the polling
+        # covers transfers done by other processes
+        result = Lock.transferNotifier.waitFor(str(itemId), check, timeout=timeout,
+                                               interval=Lock.TRANSFER_POLL_INTERVAL)
+        if result is None:
+            result = {'itemId': itemId, 'state': 'pending'}
+        return result
 
     def listDownloadingItems(self):
         return self.itemModel.find(query={Lock.FIELD_TRANSFER_IN_PROGRESS: True})
@@ -263,20 +587,68 @@ class Lock(AccessControlledModel):
             }
         )
 
-    def downloadItem(self, lock):
+    def downloadItem(self, lock, offset=0, length=None):
+        """
+        Returns a function that streams the contents of the item locked by a lock,
+        optionally restricted to length bytes starting at offset. If the item is being
+        transferred, the parts of the file that are already transferred are streamed
+        right away and the stream waits for the rest.
+        """
         item = self.itemModel.findOne({'_id': lock['itemId']})
         if item is None:
             raise ValueError('Internal error: unable to find item for lock')
-        if not item['dm']['cached']:
-            raise ValueError('Item is not available yet')
-        psPath = item['dm']['psPath']
+        watermark = None
+        if not item.get('dm', {}).get('cached'):
+            watermark = self._getWatermark(item['_id'])
+            if watermark is None:
+                # the transfer may have finished since the item was read
+                item = self.itemModel.findOne({'_id': lock['itemId']})
+                if item is None or not item.get('dm', {}).get('cached'):
+                    raise ValueError('Item is not available yet')
+        psPath = item['dm'].get('psPath')
+        end = None if length is None else offset + length
+        # the size of the file is only known for sure once it is transferred
+        size = item['size']
 
         def stream():
-            with open(psPath, 'rb') as f:
-                while True:
-                    data = f.read(Lock.DOWNLOAD_BUF_SIZE)
+            pos = offset
+            f = None
+            following = watermark is not None
+            try:
+                while end is None or pos < end:
+                    n = Lock.DOWNLOAD_BUF_SIZE if end is None else \
+                        min(Lock.DOWNLOAD_BUF_SIZE, end - pos)
+                    if following:
+                        if pos >= size:
+                            break
+                        # stream whatever is available, but at least one byte
+                        available = watermark.waitFor(pos + 1, Lock.DOWNLOAD_STALL_TIMEOUT)
+                        if available is None:
+                            # done, so read up to the end of the file
+                            following = False
+                        else:
+                            n = min(n, available - pos)
+                    if f is None:
+                        # the file may only be created once the transfer starts and
+                        # may be moved once it is done
+                        if watermark is not None:
+                            f = open(watermark.psPath, 'rb')
+                        else:
+                            f = open(psPath, 'rb')
+                        f.seek(pos)
+                    data = f.read(n)
                     if not data:
                         break
+                    pos += len(data)
                     yield data
+            finally:
+                if f is not None:
+                    f.close()
 
         return stream
+
+    def _getWatermark(self, itemId):
+        event = events.trigger('dm.getWatermark', info={'itemId': itemId})
+        if event.responses:
+            return event.responses[-1]
+        return None
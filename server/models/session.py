@@ -152,6 +152,54 @@ class Session(AccessControlledModel):
 
         return self._containsItemOrAncestor(idSet, objectId)
 
+    def containsItems(self, sessionId, objectIds, user):
+        """
+        Like containsItem(), but for many objects at once. Returns the set of the
+        ObjectIds in objectIds that are accessible in the session. The ancestors of all
+        objects are looked up one level at a time, using two queries per level, and each
+        distinct ancestor is only looked up once.
+        :param sessionId: The session in which to check the presence of the objects
+        :param objectIds: The objects to find
+        :param user: The user owning the session
+        :return:
+        """
+        session = self.load(sessionId, level=AccessType.READ, user=user)
+        if session is None:
+            raise KeyError(sessionId)
+        idSet = set()
+        for entry in session['dataSet']:
+            idSet.add(objectid.ObjectId(entry['itemId']))
+
+        contained = set()
+        # the ancestor reached so far by each object still being checked
+        pending = {objectid.ObjectId(objectId): objectid.ObjectId(objectId)
+                   for objectId in objectIds}
+        parents = {}
+        while pending:
+            for objectId, ancestorId in list(pending.items()):
+                if ancestorId is None:
+                    del pending[objectId]
+                elif ancestorId in idSet:
+                    contained.add(objectId)
+                    del pending[objectId]
+            parents.update(self._getParentIds(set(pending.values()) - set(parents)))
+            pending = {objectId: parents[ancestorId] for objectId, ancestorId in pending.items()}
+        return contained
+
+    def _getParentIds(self, objectIds):
+        # the batch version of _getParentId(); returns a dictionary with all objectIds
+        parents = dict.fromkeys(objectIds)
+        if not objectIds:
+            return parents
+        for folder in self.folderModel.find(query={'_id': {'$in': list(objectIds)}},
+                                            fields=['parentId']):
+            parents[folder['_id']] = folder['parentId']
+        rest = [objectId for objectId, parentId in parents.items() if parentId is None]
+        if rest:
+            for item in self.itemModel.find(query={'_id': {'$in': rest}}, fields=['folderId']):
+                parents[item['_id']] = item['folderId']
+        return parents
+
     def _containsItemOrAncestor(self, idSet, objectId):
         if objectId is None:
             return False
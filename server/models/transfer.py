@@ -2,25 +2,30 @@ from girder.models.model_base import AccessControlledModel
 from girder.utility.model_importer import ModelImporter
 from girder.utility import path as path_util
 from girder.constants import AccessType
-from ..constants import TransferStatus
+from ..constants import TransferStatus, TransferPriority
 from bson import objectid
+from pymongo import UpdateOne
 import datetime
 
 
 class Transfer(AccessControlledModel):
     OLD_TRANSFER_LIMIT = datetime.timedelta(minutes=1)
+    # queued, running or temporarily failed, possibly before a restart
+    UNFINISHED = [TransferStatus.INITIALIZING, TransferStatus.QUEUED,
+                  TransferStatus.TRANSFERRING, TransferStatus.FAILED_TEMPORARILY]
 
     def initialize(self):
         self.name = 'transfer'
         self.exposeFields(level=AccessType.READ,
                           fields={'_id', 'ownerId', 'sessionId', 'itemId', 'status', 'error',
-                                  'size', 'transferred', 'path', 'startTime', 'endTime'})
+                                  'size', 'transferred', 'rate', 'path', 'startTime',
+                                  'endTime', 'priority'})
         self.itemModel = ModelImporter.model('item')
 
     def validate(self, transfer):
         return transfer
 
-    def createTransfer(self, user, itemId, sessionId):
+    def createTransfer(self, user, itemId, sessionId, priority=TransferPriority.NORMAL):
         existing = self.findOne(query={'itemId': itemId, 'ownerId': user['_id'],
                                        'sessionId': sessionId})
 
@@ -45,7 +50,9 @@ class Transfer(AccessControlledModel):
             'error': None,
             'size': 0,
             'transferred': 0,
-            'path': pathFromRoot
+            'rate': 0,
+            'path': pathFromRoot,
+            'priority': priority
         }
 
         self.setUserAccess(transfer, user=user, level=AccessType.ADMIN)
@@ -65,7 +72,8 @@ class Transfer(AccessControlledModel):
                 'status': status,
                 'error': error,
                 'size': size,
-                'transferred': transferred
+                'transferred': transferred,
+                'rate': 0
             }
         }
 
@@ -83,6 +91,22 @@ class Transfer(AccessControlledModel):
             update=update
         )
 
+    def setProgress(self, progress):
+        """
+        Sets the progress of multiple transfers in one bulk operation. The progress
+        argument maps transfer ids to (size, transferred, rate) tuples, with the rate in
+        bytes per second. Transfers that are already finished or failed are left alone.
+        """
+        self.collection.bulk_write([
+            UpdateOne(
+                {'_id': transferId, 'status': {'$in': [TransferStatus.INITIALIZING,
+                                                       TransferStatus.QUEUED,
+                                                       TransferStatus.TRANSFERRING]}},
+                {'$set': {'status': TransferStatus.TRANSFERRING, 'error': None,
+                          'size': size, 'transferred': transferred, 'rate': rate}})
+            for transferId, (size, transferred, rate) in progress.items()
+        ], ordered=False)
+
     def list(self, user=None, sessionId=None, discardOld=True):
         if sessionId is None:
             return self.listAllForUser(user, discardOld=discardOld)
@@ -93,6 +117,21 @@ class Transfer(AccessControlledModel):
         query = self.getTimeConstraintQuery(discardOld)
         return self.find(query)
 
+    def listUnfinished(self):
+        return self.find({'status': {'$in': Transfer.UNFINISHED}})
+
+    def failUnfinished(self, itemId, error):
+        """
+        Marks the unfinished transfers of an item as failed, e.g., when they are not
+        restarted.
+        """
+        self.update(
+            query={'itemId': itemId, 'status': {'$in': Transfer.UNFINISHED}},
+            update={
+                '$set': {'status': TransferStatus.FAILED, 'error': error, 'rate': 0},
+                '$currentDate': {'endTime': {'$type': 'timestamp'}}
+            })
+
     def listAllForUser(self, user, discardOld=True):
         query = self.getTimeConstraintQuery(discardOld)
         query['ownerId'] = user['_id']
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from girder.api.rest import Resource
+from girder.api.rest import Resource, setResponseHeader
 from girder.utility.model_importer import ModelImporter
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
+from ..lib.metrics import Metrics
 
 
 class DM(Resource):
@@ -40,3 +41,36 @@ class DM(Resource):
     )
     def clearCache(self, force):
         self.cacheManager.clearCache(force)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Get statistics about the transfer infrastructure.')
+        .notes('The "httpPool" entry contains, for each HTTP host, the number of requests '
+               'made, the number of connections opened, and the number of requests that '
+               'reused a pooled connection.')
+        .errorResponse('Admin access required.', 403)
+    )
+    def getStats(self):
+        return {
+            'httpPool': self.cacheManager.transferManager.httpSessionPool.getStats(),
+            'zipCache': self.cacheManager.transferManager.zipDirectoryCache.getStats(),
+            'blobs': self.cacheManager.transferManager.blobStore.getStats()
+        }
+
+    @access.admin
+    @autoDescribeRoute(
+        Description('Get metrics of the transfers, locks and garbage collector of this '
+                    'server process.')
+        .notes('The metrics are returned in the Prometheus text format. They are kept in '
+               'memory and start from zero when the server is restarted.')
+        .errorResponse('Admin access required.', 403)
+    )
+    def getMetrics(self):
+        self.cacheManager.transferManager.updateMetrics()
+        text = Metrics.registry.render()
+        setResponseHeader('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+
+        def stream():
+            yield text.encode('utf8')
+
+        return stream
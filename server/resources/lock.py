@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 
+from bson import objectid
+from bson.errors import InvalidId
 from girder.api.rest import Resource
 from girder.api.rest import filtermodel, loadmodel
 from girder.constants import AccessType
@@ -9,6 +11,12 @@ from girder.api import access
 from girder.api.describe import Description, describeRoute
 from girder.exceptions import RestException
 from ..models.session import Session
+from ..constants import TransferPriority
+
+# in seconds
+# waiting requests hold a server thread, so waits are kept short and clients re-poll
+DEFAULT_WAIT_TIMEOUT = 20
+MAX_WAIT_TIMEOUT = 30
 
 
 class Lock(Resource):
@@ -87,6 +95,11 @@ class Lock(Resource):
         .param('sessionId', 'A Data Manager session.', paramType='query')
         .param('itemId', 'The item to lock', paramType='query')
         .param('ownerId', 'The lock owner.', paramType='query', required=False)
+        .param('priority', 'The priority of the transfer triggered by this lock, if any. '
+               'Locks taken in response to an open() should use "interactive", while '
+               'prefetching should use "bulk".', paramType='query', required=False,
+               enum=sorted(TransferPriority.NAMES.keys()), default='normal')
+        .errorResponse('Invalid priority.', 400)
         .errorResponse('Item not in session.', 404)
     )
     def acquireLock(self, params):
@@ -96,20 +109,131 @@ class Lock(Resource):
         ownerId = None
         if 'ownerId' in params:
             ownerId = params['ownerId']
+        priority = self._getPriority(params)
         if not Session().containsItem(sessionId, itemId, user):
             raise RestException('Item not in the session', 404)
-        return self.model('lock', 'wt_data_manager').acquireLock(user, sessionId, itemId, ownerId)
+        return self.model('lock', 'wt_data_manager').acquireLock(user, sessionId, itemId, ownerId,
+                                                                 priority)
+
+    @access.user
+    @filtermodel(model='lock', plugin='wt_data_manager')
+    @describeRoute(
+        Description('Acquires locks on many items at once.')
+        .notes('The body is a JSON object with the keys "sessionId", "itemIds" (a list of '
+               'item IDs), and, optionally, "ownerId" and "priority", which have the '
+               'same meaning as for acquiring a single lock. Returns the new locks, in '
+               'the order of itemIds. If any of the items is not in the session, no '
+               'locks are acquired.')
+        .param('body', 'The locks to acquire.', paramType='body')
+        .errorResponse('Invalid request or priority.', 400)
+        .errorResponse('Items not in session.', 404)
+    )
+    def acquireLocks(self, params):
+        user = self.getCurrentUser()
+        body = self.getBodyJson()
+        if not isinstance(body, dict) or 'sessionId' not in body or \
+                not isinstance(body.get('itemIds'), list):
+            raise RestException('Expected an object with sessionId and itemIds', 400)
+        sessionId = self._getObjectId(body['sessionId'])
+        itemIds = [self._getObjectId(itemId) for itemId in body['itemIds']]
+        priority = self._getPriority(body)
+        contained = Session().containsItems(sessionId, itemIds, user)
+        missing = [str(itemId) for itemId in itemIds if itemId not in contained]
+        if missing:
+            raise RestException('Items not in the session: %s' % ', '.join(missing), 404)
+        return self.model('lock', 'wt_data_manager').acquireLocks(
+            user, sessionId, itemIds, body.get('ownerId'), priority)
+
+    @access.user
+    @describeRoute(
+        Description('Releases many locks at once.')
+        .notes('The body is a JSON object with the key "lockIds", a list of lock IDs. If '
+               'any of the locks does not exist or cannot be released by the current '
+               'user, no locks are released.')
+        .param('body', 'The locks to release.', paramType='body')
+        .errorResponse('Invalid request.', 400)
+        .errorResponse('Access was denied for a lock.', 403)
+    )
+    def releaseLocks(self, params):
+        user = self.getCurrentUser()
+        body = self.getBodyJson()
+        if not isinstance(body, dict) or not isinstance(body.get('lockIds'), list):
+            raise RestException('Expected an object with lockIds', 400)
+        lockIds = {self._getObjectId(lockId) for lockId in body['lockIds']}
+        lockModel = self.model('lock', 'wt_data_manager')
+        locks = list(lockModel.find({'_id': {'$in': list(lockIds)}}))
+        missing = lockIds - {lock['_id'] for lock in locks}
+        if missing:
+            raise RestException('No such locks: %s' % ', '.join(map(str, missing)), 400)
+        for lock in locks:
+            lockModel.requireAccess(lock, user=user, level=AccessType.WRITE)
+        lockModel.releaseLocks(user, locks)
+
+    def _getObjectId(self, value):
+        try:
+            return objectid.ObjectId(value)
+        except (InvalidId, TypeError):
+            raise RestException('Invalid ID: %s' % value, 400)
+
+    def _getPriority(self, params):
+        name = params.get('priority', 'normal')
+        if name not in TransferPriority.NAMES:
+            raise RestException('Invalid priority: %s' % name, 400)
+        return TransferPriority.NAMES[name]
 
     @access.user
     @loadmodel(model='lock', plugin='wt_data_manager', level=AccessType.READ)
     @describeRoute(
         Description('Download the item locked by a lock.')
+        .notes('If the item is being transferred, the bytes that were already '
+               'transferred are returned immediately and the rest as they arrive.')
         .param('id', 'The ID of the lock.', paramType='path')
+        .param('offset', 'Start downloading at this byte offset.', dataType='integer',
+               required=False, default=0)
+        .param('length', 'Download at most this many bytes.', dataType='integer',
+               required=False)
         .errorResponse('ID was invalid.')
         .errorResponse('Access was denied for the lock.', 403)
     )
     def downloadItem(self, lock, params):
-        return self.model('lock', 'wt_data_manager').downloadItem(lock)
+        offset = self._getIntParam(params, 'offset', 0)
+        length = self._getIntParam(params, 'length', None)
+        return self.model('lock', 'wt_data_manager').downloadItem(lock, offset, length)
+
+    @access.user
+    @loadmodel(model='lock', plugin='wt_data_manager', level=AccessType.READ)
+    @describeRoute(
+        Description('Wait for the item locked by a lock to be cached.')
+        .notes('Returns as soon as the item is cached or its transfer fails, or after the '
+               'timeout. The "state" field of the response is "cached", with the path of '
+               'the cached file in "psPath", "failed", with the transfer error in "error", '
+               'or "pending" if the timeout passed first, in which case the client '
+               'should wait again.')
+        .param('id', 'The ID of the lock.', paramType='path')
+        .param('timeout', 'The maximum number of seconds to wait, up to %s.' %
+               MAX_WAIT_TIMEOUT, dataType='integer', required=False,
+               default=DEFAULT_WAIT_TIMEOUT)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Invalid timeout, e.g. negative or above %s.' % MAX_WAIT_TIMEOUT, 400)
+        .errorResponse('Read access was denied for the lock.', 403)
+    )
+    def waitForItem(self, lock, params):
+        timeout = self._getIntParam(params, 'timeout', DEFAULT_WAIT_TIMEOUT)
+        if timeout > MAX_WAIT_TIMEOUT:
+            raise RestException('Invalid timeout: %s (at most %s)' % (timeout, MAX_WAIT_TIMEOUT),
+                                400)
+        return self.model('lock', 'wt_data_manager').waitForItem(lock, timeout)
+
+    def _getIntParam(self, params, name, default):
+        if params.get(name) is None:
+            return default
+        try:
+            value = int(params[name])
+        except ValueError:
+            value = -1
+        if value < 0:
+            raise RestException('Invalid %s: %s' % (name, params[name]), 400)
+        return value
 
     @access.user
     @describeRoute(
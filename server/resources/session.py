@@ -7,6 +7,7 @@ from girder.api.rest import filtermodel
 from girder.constants import AccessType
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
+from ..models.lock import Lock as LockModel
 from ..models.session import Session as SessionModel
 from ..schema.dataset import dataSetSchema
 
@@ -56,6 +57,20 @@ class Session(Resource):
         user = self.getCurrentUser()
         return SessionModel().deleteSession(user, session)
 
+    @access.user
+    @autoDescribeRoute(
+        Description('Renew the leases of all the locks of a session.')
+        .notes('When dm.lock_lease_duration is set, locks that are not renewed within that '
+               'many seconds are released. Returns the number of renewed locks and their '
+               'new expiry time, which is null if locks do not expire.')
+        .modelParam('id', 'The ID of the session.', model=SessionModel, level=AccessType.WRITE)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Access was denied for the session.', 403)
+    )
+    def heartbeat(self, session):
+        renewed, expires = LockModel().renewLeases(session)
+        return {'renewed': renewed, 'expires': expires}
+
     @access.user
     @autoDescribeRoute(
         Description('Create a session.')
@@ -14,7 +14,8 @@ class Transfer(Resource):
         self.name = 'transfer'
         self.exposeFields(level=AccessType.READ,
                           fields={'_id', 'ownerId', 'sessionId', 'itemId', 'status', 'error',
-                                  'size', 'transferred', 'path', 'startTime', 'endTime'})
+                                  'size', 'transferred', 'rate', 'path', 'startTime', 'endTime',
+                                  'priority'})
 
     def validate(self, transfer):
         return transfer